@@ -0,0 +1,117 @@
+import json  # Import json to save and read the chosen batch sizes
+import math  # Import math for the step reduction
+import os  # Import os for path handling
+import sys  # Import sys to estimate the memory used by a row
+from statistics import median  # Import median to smooth the throughput measurements
+
+# Adaptive batch sizing for executemany. The controller measures the rows/s of every batch sent to the
+# database and climbs towards the batch size with the best throughput: it keeps multiplying the size while
+# the throughput improves, turns back and takes smaller steps when it gets worse, and settles when the step
+# is too small to matter. Sizes stay between the configured limits and within a memory budget.
+# The sizes chosen for each table are saved so they can be pinned in later runs. They are run state, not
+# data, so they are saved in '../batch_sizes.json' (the LDS_DW_480 folder) rather than in 'Tables CSV'.
+
+BATCH_SIZES_FILE = '../batch_sizes.json'
+
+class AdaptiveBatchSize:
+    def __init__(self, initial=1000, min_size=100, max_size=50000, memory_budget=64 * 1024 * 1024, buffers=1,
+                 factor=2.0, samples=3, tolerance=0.05, reprobe_every=100):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.memory_budget = memory_budget  # Bytes available for the batches held at the same time
+        self.buffers = buffers  # Batches held at the same time (more than one with the pipelined loader)
+        self.samples = samples  # Batches measured for each size, to smooth out the network noise
+        self.tolerance = tolerance  # Relative gain needed to consider a size better
+        self.reprobe_every = reprobe_every  # Measurements after which a settled size is probed again
+        self.initial_factor = factor
+        self.row_bytes = None  # Estimated memory of one row
+        self.size = self._clamp(initial)
+        self.best_size = None
+        self.best_rate = None
+        self.direction = 1  # 1 to grow the batches, -1 to shrink them
+        self.factor = factor
+        self.settled = False
+        self.measurements = []  # Throughputs measured for the current size
+        self.settled_for = 0  # Measurements since the size settled
+        self.history = []  # (size, rows/s) of every completed step
+
+    def current(self):
+        # Batch size to use for the next batch
+        return self.size
+
+    def _limit(self):
+        # Largest size allowed by the limits and by the memory budget
+        limit = self.max_size
+        if self.row_bytes:
+            limit = min(limit, self.memory_budget // (self.row_bytes * self.buffers))
+        return max(self.min_size, limit)
+
+    def _clamp(self, size):
+        return int(min(max(size, self.min_size), self._limit()))
+
+    def record(self, rows, elapsed, sample_row=None):
+        # Record the time taken by executemany for a batch of 'rows' rows
+        if sample_row is not None and self.row_bytes is None:
+            self.row_bytes = sys.getsizeof(sample_row) + sum(sys.getsizeof(value) for value in sample_row)
+            self.size = self._clamp(self.size)
+        if elapsed <= 0 or rows != self.size:
+            return  # Batches read before the last change, or the last partial batch of a table
+        self.measurements.append(rows / elapsed)
+
+        if self.settled:
+            self.settled_for += 1
+            if self.settled_for >= self.reprobe_every:
+                # Latency may have changed: probe around the settled size again with small steps
+                self.settled, self.settled_for, self.factor = False, 0, math.sqrt(self.initial_factor)
+                self.best_rate = median(self.measurements[-self.samples:])
+                self.measurements = []
+                self._step()
+            return
+        if len(self.measurements) < self.samples:
+            return
+
+        rate = median(self.measurements)
+        self.measurements = []
+        self.history.append((self.size, rate))
+        if self.size == self.best_size:
+            self.best_rate = rate  # Fresh measurement of the best size
+        elif self.best_rate is None or rate > self.best_rate * (1 + self.tolerance):
+            self.best_size, self.best_rate = self.size, rate  # Better: keep going the same way
+        else:
+            # Worse: turn back with a smaller step
+            self.direction = -self.direction
+            self.factor = math.sqrt(self.factor)
+        if self.best_size is None:
+            self.best_size, self.best_rate = self.size, rate
+        self._step()
+
+    def _step(self):
+        # Choose the next size to try around the best one, or settle on it
+        while self.factor >= 1 + self.tolerance:
+            candidate = self._clamp(self.best_size * self.factor ** self.direction)
+            if candidate != self.best_size:
+                self.size = candidate
+                return
+            # Limit reached in this direction: try the other one with a smaller step
+            self.direction = -self.direction
+            self.factor = math.sqrt(self.factor)
+        self.size = self.best_size
+        self.settled = True
+
+    def chosen(self):
+        # Size to pin for this table: the best one measured so far
+        return self.best_size or self.size
+
+def load_batch_sizes(path=BATCH_SIZES_FILE):
+    # Read the pinned batch sizes (table name -> size), if any
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as sizes_file:
+        return json.load(sizes_file)
+
+def save_batch_sizes(sizes, path=BATCH_SIZES_FILE):
+    # Merge the chosen batch sizes into the file of pinned sizes
+    pinned = load_batch_sizes(path)
+    pinned.update(sizes)
+    with open(path, 'w') as sizes_file:
+        json.dump(pinned, sizes_file, indent=2)
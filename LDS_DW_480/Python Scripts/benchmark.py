@@ -0,0 +1,135 @@
+import argparse  # Import argparse to read the command line options
+import json  # Import json to store the results and the baseline
+import os  # Import os for path handling and to wait for the stages with their resource usage
+import platform  # Import platform to record the machine of the run
+import shlex  # Import shlex to split the extra options of the load
+import subprocess  # Import subprocess to run every stage in its own process
+import sys  # Import sys to find the current Python interpreter
+import time  # Import time to measure the stages
+
+from generate_data import parse_count
+
+# End-to-end benchmark of the data warehouse build: generates the source data with generate_data.py (or
+# uses existing files), then runs dimension extraction, fact build and the load into a local SQLite
+# database, each stage in its own process so that its peak RSS is measured alone. The results (seconds,
+# rows/s and peak RSS of every stage) are written as JSON and compared with a stored baseline: a stage is
+# flagged when its throughput drops, or its memory grows, by more than the tolerance.
+
+BENCHMARK_DIR = '../Benchmark'
+RESULTS_FILE = 'benchmark.json'
+BASELINE_FILE = 'baseline.json'
+TOLERANCE = 0.2  # Relative change allowed before a stage is flagged
+
+def run_stage(arguments):
+    # Run a script of this folder; returns (seconds, peak RSS in MB, output)
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable] + arguments, cwd=scripts_dir,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    output = process.stdout.read()
+    process.stdout.close()
+    # wait4 returns the resource usage of this process only (ru_maxrss is in KB on Linux)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    exit_code = os.waitstatus_to_exitcode(status)
+    if exit_code != 0:
+        raise RuntimeError(f"{' '.join(arguments)} failed with exit code {exit_code}:\n{output[-2000:]}")
+    return elapsed, usage.ru_maxrss / 1024, output
+
+def count_rows(path):
+    # Data rows of a CSV file
+    with open(path, 'rb') as csv_file:
+        return sum(1 for line in csv_file if line.strip()) - 1
+
+def run_benchmark(work_dir, rows=None, seed=0, load_arguments=()):
+    # Run every stage on the data of 'work_dir' (generated first if 'rows' is given); returns the results
+    source_dir = os.path.abspath(os.path.join(work_dir, 'Original data'))
+    tables_dir = os.path.abspath(os.path.join(work_dir, 'Tables CSV'))
+    database = os.path.abspath(os.path.join(work_dir, 'benchmark.sqlite'))
+    sales_file = os.path.join(source_dir, 'computer_sales.csv')
+    geography_file = os.path.join(source_dir, 'geography.csv')
+    os.makedirs(tables_dir, exist_ok=True)
+    if os.path.exists(database):
+        os.remove(database)  # Every run loads into an empty database
+
+    stages = []
+    if rows:
+        stages.append(('generate', ['generate_data.py', '--rows', str(rows), '--seed', str(seed),
+                                    '--output-dir', source_dir]))
+    stages += [
+        ('extract_dimensions', ['extract_dimensions.py', '--sales', sales_file, '--geography', geography_file,
+                                '--output-dir', tables_dir]),
+        ('build_fact', ['build_fact.py', '--sales', sales_file, '--tables-dir', tables_dir]),
+        ('load', ['loadData.py', '--backend', 'sqlite', '--database', database, '--tables-dir', tables_dir]
+         + list(load_arguments))
+    ]
+    results = {'rows': rows, 'seed': seed, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'python': platform.python_version(), 'machine': f'{platform.system()} {platform.machine()}',
+               'cpus': os.cpu_count(), 'stages': {}}
+    for name, arguments in stages:
+        print(f"{name}...", end=' ', flush=True)
+        seconds, peak_rss, _ = run_stage(arguments)
+        if results['rows'] is None:
+            results['rows'] = count_rows(sales_file)
+        results['stages'][name] = {'seconds': round(seconds, 3),
+                                   'rows_per_second': round(results['rows'] / seconds, 1),
+                                   'peak_rss_mb': round(peak_rss, 1)}
+        print(f"{seconds:.2f} s, {results['rows'] / seconds:,.0f} rows/s, peak RSS {peak_rss:,.0f} MB")
+    return results
+
+def compare_with_baseline(results, baseline, tolerance=TOLERANCE):
+    # Stages slower or bigger than the baseline by more than the tolerance, as messages
+    regressions = []
+    for name, stage in results['stages'].items():
+        reference = baseline['stages'].get(name)
+        if reference is None:
+            continue
+        if stage['rows_per_second'] < reference['rows_per_second'] * (1 - tolerance):
+            regressions.append(f"{name}: {stage['rows_per_second']:,.0f} rows/s, "
+                               f"baseline {reference['rows_per_second']:,.0f} rows/s")
+        if stage['peak_rss_mb'] > reference['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {stage['peak_rss_mb']:,.0f} MB, "
+                               f"baseline {reference['peak_rss_mb']:,.0f} MB")
+    return regressions
+
+def write_json(path, data):
+    with open(path, 'w') as json_file:
+        json.dump(data, json_file, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time every stage of the data warehouse build and check for regressions.')
+    parser.add_argument('--rows', type=parse_count, help='generate this many sales first, e.g. 1M (default: use the existing data)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated data')
+    parser.add_argument('--work-dir', default=BENCHMARK_DIR,
+                        help="folder with the 'Original data' to use and where the tables and database are written")
+    parser.add_argument('--load-args', default='', help='extra options of loadData.py, e.g. --load-args="--bulk-reload"')
+    parser.add_argument('--output', help=f"results file (default: {RESULTS_FILE} in the work folder)")
+    parser.add_argument('--baseline', help=f"baseline file (default: {BASELINE_FILE} in the work folder)")
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='relative drop of rows/s (or growth of peak RSS) flagged as a regression')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.work_dir, args.rows, args.seed,
+                            shlex.split(args.load_args))
+    output_file = args.output or os.path.join(args.work_dir, RESULTS_FILE)
+    write_json(output_file, results)
+    print(f"Results written to '{output_file}'.")
+
+    baseline_file = args.baseline or os.path.join(args.work_dir, BASELINE_FILE)
+    if args.save_baseline:
+        write_json(baseline_file, results)
+        print(f"Baseline saved to '{baseline_file}'.")
+    elif os.path.exists(baseline_file):
+        with open(baseline_file, 'r') as json_file:
+            baseline = json.load(json_file)
+        if baseline['rows'] != results['rows']:
+            print(f"Note: the baseline was measured on {baseline['rows']:,} rows, this run on {results['rows']:,}.")
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression against the baseline of {baseline['date']} (tolerance {args.tolerance:.0%}).")
+    else:
+        print(f"No baseline in '{baseline_file}' (use --save-baseline to store one).")
@@ -0,0 +1,188 @@
+import argparse  # Import argparse to read the command line options
+import csv  # Import the csv module for reading and writing CSV files
+import os  # Import os for path handling
+import shutil  # Import shutil to append the parts written by the workers
+import tempfile  # Import tempfile to create the folder of the parts
+import time  # Import time to measure the wall-clock time
+from operator import itemgetter  # Import itemgetter to build the natural keys quickly
+
+import metrics
+from calendar_dim import time_id_lookup
+from sources import expand_sources, map_shards, source_header, source_rows
+from star_schema import (DIMENSIONS, FACT_FIELDS, FACT_FILE, FACT_REJECT_FILE, GEOGRAPHY, SALES_FILE,
+                         SALES_MEASURES, TABLES_DIR)
+
+# Streaming fact builder: reads the raw sales once and writes 'Tables CSV/computer_sales.csv' with the
+# surrogate keys of every dimension. The keys are resolved through in-memory hash indexes built from the
+# dimension tables, so memory only depends on the size of the dimensions, never on the number of sales.
+# Rows whose keys cannot be resolved are written to a reject file instead of stopping the run.
+# The sales can be a glob of (compressed) shards, resolved in parallel with --workers (see sources.py).
+
+def load_dimension_indexes(tables_dir=TABLES_DIR, calendar=None):
+    # Build a hash index natural key -> surrogate id for each dimension table.
+    # With 'calendar' (first and last YYYYMMDD code) the Time index is generated for that range of days
+    # instead of being read from Time.csv.
+    indexes = {}
+    for name, spec in DIMENSIONS.items():
+        if name == 'Time' and calendar:
+            indexes[name] = time_id_lookup(*calendar)
+            continue
+        with open(os.path.join(tables_dir, spec['file']), 'r') as dimension_file:
+            reader = csv.reader(dimension_file)
+            next(reader)  # Skip the header
+            if name == 'Time':
+                # The time code is the id of the Time dimension
+                indexes[name] = {row[0]: row[0] for row in reader if row}
+            else:
+                # The natural key is the tuple of all the columns after the id, in the same order as the sales file
+                indexes[name] = {tuple(row[1:]): row[0] for row in reader if row}
+
+    # Geography ids come straight from the sales file, so the index only checks they exist
+    with open(os.path.join(tables_dir, GEOGRAPHY['file']), 'r') as geography_file:
+        reader = csv.reader(geography_file)
+        next(reader)
+        indexes['Geography'] = {row[0]: row[0] for row in reader if row}
+    return indexes
+
+def fact_getters(header):
+    # Build the functions extracting the natural keys and the measures from a raw sales row
+    positions = {name: index for index, name in enumerate(header)}
+    getters = {name: itemgetter(*[positions[column] for column in spec['key']]) for name, spec in DIMENSIONS.items()}
+    getters['Geography'] = itemgetter(positions['geo_id'])
+    getters['measures'] = itemgetter(*[positions[column] for column in SALES_MEASURES])
+    # The sale id is taken from the sales file when available, otherwise it is the row number
+    getters['sale_id'] = itemgetter(positions['sale_id']) if 'sale_id' in positions else None
+    return getters
+
+def resolve_rows(rows, header, indexes, fact_writer, reject_writer, first_line=2, label=None, first_sale_id=0):
+    # Resolve the surrogate keys of raw sales rows, writing the fact rows and the rejects; returns
+    # (written, rejected). 'label' (the shard name) prefixes the line numbers of the rejects.
+    geo_index, time_index = indexes['Geography'], indexes['Time']
+    cpu_index, gpu_index, ram_index = indexes['Cpu'], indexes['Gpu'], indexes['Ram']
+    width = len(header)
+    getters = fact_getters(header)
+    get_geo, get_time = getters['Geography'], getters['Time']
+    get_cpu, get_gpu, get_ram = getters['Cpu'], getters['Gpu'], getters['Ram']
+    get_measures, get_sale_id = getters['measures'], getters['sale_id']
+
+    written = 0  # Number of fact rows written
+    rejected = 0  # Number of rows sent to the reject file
+    # Line 1 is the header
+    for line, row in enumerate(rows, start=first_line):
+        if len(row) != width:
+            if row:
+                reject_writer.writerow([f'{label}:{line}' if label else line,
+                                        f'expected {width} columns, found {len(row)}'] + row)
+                rejected += 1
+            continue
+
+        geo_id = geo_index.get(get_geo(row))
+        time_id = time_index.get(get_time(row))
+        ram_id = ram_index.get(get_ram(row))
+        cpu_id = cpu_index.get(get_cpu(row))
+        gpu_id = gpu_index.get(get_gpu(row))
+
+        if geo_id is None or time_id is None or ram_id is None or cpu_id is None or gpu_id is None:
+            # Report every key that could not be resolved
+            missing = [column for column, value in
+                       (('geo_id', geo_id), ('time_id', time_id), ('ram_id', ram_id), ('cpu_id', cpu_id), ('gpu_id', gpu_id))
+                       if value is None]
+            reject_writer.writerow([f'{label}:{line}' if label else line, 'unresolved ' + ', '.join(missing)] + row)
+            rejected += 1
+            continue
+
+        sale_id = get_sale_id(row) if get_sale_id else first_sale_id + written
+        fact_writer.writerow((sale_id, geo_id, time_id, ram_id, cpu_id, gpu_id) + get_measures(row))
+        written += 1
+    return written, rejected
+
+# Dimension indexes of a worker process, loaded once by init_worker
+worker_indexes = None
+
+def init_worker(tables_dir, calendar):
+    global worker_indexes
+    worker_indexes = load_dimension_indexes(tables_dir, calendar)
+
+def build_shard(task):
+    # Worker: resolve one shard into its own fact and reject part files (without headers)
+    path, header, label, fact_part, reject_part = task
+    with open(fact_part, 'w', newline='') as fact_output, open(reject_part, 'w', newline='') as reject_output:
+        return resolve_rows(source_rows([path], header), header, worker_indexes, csv.writer(fact_output),
+                            csv.writer(reject_output), label=label)
+
+def build_fact(sales_file=SALES_FILE, tables_dir=TABLES_DIR, output_file=None, reject_file=None, calendar=None,
+               workers=1):
+    # Stream the raw sales, resolve the surrogate keys and write the fact table and its rejects.
+    # 'sales_file' may be a glob of (compressed) shards; with workers > 1 every shard is resolved by a
+    # worker into part files, which are then concatenated in shard order, so the output is the same as
+    # with one process.
+    output_file = output_file or os.path.join(tables_dir, FACT_FILE)
+    reject_file = reject_file or os.path.join(tables_dir, FACT_REJECT_FILE)
+    paths = expand_sources(sales_file)
+    header = source_header(paths)
+    labels = [os.path.basename(path) for path in paths] if len(paths) > 1 else [None]
+    if 'sale_id' not in header:
+        workers = 1  # The sale ids are row numbers, which a worker cannot know for the shards after the first
+
+    written = 0  # Number of fact rows written
+    rejected = 0  # Number of rows sent to the reject file
+    with metrics.span('resolve keys'), open(output_file, 'w', newline='') as fact_output, \
+            open(reject_file, 'w', newline='') as reject_output:
+        fact_writer = csv.writer(fact_output)
+        fact_writer.writerow(FACT_FIELDS)
+        reject_writer = csv.writer(reject_output)
+        reject_writer.writerow(['line', 'reason'] + header)
+
+        if workers <= 1 or len(paths) == 1:
+            with metrics.span('load indexes'):
+                indexes = load_dimension_indexes(tables_dir, calendar)
+            for path, label in zip(paths, labels):
+                shard_written, shard_rejected = resolve_rows(source_rows([path], header), header, indexes,
+                                                             fact_writer, reject_writer, label=label,
+                                                             first_sale_id=written)
+                written += shard_written
+                rejected += shard_rejected
+        else:
+            parts_dir = tempfile.mkdtemp(prefix='fact-', dir=os.path.dirname(os.path.abspath(output_file)))
+            try:
+                tasks = [(path, header, label, os.path.join(parts_dir, f'{index}.fact.csv'),
+                          os.path.join(parts_dir, f'{index}.rejects.csv'))
+                         for index, (path, label) in enumerate(zip(paths, labels))]
+                fact_output.flush()
+                reject_output.flush()
+                # Results come back in shard order: append every part as soon as its shard is done
+                for task, (shard_written, shard_rejected) in zip(tasks, map_shards(
+                        build_shard, tasks, workers, init_worker, (tables_dir, calendar))):
+                    for part, output in ((task[3], fact_output), (task[4], reject_output)):
+                        with open(part, 'r', newline='') as part_file:
+                            shutil.copyfileobj(part_file, output)
+                        os.remove(part)
+                    written += shard_written
+                    rejected += shard_rejected
+            finally:
+                shutil.rmtree(parts_dir, ignore_errors=True)
+
+    metrics.count('fact_rows_written', written)
+    metrics.count('fact_rows_rejected', rejected)
+    return written, rejected
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the fact table resolving the surrogate keys of every dimension.')
+    parser.add_argument('--sales', default=SALES_FILE,
+                        help="sales CSV file, or a quoted glob of shards, plain or .gz/.bz2/.xz (e.g. 'sales_*.csv.gz')")
+    parser.add_argument('--workers', type=int, default=1, help='number of processes resolving the shards')
+    parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the dimension tables')
+    parser.add_argument('--output', help='fact table CSV file (default: computer_sales.csv in the tables folder)')
+    parser.add_argument('--rejects', help='reject file (default: computer_sales_rejects.csv in the tables folder)')
+    parser.add_argument('--calendar', nargs=2, metavar=('FIRST', 'LAST'),
+                        help='resolve the time ids against the calendar of these days (YYYYMMDD) instead of Time.csv')
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.enable_from_args(args, 'build_fact')
+
+    start = time.perf_counter()
+    written, rejected = build_fact(args.sales, args.tables_dir, args.output, args.rejects,
+                                   tuple(args.calendar) if args.calendar else None, args.workers)
+    elapsed = time.perf_counter() - start
+    print(f"Fact table created: {written} rows written, {rejected} rows rejected "
+          f"in {elapsed:.2f} s ({(written + rejected) / elapsed:,.0f} rows/s).")
@@ -0,0 +1,114 @@
+import argparse  # Import argparse to read the command line options
+import csv  # Import the csv module for writing the Time table
+import os  # Import os for path handling
+import time  # Import time to measure the generation (the builtin module, not time.py)
+from functools import lru_cache  # Import lru_cache to memoize the code -> time_id lookups
+
+import numpy as np  # Import numpy for the vectorized date arithmetic
+
+from star_schema import DIMENSIONS, TABLES_DIR, parse_time_code
+
+# Calendar generator for the Time dimension. Instead of parsing the time codes found in the sales one at a
+# time, the whole range of days is built at once with NumPy datetime64 arithmetic, so the Time table has no
+# gaps and does not need rebuilding when a sale falls on a new day of the range. The columns are the same
+# as the ones of time.py: the YYYYMMDD code as time_id, day, month, year, day_of_week, ISO week and quarter.
+
+# Names of the days, Monday first (datetime64 day 0, 1970-01-01, is a Thursday)
+DAY_NAMES = np.array(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'])
+QUARTER_NAMES = np.array(['Q1', 'Q2', 'Q3', 'Q4'])
+
+def to_day(time_code):
+    # Convert a YYYYMMDD code to a datetime64 day
+    code = str(time_code)
+    return np.datetime64(f'{code[:4]}-{code[4:6]}-{code[6:8]}', 'D')
+
+def calendar_columns(first, last):
+    # Build the columns of the Time table for every day from 'first' to 'last' (YYYYMMDD codes, included)
+    days = np.arange(to_day(first), to_day(last) + 1, dtype='datetime64[D]')
+    years = days.astype('datetime64[Y]')
+    months = days.astype('datetime64[M]')
+    year = years.astype(np.int64) + 1970
+    month = (months - years).astype(np.int64) + 1
+    day = (days - months).astype(np.int64) + 1
+
+    # ISO week: the week belongs to the year of its Thursday, and counts from the first Thursday of that year
+    ordinal = days.astype(np.int64)
+    weekday = (ordinal + 3) % 7  # Monday = 0
+    thursday = (ordinal - weekday + 3).astype('datetime64[D]')
+    iso_year_start = thursday.astype('datetime64[Y]').astype('datetime64[D]')
+    week = (thursday - iso_year_start).astype(np.int64) // 7 + 1
+
+    return {
+        'time_id': year * 10000 + month * 100 + day,
+        'day': day,
+        'month': month,
+        'year': year,
+        'day_of_week': DAY_NAMES[weekday],
+        'week': week,
+        'quarter': QUARTER_NAMES[(month - 1) // 3]
+    }
+
+def calendar_rows(first, last):
+    # Rows of the Time table for the range, in the column order of DIMENSIONS['Time']
+    columns = calendar_columns(first, last)
+    return zip(*[columns[field].tolist() for field in DIMENSIONS['Time']['fields']])
+
+def calendar_range(time_codes):
+    # Whole years covering the given time codes, so new days of those years are already in the table
+    codes = [int(code) for code in time_codes if code]
+    return min(codes) // 10000 * 10000 + 101, max(codes) // 10000 * 10000 + 1231
+
+def write_calendar(first, last, output_dir=TABLES_DIR):
+    # Write the full calendar to Time.csv, returning the number of days
+    spec = DIMENSIONS['Time']
+    rows = list(calendar_rows(first, last))
+    with open(os.path.join(output_dir, spec['file']), 'w', newline='') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(spec['fields'])
+        writer.writerows(rows)
+    return len(rows)
+
+@lru_cache(maxsize=None)
+def time_id_lookup(first, last):
+    # Hash index time code -> time_id for the range, built once per range and shared by every caller
+    codes = calendar_columns(first, last)['time_id'].astype(str).tolist()
+    return dict(zip(codes, codes))
+
+def check_against_parser(first, last):
+    # Compare every generated row with the one of parse_time_code, returning the first mismatch if any
+    fields = DIMENSIONS['Time']['fields'][1:]
+    for row in calendar_rows(first, last):
+        components = parse_time_code(row[0])
+        expected = [components[field] for field in fields]
+        if list(row[1:]) != expected:
+            return row, expected
+    return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the full Time dimension for a range of days.')
+    parser.add_argument('first', help='first day, YYYYMMDD')
+    parser.add_argument('last', help='last day, YYYYMMDD')
+    parser.add_argument('--output-dir', default=TABLES_DIR, help='folder where Time.csv is written')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='time the generation against parse_time_code and check the rows are identical '
+                             'instead of writing Time.csv')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        start = time.perf_counter()
+        columns = calendar_columns(args.first, args.last)
+        vectorized = time.perf_counter() - start
+        start = time.perf_counter()
+        parse_time_code.cache_clear()
+        for code in columns['time_id'].tolist():
+            parse_time_code(code)
+        parsed = time.perf_counter() - start
+        days = len(columns['time_id'])
+        print(f"{days} days: vectorized {vectorized * 1000:.2f} ms, parse_time_code {parsed * 1000:.2f} ms "
+              f"({parsed / vectorized:.0f}x)")
+        mismatch = check_against_parser(args.first, args.last)
+        print("Rows identical to parse_time_code." if mismatch is None else f"Mismatch: {mismatch}")
+    else:
+        start = time.perf_counter()
+        days = write_calendar(args.first, args.last, args.output_dir)
+        print(f"Time table created with {days} days in {(time.perf_counter() - start) * 1000:.1f} ms.")
@@ -0,0 +1,215 @@
+import argparse  # Import argparse to read the command line options
+import csv  # Import the csv module for reading and writing CSV files
+import json  # Import json to store the metadata of each table
+import math  # Import math to recognise missing float values
+import os  # Import os for path handling
+
+import numpy as np  # Import numpy for the typed arrays and the memory mapping
+
+from star_schema import TABLE_COLUMNS, TABLE_FILES, TABLES_DIR
+
+# Typed columnar copy of the 'Tables CSV' outputs. Each table is a folder with one binary file per column
+# and a 'meta.json' file. INT and FLOAT columns are fixed-width little-endian arrays, VARCHAR columns are
+# dictionary-encoded (int32 codes + the list of distinct strings). Files are opened with memory mapping,
+# so batches are read without copying or parsing anything. Types come from TABLE_COLUMNS in star_schema,
+# the same definitions used for the CREATE TABLE statements.
+
+def columnar_dir(tables_dir=TABLES_DIR):
+    # The columnar copy of the tables of a folder lives in its 'columnar' subfolder
+    return os.path.join(tables_dir, 'columnar')
+
+def export_dir(tables_dir=TABLES_DIR):
+    # CSV files exported from the columnar copy, kept apart from the original tables
+    return os.path.join(tables_dir, 'export')
+
+COLUMNAR_DIR = columnar_dir()
+META_FILE = 'meta.json'
+
+# Storage used for every SQL type
+INT_DTYPE = np.dtype('<i8')
+FLOAT_DTYPE = np.dtype('<f8')
+CODE_DTYPE = np.dtype('<i4')
+
+# Missing values: NaN for FLOAT columns, the smallest int64 for INT columns
+INT_NULL = np.iinfo(INT_DTYPE).min
+
+BATCH_SIZE = 65536  # Rows converted at a time when writing
+
+def storage_of(sql_type):
+    # Return how a column with this SQL type is stored
+    if sql_type == 'INT':
+        return 'int'
+    if sql_type == 'FLOAT':
+        return 'float'
+    return 'dict'
+
+def parse_int(value):
+    return int(value) if value != '' else INT_NULL
+
+def parse_float(value):
+    return float(value) if value != '' else math.nan
+
+def write_table(table_name, csv_file, output_dir=COLUMNAR_DIR, batch_size=BATCH_SIZE):
+    # Convert a CSV table to the columnar format, one batch at a time so memory stays bounded
+    table_dir = os.path.join(output_dir, table_name)
+    os.makedirs(table_dir, exist_ok=True)
+    columns = TABLE_COLUMNS[table_name]
+    storages = [storage_of(sql_type) for _, sql_type in columns]
+    dictionaries = [{} if storage == 'dict' else None for storage in storages]  # String -> code
+    # FLOAT columns: whether the source writes integral values with their '.0' ('6.0') or not ('6'),
+    # None until an integral value is seen, so the CSV export gives back the same text
+    point_zero = [None] * len(columns)
+
+    column_files = [open(os.path.join(table_dir, name + '.bin'), 'wb') for name, _ in columns]
+    row_count = 0
+    try:
+        with open(csv_file, 'r') as source:
+            reader = csv.reader(source)
+            header = next(reader)
+            if header != [name for name, _ in columns]:
+                raise ValueError(f"Columns of '{csv_file}' do not match the definition of table '{table_name}': {header}")
+
+            batch = []
+            for row in reader:
+                if row:
+                    batch.append(row)
+                if len(batch) == batch_size:
+                    write_batch(batch, storages, dictionaries, column_files, point_zero)
+                    row_count += len(batch)
+                    batch = []
+            if batch:
+                write_batch(batch, storages, dictionaries, column_files, point_zero)
+                row_count += len(batch)
+    finally:
+        for column_file in column_files:
+            column_file.close()
+
+    # The metadata is written last, so a table without it is known to be incomplete
+    meta = {
+        'table': table_name,
+        'rows': row_count,
+        'columns': [
+            {'name': name, 'sql_type': sql_type, 'storage': storage,
+             'dictionary': list(dictionary) if dictionary is not None else None,
+             'point_zero': point_zero[index] is not False}
+            for index, ((name, sql_type), storage, dictionary) in enumerate(zip(columns, storages, dictionaries))
+        ]
+    }
+    with open(os.path.join(table_dir, META_FILE), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    return row_count
+
+def write_batch(batch, storages, dictionaries, column_files, point_zero):
+    # Convert a batch of CSV rows column by column and append the typed values to the column files
+    for index, (values, storage, dictionary) in enumerate(zip(zip(*batch), storages, dictionaries)):
+        if storage == 'int':
+            array = np.fromiter(map(parse_int, values), dtype=INT_DTYPE, count=len(values))
+        elif storage == 'float':
+            array = np.fromiter(map(parse_float, values), dtype=FLOAT_DTYPE, count=len(values))
+            if point_zero[index] is None:
+                integral = np.flatnonzero(array == np.floor(array))
+                if len(integral):
+                    point_zero[index] = '.' in values[integral[0]]
+        else:
+            # New strings get the next code of the dictionary
+            array = np.fromiter((dictionary.setdefault(value, len(dictionary)) for value in values),
+                                dtype=CODE_DTYPE, count=len(values))
+        array.tofile(column_files[index])
+
+class ColumnarTable:
+    # Read-only view of a columnar table; every column is a memory-mapped numpy array
+    def __init__(self, table_dir):
+        with open(os.path.join(table_dir, META_FILE), 'r') as meta_file:
+            meta = json.load(meta_file)
+        self.name = meta['table']
+        self.num_rows = meta['rows']
+        self.meta = {column['name']: column for column in meta['columns']}
+        self.columns = [column['name'] for column in meta['columns']]
+        self.dictionaries = {name: np.array(column['dictionary'], dtype=object)
+                             for name, column in self.meta.items() if column['storage'] == 'dict'}
+        self.arrays = {}
+        for name, column in self.meta.items():
+            dtype = {'int': INT_DTYPE, 'float': FLOAT_DTYPE, 'dict': CODE_DTYPE}[column['storage']]
+            if self.num_rows:
+                self.arrays[name] = np.memmap(os.path.join(table_dir, name + '.bin'), dtype=dtype, mode='r',
+                                              shape=(self.num_rows,))
+            else:
+                self.arrays[name] = np.empty(0, dtype=dtype)  # numpy cannot map an empty file
+
+    def column(self, name):
+        # Return the stored array of a column (the codes for dictionary-encoded columns), without copying
+        return self.arrays[name]
+
+    def decoded(self, name, start=0, stop=None):
+        # Return the values of a column, decoding the strings of dictionary-encoded columns
+        values = self.arrays[name][start:stop]
+        if name in self.dictionaries:
+            return self.dictionaries[name][values]
+        return values
+
+    def iter_batches(self, batch_size=BATCH_SIZE, columns=None):
+        # Yield dictionaries column name -> array slice; the slices are views on the mapped files
+        columns = columns or self.columns
+        for start in range(0, self.num_rows, batch_size):
+            yield {name: self.arrays[name][start:start + batch_size] for name in columns}
+
+    def iter_rows(self, batch_size=BATCH_SIZE):
+        # Yield batches of row tuples with Python values (None for missing values), ready for executemany
+        for start in range(0, self.num_rows, batch_size):
+            stop = start + batch_size
+            converted = []
+            for name in self.columns:
+                storage = self.meta[name]['storage']
+                values = self.decoded(name, start, stop).tolist()
+                if storage == 'int':
+                    values = [None if value == INT_NULL else value for value in values]
+                elif storage == 'float':
+                    values = [None if value != value else value for value in values]  # NaN is not equal to itself
+                converted.append(values)
+            yield list(zip(*converted))
+
+def format_value(value, point_zero=True):
+    # Format a value for the CSV export; floats are written with repr, and integral floats keep their '.0'
+    # only if the source file had it (1308.0 or 6, as recorded when the table was converted)
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return str(int(value)) if not point_zero and value.is_integer() else repr(value)
+    return value
+
+def export_csv(table_dir, csv_file):
+    # Write a columnar table back to CSV, for compatibility with the tools reading 'Tables CSV'
+    table = ColumnarTable(table_dir)
+    with open(csv_file, 'w', newline='') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(table.columns)
+        # Tables converted before the '.0' was recorded keep it
+        point_zero = [table.meta[name].get('point_zero', True) for name in table.columns]
+        for rows in table.iter_rows():
+            writer.writerows([format_value(value, keep) for value, keep in zip(row, point_zero)] for row in rows)
+    return table.num_rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert the 'Tables CSV' outputs to the typed columnar format and back.")
+    parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the CSV tables')
+    parser.add_argument('--columnar-dir', help="folder with the columnar tables (default: 'columnar' in the tables folder)")
+    parser.add_argument('--export', action='store_true', help='export the columnar tables to CSV instead')
+    parser.add_argument('--export-dir',
+                        help="folder of the exported CSV files (default: 'export' in the tables folder, never the tables themselves)")
+    args = parser.parse_args()
+    args.columnar_dir = args.columnar_dir or columnar_dir(args.tables_dir)
+    if args.export:
+        args.export_dir = args.export_dir or export_dir(args.tables_dir)
+        os.makedirs(args.export_dir, exist_ok=True)
+
+    for table_name, file_name in TABLE_FILES.items():
+        csv_file = os.path.join(args.tables_dir, file_name)
+        if args.export:
+            csv_file = os.path.join(args.export_dir, file_name)
+            rows = export_csv(os.path.join(args.columnar_dir, table_name), csv_file)
+            print(f"Table '{table_name}' exported to '{csv_file}' ({rows} rows).")
+        elif os.path.exists(csv_file):
+            rows = write_table(table_name, csv_file, args.columnar_dir)
+            print(f"Table '{table_name}' converted to the columnar format ({rows} rows).")
+        else:
+            print(f"File '{csv_file}' not found, table '{table_name}' skipped.")
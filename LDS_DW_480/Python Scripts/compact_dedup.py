@@ -0,0 +1,230 @@
+import csv  # Import the csv module for the spill files
+import hashlib  # Import hashlib for the 128-bit fingerprints of the keys
+import heapq  # Import heapq to merge the spilled partitions in first-seen order
+import os  # Import os for path handling
+import shutil  # Import shutil to remove the spill folder
+import tempfile  # Import tempfile to create the spill folder
+from array import array  # Import array for the compact offsets of the stored keys
+
+import numpy as np  # Import numpy for the open-addressing table and the batch probes
+
+# Low-memory deduplication of natural keys, for dimensions with many distinct members. Instead of a set of
+# key tuples plus a dict of attribute rows (cpu.py, gpu.py, ram.py), every distinct key is stored once as
+# encoded bytes in a single buffer, and found again through an open-addressing hash table made of NumPy
+# arrays: the two 64-bit halves of a 128-bit BLAKE2b digest of the encoded key, and the id of the key. A hit
+# compares the fingerprints only, never the stored bytes, so the fingerprint must be wide: with 128 bits
+# two distinct keys are never confused in practice (Python's hash() has 64 bits and collides on purpose,
+# e.g. hash(-1) == hash(-2)). Rows are processed in batches: the keys of a batch are deduplicated first,
+# then their fingerprints are probed against the table all at once, so only the keys never seen before are
+# stored. Ids follow the first-seen order, like the original scripts.
+#
+# When the table and the stored keys exceed the memory budget, the set spills: the keys seen so far stay in
+# memory (and are still recognized), and new keys are written, with the position of the row they were
+# first seen on, to one of several partition files chosen by hash. At the end every partition is
+# deduplicated on its own and the partitions are merged back by position, so the order (and every id) is
+# the same as with an unlimited budget while memory stays bounded by the budget plus one partition.
+
+SEPARATOR = '\x1f'  # Between the fields of an encoded key
+NONE = '\x00'  # Encodes a missing field (None), which differs from an empty one
+BATCH_ROWS = 65536  # Rows deduplicated at a time
+SPILL_PARTITIONS = 64  # Partition files of a spilled key set
+EMPTY = -1  # Id of an empty slot of the table
+CLAIMED = -2  # Slot taken in the current batch, before its id is known
+
+def fingerprints(texts):
+    # The two 64-bit halves of the 128-bit BLAKE2b digest of every encoded key
+    digests = b''.join(hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+                       for text in texts)
+    halves = np.frombuffer(digests, dtype=np.int64).reshape(-1, 2)
+    return halves[:, 0].copy(), halves[:, 1].copy()
+
+class CompactKeySet:
+    # Distinct keys of one dimension in first-seen order; 'width' is the number of fields of a key
+    # (1 for keys that are plain strings, like the time codes)
+    def __init__(self, width, memory_budget=None, spill_dir=None):
+        self.width = width
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.count = 0  # Keys in memory
+        self.blob = bytearray()  # Encoded keys, one after the other
+        self.offsets = array('q', [0])  # Start of every key in the blob, plus the end
+        self._allocate(1024)
+        self.spill = None  # Partition writers once the set has spilled
+        self.spill_files = None
+        self.spilled_rows = 0  # Position of the next row in the input (to order the spilled keys)
+
+    def _allocate(self, capacity):
+        self.mask = capacity - 1
+        self.first = np.zeros(capacity, dtype=np.int64)
+        self.second = np.zeros(capacity, dtype=np.int64)
+        self.ids = np.full(capacity, EMPTY, dtype=np.int64)
+
+    def nbytes(self):
+        return self.first.nbytes + self.second.nbytes + self.ids.nbytes + len(self.blob) + \
+            self.offsets.itemsize * len(self.offsets)
+
+    def encode(self, key):
+        if self.width == 1:
+            return NONE if key is None else key
+        return SEPARATOR.join(NONE if field is None else field for field in key)
+
+    def decode(self, text):
+        if self.width == 1:
+            return None if text == NONE else text
+        return tuple(None if field == NONE else field for field in text.split(SEPARATOR))
+
+    def _probe(self, first, second, insert):
+        # Find the slots of the fingerprints (distinct within the call). Returns the ids found (EMPTY for the
+        # missing ones) and, if 'insert', the positions of the newly claimed slots of the missing ones.
+        ids = np.full(len(first), EMPTY, dtype=np.int64)
+        claimed = np.full(len(first), -1, dtype=np.int64)
+        pending = np.arange(len(first))
+        position = first & self.mask
+        while len(pending):
+            slots = position[pending]
+            slot_ids = self.ids[slots]
+            empty = slot_ids == EMPTY
+            hit = ~empty & (self.first[slots] == first[pending]) & (self.second[slots] == second[pending])
+            ids[pending[hit]] = slot_ids[hit]
+            done = hit.copy()
+            if insert and empty.any():
+                # Several new keys may reach the same empty slot: the first one takes it, the others move on
+                _, winners = np.unique(slots[empty], return_index=True)
+                takers = np.flatnonzero(empty)[winners]
+                taken = slots[takers]
+                self.first[taken] = first[pending[takers]]
+                self.second[taken] = second[pending[takers]]
+                self.ids[taken] = CLAIMED
+                claimed[pending[takers]] = taken
+                done[takers] = True
+            elif not insert:
+                done |= empty  # Not in the table
+            pending = pending[~done]
+            position[pending] = (position[pending] + 1) & self.mask
+        return ids, claimed
+
+    def _grow(self, needed):
+        # Keep the table at most half full, rehashing every key into a larger one
+        capacity = self.mask + 1
+        if needed * 2 <= capacity:
+            return
+        while needed * 2 > capacity:
+            capacity *= 2
+        used = self.ids != EMPTY
+        first, second, ids = self.first[used], self.second[used], self.ids[used]
+        self._allocate(capacity)
+        _, claimed = self._probe(first, second, insert=True)
+        self.ids[claimed] = ids
+
+    def add_batch(self, keys):
+        # Add the keys of a batch of rows, in row order
+        distinct = list(dict.fromkeys(keys))  # Distinct keys of the batch, in first-seen order
+        texts = [self.encode(key) for key in distinct]
+        first, second = fingerprints(texts)
+        if self.spill is not None:
+            # Known keys are skipped; the new ones go to the partitions with the position of their first row
+            ids, _ = self._probe(first, second, insert=False)
+            missing = np.flatnonzero(ids == EMPTY).tolist()
+            if missing:
+                first_row = dict(zip(reversed(keys), range(len(keys) - 1, -1, -1)))  # The smallest row wins
+                for index in missing:
+                    self.spill[int(first[index]) % SPILL_PARTITIONS].writerow(
+                        [self.spilled_rows + first_row[distinct[index]], texts[index]])
+            self.spilled_rows += len(keys)
+            return
+        self._grow(self.count + len(distinct))
+        ids, claimed = self._probe(first, second, insert=True)
+        new = np.flatnonzero(ids == EMPTY)  # Already in first-seen order
+        self.ids[claimed[new]] = np.arange(self.count, self.count + len(new))
+        for index in new.tolist():
+            self.blob += texts[index].encode('utf-8', 'surrogatepass')
+            self.offsets.append(len(self.blob))
+        self.count += len(new)
+        self.spilled_rows += len(keys)
+        if self.memory_budget is not None and self.nbytes() > self.memory_budget:
+            self._start_spill()
+
+    def _start_spill(self):
+        # From now on the table is frozen and new keys are written to the partition files
+        self.spill_path = tempfile.mkdtemp(prefix='dedup-', dir=self.spill_dir)
+        self.spill_files = [open(os.path.join(self.spill_path, f'{index}.csv'), 'w', newline='', encoding='utf-8',
+                                 errors='surrogatepass') for index in range(SPILL_PARTITIONS)]
+        self.spill = [csv.writer(spill_file) for spill_file in self.spill_files]
+
+    def _memory_keys(self):
+        blob, offsets = self.blob, self.offsets
+        for index in range(self.count):
+            yield self.decode(blob[offsets[index]:offsets[index + 1]].decode('utf-8', 'surrogatepass'))
+
+    def _partition_keys(self, index):
+        # Distinct keys of a partition as (position of their first row, encoded key), in position order
+        path = os.path.join(self.spill_path, f'{index}.csv')
+        seen = {}
+        with open(path, 'r', newline='', encoding='utf-8', errors='surrogatepass') as spill_file:
+            for position, text in csv.reader(spill_file):
+                position = int(position)
+                if seen.get(text, position) >= position:
+                    seen[text] = position  # Keep the first row the key was seen on
+        os.remove(path)
+        distinct = os.path.join(self.spill_path, f'{index}.distinct.csv')
+        with open(distinct, 'w', newline='', encoding='utf-8', errors='surrogatepass') as distinct_file:
+            csv.writer(distinct_file).writerows(sorted((position, text) for text, position in seen.items()))
+        return distinct
+
+    def finish(self):
+        # Close the partitions of a spilled set and deduplicate each of them on its own
+        if self.spill is None or self.spill_files is None:
+            return
+        for spill_file in self.spill_files:
+            spill_file.close()
+        self.spill_files = None
+        self.distinct_files = [self._partition_keys(index) for index in range(SPILL_PARTITIONS)]
+
+    def __iter__(self):
+        # The distinct keys in first-seen order (can be iterated several times)
+        yield from self._memory_keys()
+        if self.spill is None:
+            return
+        self.finish()
+        readers = []
+        try:
+            for path in self.distinct_files:
+                readers.append(open(path, 'r', newline='', encoding='utf-8', errors='surrogatepass'))
+            rows = heapq.merge(*[((int(position), text) for position, text in csv.reader(reader))
+                                 for reader in readers])
+            for _, text in rows:
+                yield self.decode(text)
+        finally:
+            for reader in readers:
+                reader.close()
+
+    def close(self):
+        # Remove the spill files
+        if self.spill is not None:
+            if self.spill_files:
+                for spill_file in self.spill_files:
+                    spill_file.close()
+                self.spill_files = None
+            shutil.rmtree(self.spill_path, ignore_errors=True)
+
+def collect_keys_compact(reader, getters, widths, memory_budget=None, spill_dir=None, batch_rows=BATCH_ROWS):
+    # Deduplicate the keys of every dimension from CSV rows; returns (key sets, rows read).
+    # 'getters' and 'widths' map every dimension to its key getter and number of key fields.
+    # Only the keys of a batch are kept, not its rows.
+    sets = {name: CompactKeySet(widths[name], memory_budget, spill_dir) for name in getters}
+    names = list(getters)
+    batches = [[] for _ in names]
+    pairs = [(getters[name], batch.append) for name, batch in zip(names, batches)]
+    row_count = 0
+    for row in reader:
+        for get_key, add in pairs:
+            add(get_key(row))
+        row_count += 1
+        if row_count % batch_rows == 0:
+            for name, batch in zip(names, batches):
+                sets[name].add_batch(batch)
+                batch.clear()
+    for name, batch in zip(names, batches):
+        if batch:
+            sets[name].add_batch(batch)
+    return sets, row_count
@@ -0,0 +1,63 @@
+import csv  # Import the csv module to parse the lines of a chunk
+import locale  # Import locale to decode the lines like open() does
+import os  # Import os to get the size of the files
+
+# Helpers to split a CSV file into byte ranges aligned to line boundaries, so that several workers can
+# read different parts of the same file. They assume no quoted field contains a line break, which holds
+# for the sales file and for the tables written by these scripts.
+
+def read_header(path):
+    # Return the header row of a CSV file and the byte offset of the first data row
+    with open(path, 'rb') as source:
+        line = source.readline()
+    return next(csv.reader([line.decode(locale.getpreferredencoding(False))])), len(line)
+
+def chunk_ranges(path, chunks):
+    # Split the data rows of the file into at most 'chunks' byte ranges, each boundary moved to the start
+    # of the next line
+    with open(path, 'rb') as source:
+        header = source.readline()
+        start, size = len(header), os.fstat(source.fileno()).st_size
+        boundaries = [start]
+        for index in range(1, chunks):
+            source.seek(max(start + (size - start) * index // chunks - 1, boundaries[-1]))
+            source.readline()  # Move to the start of the next line
+            boundaries.append(min(source.tell(), size))
+        boundaries.append(size)
+    return [(begin, end) for begin, end in zip(boundaries, boundaries[1:]) if begin < end]
+
+def iter_lines(path, begin, end):
+    # Yield the decoded lines of a byte range, one at a time so memory stays bounded
+    encoding = locale.getpreferredencoding(False)
+    with open(path, 'rb') as source:
+        source.seek(begin)
+        position = begin
+        while position < end:
+            line = source.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode(encoding)
+
+def iter_csv_range(path, begin, end):
+    # Yield the non-empty CSV rows of a byte range
+    for row in csv.reader(iter_lines(path, begin, end)):
+        if row:
+            yield row
+
+def iter_csv_batches(path, begin, batch_size):
+    # Yield (rows, offset) pairs from the byte offset 'begin' to the end of the file, where 'offset' is the
+    # position right after the last line of the batch, i.e. where the next batch starts
+    encoding = locale.getpreferredencoding(False)
+    with open(path, 'rb') as source:
+        source.seek(begin)
+        position = begin
+        lines = []
+        for line in source:
+            position += len(line)
+            lines.append(line.decode(encoding))
+            if len(lines) == batch_size:
+                yield [row for row in csv.reader(lines) if row], position
+                lines = []
+        if lines:
+            yield [row for row in csv.reader(lines) if row], position
@@ -0,0 +1,155 @@
+import argparse  # Import argparse to read the command line options
+import csv  # Import the csv module for reading and writing CSV files
+import os  # Import os for path handling
+import time  # Import time to measure the throughput
+
+import numpy as np  # Import numpy to convert whole batches at once
+
+import metrics
+from csv_chunks import iter_csv_batches, read_header
+from generate_data import FX_RATES_FILE as FX_RATES_NAME, GENERATED_DIR
+from star_schema import FACT_FILE, GEOGRAPHY, TABLES_DIR
+
+# Currency conversion stage: computes the '_usd' measures of the fact table from the local ones, with the
+# exchange rate of the currency of the sale's region on the day of the sale. Rates come from a local dated
+# table (one row per currency and day the rate changed); the rate of a day is the last one published on
+# or before it. Every batch is converted with array operations, and each distinct (currency, time_id) pair
+# is resolved once and then memoized, so the rate table is searched once per pair instead of once per row.
+
+# Written by generate_data.py next to the sources it generates (the real sources have no rates); columns:
+# currency, date (YYYYMMDD), usd_rate (USD for 1 unit)
+FX_RATES_FILE = os.path.join(GENERATED_DIR, FX_RATES_NAME)
+CHUNK_ROWS = 4096  # Fact rows converted at a time
+
+# Local measures and the USD measure computed from each of them
+MEASURE_PAIRS = [('ram_sales', 'ram_sales_usd'), ('cpu_sales', 'cpu_sales_usd'),
+                 ('gpu_sales', 'gpu_sales_usd'), ('total_sales', 'total_sales_usd')]
+
+class FxRates:
+    # Dated exchange rates with a memo (currency, time_id) -> rate
+    def __init__(self, rates_file=FX_RATES_FILE):
+        rates = {}
+        with open(rates_file, 'r') as fx_file:
+            for row in csv.DictReader(fx_file):
+                rates.setdefault(row['currency'], []).append((int(row['date']), float(row['usd_rate'])))
+        rates.setdefault('USD', [(0, 1.0)])  # US dollars need no rate
+        self.currencies = sorted(rates)
+        self.codes = {currency: code for code, currency in enumerate(self.currencies)}
+        self.dates, self.rates = [], []
+        for currency in self.currencies:
+            history = sorted(rates[currency])
+            self.dates.append(np.array([date for date, _ in history], dtype=np.int64))
+            self.rates.append(np.array([rate for _, rate in history]))
+        self.memo = {}  # currency code * 10**8 + time_id -> rate
+        self.lookups = 0  # Rows whose rate was requested
+
+    def code(self, currency):
+        # Return the code of a currency, failing on currencies without rates instead of assuming USD
+        if currency not in self.codes:
+            raise KeyError(f"No exchange rate for currency '{currency}'")
+        return self.codes[currency]
+
+    def resolve(self, currency_code, time_id):
+        # Search the rate table: last rate published on or before the day
+        position = np.searchsorted(self.dates[currency_code], time_id, side='right') - 1
+        if position < 0:
+            raise KeyError(f"No exchange rate for '{self.currencies[currency_code]}' on or before {time_id}")
+        return float(self.rates[currency_code][position])
+
+    def rates_for(self, currency_codes, time_ids):
+        # Return the rate of every row; only the pairs never seen before search the rate table
+        self.lookups += len(time_ids)
+        pairs, inverse = np.unique(currency_codes.astype(np.int64) * 10**8 + time_ids, return_inverse=True)
+        memo = self.memo
+        values = np.empty(len(pairs))
+        for index, pair in enumerate(pairs.tolist()):
+            rate = memo.get(pair)
+            if rate is None:
+                rate = memo[pair] = self.resolve(pair // 10**8, pair % 10**8)
+            values[index] = rate
+        return values[inverse]
+
+def convert_measures(measures, rates):
+    # Convert a batch of local measures (name -> array) to USD, rounded to cents like the source data
+    return {usd_name: np.round(measures[name] * rates, 2) for name, usd_name in MEASURE_PAIRS if name in measures}
+
+def read_currencies(fx, geography_file):
+    # Map geo_id -> currency code, from the currency column of the geography table
+    with open(geography_file, 'r') as geo_file:
+        return {int(row['geo_id']): fx.code(row['currency']) for row in csv.DictReader(geo_file)}
+
+def convert_fact(fact_file, geography_file, fx, output_file, chunk_rows=CHUNK_ROWS):
+    # Rewrite the fact table with the '_usd' measures computed from the local ones; return the rows written
+    currency_of_geo = read_currencies(fx, geography_file)
+    header, data_start = read_header(fact_file)
+    positions = {name: index for index, name in enumerate(header)}
+    geo_column, time_column = positions['geo_id'], positions['time_id']
+    row_count = 0
+    with open(output_file, 'w', newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow(header)
+        for rows, _ in iter_csv_batches(fact_file, data_start, chunk_rows):
+            batch_start = time.perf_counter()
+            currency_codes = np.array([currency_of_geo[int(row[geo_column])] for row in rows], dtype=np.int64)
+            time_ids = np.array([row[time_column] for row in rows], dtype=np.int64)
+            measures = {name: np.array([row[positions[name]] for row in rows], dtype=np.float64)
+                        for name, usd_name in MEASURE_PAIRS if name in positions and usd_name in positions}
+            converted = convert_measures(measures, fx.rates_for(currency_codes, time_ids))
+            for usd_name, values in converted.items():
+                column = positions[usd_name]
+                for row, value in zip(rows, values.tolist()):
+                    row[column] = value
+            metrics.observe('convert_batch_seconds', time.perf_counter() - batch_start)
+            writer.writerows(rows)
+            row_count += len(rows)
+    metrics.count('fact_rows_converted', row_count)
+    return row_count
+
+def benchmark(fx, total_rows, batch_rows=1000000, days=3000):
+    # Convert 'total_rows' synthetic rows in batches of 'batch_rows', with random currencies and days
+    generator = np.random.default_rng(0)
+    codes = np.arange(len(fx.currencies))
+    first_day = np.datetime64('2013-01-01')
+    elapsed = 0.0
+    converted = 0
+    while converted < total_rows:
+        size = min(batch_rows, total_rows - converted)
+        currency_codes = generator.choice(codes, size)
+        days_since = generator.integers(0, days, size).astype('timedelta64[D]')
+        time_ids = np.char.replace(np.datetime_as_string(first_day + days_since), '-', '').astype(np.int64)
+        measures = {name: generator.uniform(10, 2000, size).round(2) for name, _ in MEASURE_PAIRS}
+        start = time.perf_counter()
+        convert_measures(measures, fx.rates_for(currency_codes, time_ids))
+        elapsed += time.perf_counter() - start
+        converted += size
+    print(f"{converted:,} rows x {len(MEASURE_PAIRS)} measures converted in {elapsed:.2f} s "
+          f"({converted / elapsed:,.0f} rows/s); {len(fx.memo):,} distinct (currency, day) pairs resolved "
+          f"for {fx.lookups:,} rows")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compute the '_usd' measures of the fact table from dated exchange rates.")
+    parser.add_argument('--rates', default=FX_RATES_FILE, help='CSV file with the columns currency, date, usd_rate; use the fx_rates.csv of the '
+                             'output folder of generate_data.py when it was run with --output-dir '
+                             f'(default: {FX_RATES_FILE})')
+    parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the fact and geography tables')
+    parser.add_argument('--output', help='converted fact table (default: computer_sales.csv in the tables folder)')
+    parser.add_argument('--benchmark', type=int, metavar='ROWS', help='measure the conversion of ROWS synthetic rows instead')
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.enable_from_args(args, 'currency')
+
+    with metrics.span('read rates'):
+        fx = FxRates(args.rates)
+    if args.benchmark:
+        benchmark(fx, args.benchmark)
+    else:
+        fact_file = os.path.join(args.tables_dir, FACT_FILE)
+        output_file = args.output or fact_file
+        temporary_file = output_file + '.tmp'  # The fact table may be converted in place
+        start = time.perf_counter()
+        with metrics.span('convert'):
+            row_count = convert_fact(fact_file, os.path.join(args.tables_dir, GEOGRAPHY['file']), fx, temporary_file)
+        os.replace(temporary_file, output_file)
+        elapsed = time.perf_counter() - start
+        print(f"Converted {row_count} fact rows in {elapsed:.2f} s ({row_count / elapsed:,.0f} rows/s); "
+              f"{len(fx.memo)} distinct (currency, day) pairs resolved.")
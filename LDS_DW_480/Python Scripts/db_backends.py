@@ -0,0 +1,261 @@
+import sqlite3  # Import sqlite3 for the local backend
+
+from star_schema import FOREIGN_KEYS, TABLE_COLUMNS, create_table_query
+
+# Database backends used by the loaders. Each backend knows how to connect, how to check and create the
+# tables and how to insert a batch of rows with the fastest path of its database:
+# - SqlServerBackend: the course server through pyodbc, with fast_executemany and setinputsizes
+# - SQLiteBackend: a local SQLite file, with relaxed journaling and one transaction per table,
+#   so the load path can be tested and benchmarked on any machine
+# For the upsert mode (upsert.py) each backend also stages a batch in a temporary table and applies it to the
+# target table with one set-based statement: MERGE on SQL Server, INSERT ... ON CONFLICT on SQLite.
+
+class SqlServerBackend:
+    name = 'sqlserver'
+
+    def __init__(self, server='tcp:lds.di.unipi.it', database='Group_ID_480_DB', username='Group_ID_480',
+                 password='779ENI6E1'):
+        self.server = server
+        self.database = database
+        self.username = username
+        self.password = password
+
+    def describe(self):
+        return f"database '{self.database}' on server '{self.server}' with user '{self.username}'"
+
+    def connect(self):
+        import pyodbc  # Only needed for this backend
+        connectionString = (f'DRIVER={{SQL Server}};SERVER={self.server};DATABASE={self.database};'
+                            f'UID={self.username};PWD={self.password}')
+        return pyodbc.connect(connectionString)
+
+    def table_exists(self, cursor, table_name):
+        cursor.execute("SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = ?", table_name)
+        return cursor.fetchone() is not None
+
+    def create_table(self, cursor, table_name, foreign_keys=True):
+        query = create_table_query(table_name, foreign_keys)
+        cursor.execute(query)
+        return query
+
+    # Bulk reload: the foreign keys of the fact table are dropped and the tables truncated (minimally logged,
+    # unlike DELETE); non-clustered indexes are disabled during the inserts. At the end the foreign keys are
+    # added back WITH CHECK in a single statement, so SQL Server validates them with one set-based scan.
+
+    def drop_foreign_keys(self, cursor, table_name):
+        cursor.execute("SELECT name FROM sys.foreign_keys WHERE parent_object_id = OBJECT_ID(?)", table_name)
+        for (name,) in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE {table_name} DROP CONSTRAINT [{name}]")
+
+    def truncate_table(self, cursor, table_name):
+        cursor.execute(f"TRUNCATE TABLE {table_name}")
+
+    def disable_indexes(self, cursor, table_name):
+        # Disable the non-clustered indexes (the clustered primary key holds the data and stays enabled)
+        cursor.execute("SELECT name FROM sys.indexes WHERE object_id = OBJECT_ID(?) AND type_desc = 'NONCLUSTERED' "
+                       "AND is_disabled = 0", table_name)
+        indexes = [name for (name,) in cursor.fetchall()]
+        for name in indexes:
+            cursor.execute(f"ALTER INDEX [{name}] ON {table_name} DISABLE")
+        return indexes
+
+    def rebuild_indexes(self, cursor, table_name, indexes):
+        for name in indexes:
+            cursor.execute(f"ALTER INDEX [{name}] ON {table_name} REBUILD")
+
+    def add_foreign_keys(self, cursor, table_name):
+        constraints = [f"CONSTRAINT FK_{table_name}_{column} FOREIGN KEY ({column}) "
+                       f"REFERENCES {table}({TABLE_COLUMNS[table][0][0]})"
+                       for column, table in FOREIGN_KEYS.get(table_name, [])]
+        if constraints:
+            cursor.execute(f"ALTER TABLE {table_name} WITH CHECK ADD " + ", ".join(constraints))
+
+    def input_sizes(self, table_name, columns):
+        # pyodbc parameter types of the columns of a table
+        import pyodbc
+        sql_types = dict(TABLE_COLUMNS[table_name])
+        sizes = []
+        for column in columns:
+            sql_type = sql_types[column]
+            if sql_type == 'INT':
+                sizes.append((pyodbc.SQL_INTEGER, 0, 0))
+            elif sql_type == 'FLOAT':
+                sizes.append((pyodbc.SQL_DOUBLE, 0, 0))
+            else:
+                sizes.append((pyodbc.SQL_VARCHAR, int(sql_type[sql_type.index('(') + 1:-1]), 0))
+        return sizes
+
+    def prepare_insert(self, cursor, table_name, columns):
+        # Send the batches as arrays of parameters, with the parameter types declared once up front
+        cursor.fast_executemany = True
+        cursor.setinputsizes(self.input_sizes(table_name, columns))
+        return insert_query(table_name, columns)
+
+    # Upsert: the changed rows of a batch are bulk-inserted into a session temporary table and merged into the
+    # target table, and their hashes into the hash table, with one MERGE each. The statements take no
+    # parameters, so the input sizes declared for the staging inserts do not apply to them.
+
+    def create_staging(self, cursor, table_name, columns):
+        staging = f'#stage_{table_name}'
+        sql_types = dict(TABLE_COLUMNS[table_name])
+        cursor.execute(f"CREATE TABLE {staging} (" + ", ".join(f"{column} {sql_types[column]}" for column in columns)
+                       + ", row_hash CHAR(32))")
+        return staging
+
+    def prepare_staging_insert(self, cursor, table_name, staging, columns):
+        import pyodbc
+        cursor.fast_executemany = True
+        cursor.setinputsizes(self.input_sizes(table_name, columns) + [(pyodbc.SQL_CHAR, 32, 0)])
+        return insert_query(staging, columns + ['row_hash'])
+
+    def merge_staging(self, cursor, table_name, staging, columns, hash_table):
+        key = TABLE_COLUMNS[table_name][0][0]
+        updates = ", ".join(f"{column} = source.{column}" for column in columns if column != key)
+        cursor.execute(f"MERGE {table_name} WITH (HOLDLOCK) AS target USING {staging} AS source "
+                       f"ON target.{key} = source.{key} "
+                       f"WHEN MATCHED THEN UPDATE SET {updates} "
+                       f"WHEN NOT MATCHED BY TARGET THEN INSERT ({', '.join(columns)}) "
+                       f"VALUES ({', '.join('source.' + column for column in columns)});")
+        cursor.execute(f"MERGE {hash_table} WITH (HOLDLOCK) AS target "
+                       f"USING (SELECT '{table_name}' AS table_name, {key} AS row_id, row_hash FROM {staging}) AS source "
+                       f"ON target.table_name = source.table_name AND target.row_id = source.row_id "
+                       f"WHEN MATCHED THEN UPDATE SET row_hash = source.row_hash "
+                       f"WHEN NOT MATCHED BY TARGET THEN INSERT (table_name, row_id, row_hash) "
+                       f"VALUES (source.table_name, source.row_id, source.row_hash);")
+        cursor.execute(f"TRUNCATE TABLE {staging}")
+
+    def drop_staging(self, cursor, staging):
+        cursor.execute(f"DROP TABLE {staging}")
+
+    def insert_rows(self, cursor, query, rows):
+        cursor.executemany(query, rows)
+
+    def is_transient(self, error):
+        # Errors worth a retry: lost or refused connections (SQLSTATE 08xxx), timeouts (HYT00, HYT01)
+        # and deadlock victims (40001)
+        import pyodbc
+        if not isinstance(error, pyodbc.Error):
+            return False
+        sqlstate = str(error.args[0]) if error.args else ''
+        return sqlstate.startswith(('08', 'HYT')) or sqlstate == '40001'
+
+class SQLiteBackend:
+    name = 'sqlite'
+
+    def __init__(self, path='../Group_ID_480_DB.sqlite'):
+        self.path = path
+
+    def describe(self):
+        return f"SQLite database '{self.path}'"
+
+    def connect(self):
+        # Several connections may write to the same file: SQLite serialises them, waiting for the lock
+        cnxn = sqlite3.connect(self.path, timeout=600, check_same_thread=False)
+        # Relaxed journaling for bulk loads: the rollback journal is kept in memory and writes are not synced
+        cnxn.execute("PRAGMA journal_mode = MEMORY")
+        cnxn.execute("PRAGMA synchronous = OFF")
+        return cnxn
+
+    def table_exists(self, cursor, table_name):
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+        return cursor.fetchone() is not None
+
+    def create_table(self, cursor, table_name, foreign_keys=True):
+        # SQLite cannot add foreign keys to an existing table, so they are always declared; they are only
+        # enforced when 'PRAGMA foreign_keys' is ON, which is not the case on these connections
+        query = create_table_query(table_name)
+        cursor.execute(query)
+        return query
+
+    # Bulk reload: foreign keys are not enforced during the inserts and the indexes are dropped; at the end
+    # the indexes are created again and the foreign keys checked with a single PRAGMA foreign_key_check.
+
+    def drop_foreign_keys(self, cursor, table_name):
+        cursor.execute("PRAGMA foreign_keys = OFF")
+
+    def truncate_table(self, cursor, table_name):
+        # Without a WHERE clause SQLite empties the table in one step instead of deleting row by row
+        cursor.execute(f"DELETE FROM {table_name}")
+
+    def disable_indexes(self, cursor, table_name):
+        # Drop the explicit indexes, keeping their definitions (automatic primary key indexes have no SQL)
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                       (table_name,))
+        indexes = cursor.fetchall()
+        for name, _ in indexes:
+            cursor.execute(f'DROP INDEX "{name}"')
+        return indexes
+
+    def rebuild_indexes(self, cursor, table_name, indexes):
+        for _, sql in indexes:
+            cursor.execute(sql)
+
+    def add_foreign_keys(self, cursor, table_name):
+        cursor.execute(f"PRAGMA foreign_key_check({table_name})")
+        violations = cursor.fetchall()
+        if violations:
+            raise sqlite3.IntegrityError(f"{len(violations)} rows of '{table_name}' violate a foreign key, "
+                                         f"e.g. row {violations[0][1]} referencing '{violations[0][2]}'")
+
+    def prepare_insert(self, cursor, table_name, columns):
+        # sqlite3 prepares the statement once and reuses it for every row of executemany; the rows stay in the
+        # transaction opened by the first insert until the loader commits
+        return insert_query(table_name, columns)
+
+    def insert_rows(self, cursor, query, rows):
+        cursor.executemany(query, rows)
+
+    # Upsert: the staging table is a TEMP table of the connection, applied with INSERT ... ON CONFLICT DO
+    # UPDATE (SQLite 3.24 or later; 'WHERE true' is needed by the parser with INSERT ... SELECT).
+
+    def create_staging(self, cursor, table_name, columns):
+        staging = f'stage_{table_name}'
+        sql_types = dict(TABLE_COLUMNS[table_name])
+        cursor.execute(f"CREATE TEMP TABLE {staging} (" + ", ".join(f"{column} {sql_types[column]}" for column in columns)
+                       + ", row_hash CHAR(32))")
+        return staging
+
+    def prepare_staging_insert(self, cursor, table_name, staging, columns):
+        return insert_query(staging, columns + ['row_hash'])
+
+    def merge_staging(self, cursor, table_name, staging, columns, hash_table):
+        key = TABLE_COLUMNS[table_name][0][0]
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns if column != key)
+        cursor.execute(f"INSERT INTO {table_name} ({', '.join(columns)}) SELECT {', '.join(columns)} FROM {staging} "
+                       f"WHERE true ON CONFLICT ({key}) DO UPDATE SET {updates}")
+        cursor.execute(f"INSERT INTO {hash_table} (table_name, row_id, row_hash) "
+                       f"SELECT '{table_name}', {key}, row_hash FROM {staging} "
+                       f"WHERE true ON CONFLICT (table_name, row_id) DO UPDATE SET row_hash = excluded.row_hash")
+        cursor.execute(f"DELETE FROM {staging}")
+
+    def drop_staging(self, cursor, staging):
+        cursor.execute(f"DROP TABLE temp.{staging}")
+
+    def is_transient(self, error):
+        # Another connection holding the lock for longer than the timeout
+        return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+BACKENDS = {backend.name: backend for backend in (SqlServerBackend, SQLiteBackend)}
+
+def insert_query(table_name, columns):
+    # Build the parameterised INSERT statement of a table
+    placeholders = ", ".join(['?'] * len(columns))
+    return f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})"
+
+def add_backend_arguments(parser):
+    # Add the options selecting the database backend to a command line parser
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='sqlserver',
+                        help='database backend (default: the SQL Server of the course)')
+    parser.add_argument('--database', help='database name, or the file path for the sqlite backend')
+    parser.add_argument('--server', help='server address (sqlserver backend)')
+
+def backend_from_args(args):
+    # Build the backend selected on the command line
+    if args.backend == 'sqlite':
+        return SQLiteBackend(args.database) if args.database else SQLiteBackend()
+    options = {}
+    if args.database:
+        options['database'] = args.database
+    if args.server:
+        options['server'] = args.server
+    return SqlServerBackend(**options)
@@ -0,0 +1,281 @@
+import argparse  # Import argparse to read the command line options
+import csv  # Import the csv module for reading and writing CSV files
+import os  # Import os for path handling
+import resource  # Import resource to report the peak memory of the benchmark
+import shutil  # Import shutil to remove the scaled-up benchmark data
+import tempfile  # Import tempfile to write the scaled-up benchmark data in a scratch folder
+import time  # Import time to measure the throughput
+from operator import itemgetter  # Import itemgetter to pick the needed columns of the fact rows
+
+import numpy as np  # Import numpy for the vectorized joins and group-bys
+
+import metrics
+from csv_chunks import iter_csv_batches, read_header
+from star_schema import DIMENSIONS, FACT_FILE, FACT_TABLE, GEOGRAPHY, TABLES_DIR
+
+# In-process replacement of the data flow of the SSIS package (LDS_ETL_480, Package.dtsx). For every year
+# and region it keeps the sales with the highest 'CPU sales (USD)' and, for each of them, the share of its
+# 'Total sales (USD)' in the total of its CPU series in that year and region:
+# - Lookup CPU, Geography and Time info: hash joins on cpu_id, geo_id and time_id
+# - Find Max CPU Sales + Merge Join by CPU Sales: maximum per (Year, Region), keeping the rows that reach it
+# - Sum CPU Series sales + Merge Join by CPU Series: sum per (Year, Region, CPU series), broadcast back
+#   onto the kept rows
+# - Calculate Sales Percentage on CPU Series: ROUND(Total sales (USD) / Total sales CPU Series (USD) * 100, 2)
+# - Sort by Year, Region and Computer ID, then export
+# The fact table is read in chunks: only the group totals and the rows reaching the current maximum of
+# their group are kept, so memory does not grow with the number of sales.
+
+RESULTS_FILE = 'ETL process results group 480.csv'
+ERROR_FILE = 'Percentage calculation error.txt'
+SSIS_RESULTS = os.path.join('../../LDS_ETL_480/ETL Process Results', RESULTS_FILE)  # Output of the SSIS package
+
+RESULT_FIELDS = ['Year', 'Region', 'Currency', 'Computer ID', 'CPU series', 'CPU name', 'CPU sales',
+                 'CPU sales (USD)', 'Total sales', 'Total sales (USD)', 'Total sales CPU Series (USD)',
+                 'Sales Percentage on CPU Series']
+# Rows whose percentage cannot be computed: same columns, with the reason instead of the percentage
+ERROR_FIELDS = RESULT_FIELDS[:-1] + ['Error']
+
+CHUNK_ROWS = 4096  # Fact rows processed at a time (larger chunks of parsed rows only slow the garbage collector down)
+
+# Fact columns read by the engine, with their type
+FACT_COLUMNS = [('sale_id', np.int64), ('geo_id', np.int64), ('time_id', np.int64), ('cpu_id', np.int64),
+                ('cpu_sales', np.float64), ('cpu_sales_usd', np.float64),
+                ('total_sales', np.float64), ('total_sales_usd', np.float64)]
+
+class Lookup:
+    # Hash join with a dimension table: id -> row of the table, the copied columns kept as arrays
+    def __init__(self, name, table_file, id_column, columns):
+        self.name = name
+        self.id_column = id_column
+        with open(table_file, 'r') as dimension_file:
+            rows = [row for row in csv.DictReader(dimension_file)]
+        self.positions = {int(row[id_column]): index for index, row in enumerate(rows)}
+        self.columns = {column: np.array([row[column] for row in rows], dtype=object) for column in columns}
+
+    def match(self, ids):
+        # Return the row of the dimension of every id; the dictionary is probed once per distinct id
+        unique, inverse = np.unique(ids, return_inverse=True)
+        positions = np.array([self.positions.get(value, -1) for value in unique.tolist()], dtype=np.int64)
+        if (positions < 0).any():
+            # Like the SSIS lookups, a missing match stops the process
+            missing = unique[positions < 0]
+            raise ValueError(f"Lookup {self.name} info: no match for {len(missing)} {self.id_column} values, "
+                             f"e.g. {missing[0]}")
+        return positions[inverse]
+
+def encode(values):
+    # Dictionary-encode an array of strings: the codes follow the sort order of the strings
+    names, codes = np.unique(values.astype(str), return_inverse=True)
+    return names, codes.astype(np.int64)
+
+def csv_chunks(fact_file, chunk_rows=CHUNK_ROWS):
+    # Yield the needed fact columns as arrays, 'chunk_rows' rows at a time
+    header, data_start = read_header(fact_file)
+    get_columns = itemgetter(*[header.index(name) for name, _ in FACT_COLUMNS])
+    for rows, _ in iter_csv_batches(fact_file, data_start, chunk_rows):
+        columns = zip(*map(get_columns, rows))
+        yield {name: np.array(values, dtype=dtype) for (name, dtype), values in zip(FACT_COLUMNS, columns)}
+
+def columnar_chunks(tables_dir=TABLES_DIR, chunk_rows=CHUNK_ROWS):
+    # Yield the needed fact columns straight from the memory-mapped columnar copy written by columnar.py
+    from columnar import ColumnarTable, columnar_dir
+    table = ColumnarTable(os.path.join(columnar_dir(tables_dir), FACT_TABLE))
+    yield from table.iter_batches(chunk_rows, [name for name, _ in FACT_COLUMNS])
+
+def ssis_round(values, decimals=2):
+    # ROUND of the SSIS expression language: halves are rounded away from zero
+    scale = 10.0 ** decimals
+    return np.sign(values) * np.floor(np.abs(values) * scale + 0.5) / scale
+
+def format_float(value):
+    # Format a DT_R8 value like the SSIS flat file destination: 17 significant digits without trailing
+    # zeros, in scientific notation when more than 17 decimals would be needed (e.g. 2.9999999999999999E-2)
+    if value == 0:
+        return '0'
+    mantissa, exponent = f'{value:.16e}'.split('e')
+    exponent = int(exponent)
+    sign = '-' if mantissa.startswith('-') else ''
+    digits = mantissa.lstrip('-').replace('.', '').rstrip('0')
+    if exponent >= 17 or len(digits) - exponent - 1 > 17:
+        return f"{sign}{digits[0]}{'.' + digits[1:] if len(digits) > 1 else ''}E{exponent:+d}"
+    if exponent < 0:
+        return f"{sign}0.{'0' * (-exponent - 1)}{digits}"
+    integer = digits[:exponent + 1].ljust(exponent + 1, '0')
+    fraction = digits[exponent + 1:]
+    return sign + integer + ('.' + fraction if fraction else '')
+
+def run_engine(chunks, tables_dir=TABLES_DIR):
+    # Run the data flow over an iterable of fact chunks; return (result rows, error rows, fact rows read)
+    cpu = Lookup('CPU', os.path.join(tables_dir, DIMENSIONS['Cpu']['file']), 'cpu_id', ['cpu_series', 'cpu_name'])
+    geography = Lookup('Geography', os.path.join(tables_dir, GEOGRAPHY['file']), 'geo_id', ['region', 'currency'])
+    calendar = Lookup('Time', os.path.join(tables_dir, DIMENSIONS['Time']['file']), 'time_id', ['year'])
+
+    # Group keys are integers: year, region code and CPU series code packed together
+    regions, region_of_geo = encode(geography.columns['region'])
+    series, series_of_cpu = encode(cpu.columns['cpu_series'])
+    year_of_time = calendar.columns['year'].astype(np.int64)
+
+    series_totals = {}  # (year, region, series) key -> Total sales CPU Series (USD)
+    best = {}  # (year, region) key -> [maximum CPU sales (USD), list of chunks of the rows reaching it]
+    fact_rows = 0
+    for chunk in chunks:
+        chunk_start = time.perf_counter()
+        fact_rows += len(chunk['sale_id'])
+        geo_rows = geography.match(chunk['geo_id'])
+        cpu_rows = cpu.match(chunk['cpu_id'])
+        year = year_of_time[calendar.match(chunk['time_id'])]
+        group = year * len(regions) + region_of_geo[geo_rows]
+        series_group = group * len(series) + series_of_cpu[cpu_rows]
+        cpu_usd = np.asarray(chunk['cpu_sales_usd'], dtype=np.float64)
+
+        # Sum of the total sales per CPU series, added to the totals of the previous chunks
+        keys, inverse = np.unique(series_group, return_inverse=True)
+        sums = np.bincount(inverse, weights=chunk['total_sales_usd'])
+        for key, total in zip(keys.tolist(), sums.tolist()):
+            series_totals[key] = series_totals.get(key, 0.0) + total
+
+        # Maximum CPU sales per year and region; only the rows reaching the maximum of their group are kept
+        keys, inverse = np.unique(group, return_inverse=True)
+        maximum = np.full(len(keys), -np.inf)
+        np.maximum.at(maximum, inverse, cpu_usd)
+        kept = np.flatnonzero(cpu_usd == maximum[inverse])
+        kept = kept[np.argsort(inverse[kept], kind='stable')]
+        boundaries = np.cumsum(np.bincount(inverse[kept], minlength=len(keys)))[:-1]
+        for key, group_max, rows in zip(keys.tolist(), maximum.tolist(), np.split(kept, boundaries)):
+            piece = {'sale_id': chunk['sale_id'][rows], 'year': year[rows], 'geo_row': geo_rows[rows],
+                     'cpu_row': cpu_rows[rows], 'series_group': series_group[rows],
+                     'cpu_sales': chunk['cpu_sales'][rows], 'cpu_sales_usd': cpu_usd[rows],
+                     'total_sales': chunk['total_sales'][rows], 'total_sales_usd': chunk['total_sales_usd'][rows]}
+            current = best.get(key)
+            if current is None or group_max > current[0]:
+                best[key] = [group_max, [piece]]
+            elif group_max == current[0]:
+                current[1].append(piece)
+        metrics.observe('chunk_seconds', time.perf_counter() - chunk_start)
+
+    pieces = [piece for _, group_pieces in best.values() for piece in group_pieces]
+    if not pieces:
+        return [], [], fact_rows
+    kept = {name: np.concatenate([piece[name] for piece in pieces]) for name in pieces[0]}
+
+    # Broadcast the CPU series totals back onto the kept rows
+    total_keys = np.array(sorted(series_totals), dtype=np.int64)
+    total_values = np.array([series_totals[key] for key in total_keys.tolist()])
+    series_total = total_values[np.searchsorted(total_keys, kept['series_group'])]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentage = ssis_round(kept['total_sales_usd'] / series_total * 100)
+
+    # Sort by Year, Region and Computer ID (region codes follow the order of the names)
+    region_code = region_of_geo[kept['geo_row']]
+    order = np.lexsort((kept['sale_id'], region_code, kept['year']))
+    results, errors = [], []
+    for index in order.tolist():
+        geo_row, cpu_row = kept['geo_row'][index], kept['cpu_row'][index]
+        row = [int(kept['year'][index]), regions[region_code[index]], geography.columns['currency'][geo_row],
+               int(kept['sale_id'][index]), cpu.columns['cpu_series'][cpu_row], cpu.columns['cpu_name'][cpu_row],
+               format_float(kept['cpu_sales'][index]), format_float(kept['cpu_sales_usd'][index]),
+               format_float(kept['total_sales'][index]), format_float(kept['total_sales_usd'][index]),
+               format_float(series_total[index])]
+        if np.isfinite(percentage[index]):
+            results.append(row + [format_float(percentage[index])])
+        else:
+            # Error output of the derived column, with a readable reason instead of the SSIS error code
+            errors.append(row + ['division by zero: Total sales CPU Series (USD) is 0'])
+    return results, errors, fact_rows
+
+def write_results(results, errors, output_dir):
+    # Write the result file and the error file with the names used by the SSIS package
+    os.makedirs(output_dir, exist_ok=True)
+    for file_name, fields, rows in ((RESULTS_FILE, RESULT_FIELDS, results), (ERROR_FILE, ERROR_FIELDS, errors)):
+        with open(os.path.join(output_dir, file_name), 'w', newline='') as output_file:
+            writer = csv.writer(output_file, lineterminator='\n')
+            writer.writerow(fields)
+            writer.writerows(rows)
+
+def compare_results(results_file, expected_file):
+    # Compare two result files row by row. 'Total sales CPU Series (USD)' is a sum of floats whose last
+    # digits depend on the order of the additions, so it is compared with a relative tolerance.
+    with open(results_file, 'r') as results, open(expected_file, 'r') as expected:
+        ours, theirs = list(csv.reader(results)), list(csv.reader(expected))
+    if ours[0] != theirs[0] or len(ours) != len(theirs):
+        print(f"Different header or number of rows: {len(ours) - 1} vs {len(theirs) - 1}")
+        return False
+    total_column = RESULT_FIELDS.index('Total sales CPU Series (USD)')
+    differences = 0
+    for line, (row, other) in enumerate(zip(ours[1:], theirs[1:]), start=2):
+        same = all(value == other_value if column != total_column
+                   else np.isclose(float(value), float(other_value), rtol=1e-12, atol=0)
+                   for column, (value, other_value) in enumerate(zip(row, other)))
+        if not same:
+            differences += 1
+            if differences <= 5:
+                print(f"  line {line}: {row} != {other}")
+    print(f"{differences} rows differ out of {len(ours) - 1}.")
+    return differences == 0
+
+def scale_fact(fact_file, output_file, factor):
+    # Write the fact table 'factor' times, with new sale ids, to benchmark the engine on more data
+    with open(fact_file, 'r') as source:
+        reader = csv.reader(source)
+        header = next(reader)
+        rows = [row for row in reader if row]
+    sale_id = header.index('sale_id')
+    step = max(int(row[sale_id]) for row in rows) + 1
+    with open(output_file, 'w', newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow(header)
+        for copy in range(factor):
+            for row in rows:
+                row = list(row)
+                row[sale_id] = str(int(row[sale_id]) + copy * step)
+                writer.writerow(row)
+    return len(rows) * factor
+
+def benchmark(tables_dir, factor, chunk_rows):
+    # Time the engine on the fact table scaled up 'factor' times
+    scratch = tempfile.mkdtemp()
+    try:
+        fact_file = os.path.join(scratch, FACT_FILE)
+        row_count = scale_fact(os.path.join(tables_dir, FACT_FILE), fact_file, factor)
+        start = time.perf_counter()
+        results, errors, _ = run_engine(csv_chunks(fact_file, chunk_rows), tables_dir)
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(scratch)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Kilobytes on Linux
+    print(f"{row_count} fact rows (x{factor}) in {elapsed:.2f} s ({row_count / elapsed:,.0f} rows/s), "
+          f"{len(results)} result rows, {len(errors)} errors, peak memory {peak:,.0f} MB")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the data flow of the SSIS package in Python.')
+    parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the dimension and fact tables')
+    parser.add_argument('--output-dir', default=TABLES_DIR, help='folder where the result and error files are written')
+    parser.add_argument('--columnar', action='store_true', help='read the fact table from its columnar copy')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='fact rows processed at a time')
+    parser.add_argument('--compare', nargs='?', const=SSIS_RESULTS, metavar='FILE',
+                        help='compare the result file with another one (default: the output of the SSIS package)')
+    parser.add_argument('--benchmark', type=int, metavar='FACTOR',
+                        help='measure the throughput on the fact table scaled up FACTOR times instead')
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.enable_from_args(args, 'etl_engine')
+
+    if args.benchmark:
+        benchmark(args.tables_dir, args.benchmark, args.chunk_rows)
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)  # Before the data flow, not after it
+        start = time.perf_counter()
+        chunks = columnar_chunks(args.tables_dir, args.chunk_rows) if args.columnar else \
+            csv_chunks(os.path.join(args.tables_dir, FACT_FILE), args.chunk_rows)
+        with metrics.span('data flow'):
+            results, errors, fact_rows = run_engine(chunks, args.tables_dir)
+        with metrics.span('write results'):
+            write_results(results, errors, args.output_dir)
+        metrics.count('fact_rows_read', fact_rows)
+        metrics.count('result_rows', len(results))
+        metrics.count('error_rows', len(errors))
+        elapsed = time.perf_counter() - start
+        print(f"{len(results)} result rows and {len(errors)} errors from {fact_rows} fact rows "
+              f"in {elapsed:.2f} s ({fact_rows / elapsed:,.0f} rows/s).")
+        if args.compare:
+            compare_results(os.path.join(args.output_dir, RESULTS_FILE), args.compare)
@@ -0,0 +1,382 @@
+import argparse  # Import argparse to read the command line options
+import csv  # Import the csv module for reading and writing CSV files
+import filecmp  # Import filecmp to compare the outputs with the ones of the original scripts
+import io  # Import io to parse the chunks of the sales file from memory
+import locale  # Import locale to decode the chunks like open() does
+import multiprocessing  # Import multiprocessing to deduplicate chunks on several cores
+import os  # Import os for path handling
+import subprocess  # Import subprocess to run the original scripts in the benchmark
+import sys  # Import sys to find the current Python interpreter
+import tempfile  # Import tempfile to write the benchmark outputs in a scratch folder
+import time  # Import time to measure the wall-clock time
+from operator import itemgetter  # Import itemgetter to build the natural keys quickly
+
+import metrics
+from calendar_dim import calendar_range, write_calendar
+from compact_dedup import collect_keys_compact
+from csv_chunks import chunk_ranges
+from key_registry import KeyRegistry, load_watermark, save_watermark
+from sources import expand_sources, is_sharded, map_shards, source_header, source_rows
+from star_schema import (DIMENSIONS, GEOGRAPHY, GEOGRAPHY_FILE, REGISTRY_DIR, SALES_FILE, TABLES_DIR,
+                         country_currency_map, parse_time_code)
+
+# Single-pass extractor: reads 'computer_sales.csv' once and writes CPU.csv, GPU.csv, RAM.csv and Time.csv
+# in the same pass, plus geography.csv with its currency. The output is byte-identical to the one of
+# cpu.py, gpu.py, ram.py, time.py and geograpy.py. The sales can also be a glob pattern of (compressed)
+# shards, see sources.py.
+
+# Original scripts replaced by this extractor, used by the benchmark
+ORIGINAL_SCRIPTS = ['geograpy.py', 'time.py', 'cpu.py', 'gpu.py', 'ram.py']
+
+# Size of the chunks processed by each worker in the parallel mode
+CHUNK_SIZE = 16 * 1024 * 1024
+
+def read_geography(geography_file=GEOGRAPHY_FILE):
+    # Read the geography file and add the currency of each country (same logic as geograpy.py)
+    geography_data = {}
+    with open(geography_file, 'r') as geo_file:
+        for row in csv.DictReader(geo_file):
+            geography_data[int(row['geo_id'])] = {
+                'continent': row['continent'],
+                'country': row['country'],
+                'region': row['region'],
+                # If the country is not found, default to 'USD'
+                'currency': country_currency_map.get(row['country'], 'USD')
+            }
+    return geography_data
+
+def write_geography(geography_data, output_dir=TABLES_DIR):
+    # Write the geography table with its currency column
+    with open(os.path.join(output_dir, GEOGRAPHY['file']), 'w', newline='') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(GEOGRAPHY['fields'])
+        for geo_id, details in geography_data.items():
+            writer.writerow([geo_id, details['continent'], details['country'], details['region'], details['currency']])
+
+def key_getters(header):
+    # Build, for every dimension, a function extracting its natural key from a raw row.
+    # Duplicated header names resolve to the last column, like csv.DictReader does.
+    positions = {name: index for index, name in enumerate(header)}
+    return {name: itemgetter(*[positions[column] for column in spec['key']]) for name, spec in DIMENSIONS.items()}
+
+def iter_rows(reader, width, pad=None):
+    # Yield the raw rows, skipping empty lines and padding short rows like csv.DictReader does
+    for row in reader:
+        if len(row) != width:
+            if not row:
+                continue
+            if len(row) < width:
+                row = row + [pad] * (width - len(row))
+        yield row
+
+def collect_keys(reader, header):
+    # Collect the distinct natural keys of every dimension from the rows of a CSV reader.
+    # Each dimension keeps its keys in a dictionary used as an ordered set, so the first-seen order is preserved.
+    getters = key_getters(header)
+    seen = {name: {} for name in DIMENSIONS}
+
+    # Bind the lookups to local variables to keep the loop tight
+    get_cpu, get_gpu, get_ram, get_time = getters['Cpu'], getters['Gpu'], getters['Ram'], getters['Time']
+    add_cpu, add_gpu, add_ram, add_time = (seen[name].setdefault for name in ('Cpu', 'Gpu', 'Ram', 'Time'))
+
+    row_count = 0
+    for row in iter_rows(reader, len(header)):
+        add_cpu(get_cpu(row))
+        add_gpu(get_gpu(row))
+        add_ram(get_ram(row))
+        add_time(get_time(row))
+        row_count += 1
+    return seen, row_count
+
+def scan_sales(sales_file=SALES_FILE):
+    # Read the sales (every shard in order) once and collect the distinct natural keys of every dimension
+    paths = expand_sources(sales_file)
+    header = source_header(paths)
+    seen, row_count = collect_keys(source_rows(paths, header), header)
+    return {name: list(keys) for name, keys in seen.items()}, row_count
+
+def scan_sales_compact(sales_file=SALES_FILE, memory_budget=None, spill_dir=None):
+    # Collect the distinct keys with the low-memory key sets of compact_dedup, spilling to disk past the
+    # memory budget (bytes per dimension)
+    paths = expand_sources(sales_file)
+    header = source_header(paths)
+    widths = {name: len(spec['key']) for name, spec in DIMENSIONS.items()}
+    return collect_keys_compact(iter_rows(source_rows(paths, header), len(header)), key_getters(header), widths,
+                                memory_budget, spill_dir)
+
+def scan_chunk(task):
+    # Worker: collect the distinct keys of one byte range of the sales file
+    sales_file, header, begin, end = task
+    with open(sales_file, 'rb') as sales:
+        sales.seek(begin)
+        data = sales.read(end - begin)
+    # Decode like open(..., 'r') does in the sequential scan, with universal newlines
+    text = io.StringIO(data.decode(locale.getpreferredencoding(False)), newline=None)
+    seen, row_count = collect_keys(csv.reader(text), header)
+    return {name: list(keys) for name, keys in seen.items()}, row_count
+
+def scan_shard(task):
+    # Worker: collect the distinct keys of one shard
+    path, header = task
+    seen, row_count = collect_keys(source_rows([path], header), header)
+    return {name: list(keys) for name, keys in seen.items()}, row_count
+
+def merge_keys(results):
+    # Merge the keys of the chunks (or shards) in file order: a key seen first in an earlier chunk is also
+    # seen first in the whole file, so the merged order (and therefore every id) is the same as in the
+    # sequential scan
+    merged = {name: {} for name in DIMENSIONS}
+    row_count = 0
+    for keys, chunk_rows in results:
+        for name, chunk_keys in keys.items():
+            merged[name].update(dict.fromkeys(chunk_keys))  # Existing keys keep their position
+        row_count += chunk_rows
+    return {name: list(keys) for name, keys in merged.items()}, row_count
+
+def scan_sales_parallel(sales_file=SALES_FILE, workers=1, chunk_size=CHUNK_SIZE):
+    # Collect the distinct keys with a pool of processes: each worker deduplicates one shard or, for a
+    # single plain file, one chunk of it
+    if workers <= 1:
+        return scan_sales(sales_file)
+    paths = expand_sources(sales_file)
+    if is_sharded(paths):
+        header = source_header(paths)
+        return merge_keys(map_shards(scan_shard, [(path, header) for path in paths], workers))
+    with open(sales_file, 'r') as sales:
+        header = next(csv.reader(sales))
+    chunks = max(workers, -(-os.path.getsize(sales_file) // chunk_size))
+    tasks = [(sales_file, header, begin, end) for begin, end in chunk_ranges(sales_file, chunks)]
+    with multiprocessing.Pool(workers) as pool:
+        # imap returns the results in task order while the chunks are processed concurrently
+        return merge_keys(pool.imap(scan_chunk, tasks))
+
+def dimension_rows(name, keys):
+    # Turn the distinct keys of a dimension into output rows with their surrogate id
+    if name == 'Time':
+        # The time code is the id; empty time codes are skipped as in time.py
+        for time_code in keys:
+            if time_code:
+                components = parse_time_code(time_code)
+                yield [time_code] + [components[field] for field in DIMENSIONS['Time']['fields'][1:]]
+    else:
+        # Sequential ids in first-seen order, as in cpu.py, gpu.py and ram.py
+        for idx, key in enumerate(keys):
+            yield [idx, *key]
+
+def write_dimension(name, rows, output_dir=TABLES_DIR):
+    # Write the rows of a dimension to its CSV file
+    spec = DIMENSIONS[name]
+    with open(os.path.join(output_dir, spec['file']), 'w', newline='') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(spec['fields'])
+        writer.writerows(rows)
+
+def write_dimensions(rows_of, time_codes, output_dir=TABLES_DIR, calendar=False):
+    # Write every dimension table; with 'calendar' the Time table holds every day of the years of the sales
+    # instead of only the days found in them
+    for name in DIMENSIONS:
+        if name == 'Time' and calendar:
+            write_calendar(*calendar_range(time_codes), output_dir)
+        else:
+            write_dimension(name, rows_of(name), output_dir)
+
+def extract_dimensions(sales_file=SALES_FILE, geography_file=GEOGRAPHY_FILE, output_dir=TABLES_DIR, workers=1,
+                       calendar=False, compact=False, memory_budget=None, spill_dir=None):
+    # Build all the dimension tables, returning the number of sales rows read.
+    # With 'compact' the keys are deduplicated by the low-memory key sets (sequential scan only).
+    with metrics.span('geography'):
+        write_geography(read_geography(geography_file), output_dir)
+    with metrics.span('scan sales'):
+        if compact:
+            keys, row_count = scan_sales_compact(sales_file, memory_budget, spill_dir)
+        else:
+            keys, row_count = scan_sales_parallel(sales_file, workers)
+    metrics.count('sales_rows_read', row_count)
+    try:
+        with metrics.span('write tables'):
+            write_dimensions(lambda name: dimension_rows(name, keys[name]), keys['Time'], output_dir, calendar)
+    finally:
+        if compact:
+            for key_set in keys.values():
+                key_set.close()
+    return row_count
+
+def resume_offset(sales_file, watermark):
+    # Return the byte offset where the previous incremental run stopped, if the sales file is the same one
+    # and has only grown since then (new sales appended at the end); otherwise return 0
+    offset = watermark.get('offset', 0)
+    if not offset or watermark.get('source') != os.path.abspath(sales_file):
+        return 0
+    if os.path.getsize(sales_file) < offset:
+        return 0
+    with open(sales_file, 'rb') as sales:
+        sales.seek(offset - 1)
+        if sales.read(1) != b'\n':
+            return 0
+    return offset
+
+def registry_rows(name, registry):
+    # Turn the registered keys of a dimension into output rows, in id order
+    if name == 'Time':
+        for _, (time_code,) in registry.keys:
+            components = parse_time_code(time_code)
+            yield [time_code] + [components[field] for field in DIMENSIONS['Time']['fields'][1:]]
+    else:
+        for surrogate_id, key in registry.keys:
+            yield [surrogate_id, *key]
+
+def extract_incremental(sales_file=SALES_FILE, geography_file=GEOGRAPHY_FILE, output_dir=TABLES_DIR,
+                        registry_dir=REGISTRY_DIR, calendar=False):
+    # Incremental extraction: only the sales past the stored watermark are read, new natural keys get the
+    # next id in the key registry and existing keys keep theirs, so the fact table never needs renumbering.
+    # If the sales file grew since the last run, reading starts at the byte offset where that run stopped;
+    # otherwise (e.g. a new delivery) rows with a time code up to the stored one are skipped.
+    with metrics.span('open registry'):
+        registries = {name: KeyRegistry(os.path.join(registry_dir, name + '.keys')) for name in DIMENSIONS}
+    watermark = load_watermark(registry_dir)
+    last_time_code = watermark.get('time_code', '')
+
+    with metrics.span('scan sales'), open(sales_file, 'r') as sales:
+        # Sales appended while this run is reading will be read again by the next run, which is harmless
+        end_offset = os.fstat(sales.fileno()).st_size
+        reader = csv.reader(sales)
+        header = next(reader)
+        getters = key_getters(header)
+        get_time = getters['Time']
+        others = [(getters[name], registries[name].get_or_add) for name in ('Cpu', 'Gpu', 'Ram')]
+        add_time = registries['Time'].get_or_add
+
+        offset = resume_offset(sales_file, watermark)
+        if offset:
+            sales.seek(offset)
+            skip_until = ''  # Everything past the offset is new
+        else:
+            skip_until = last_time_code
+
+        row_count = 0
+        max_time_code = last_time_code
+        for row in iter_rows(reader, len(header), pad=''):
+            time_code = get_time(row)
+            if time_code and time_code <= skip_until:
+                continue
+            for get_key, add_key in others:
+                add_key(get_key(row))
+            if time_code:
+                add_time((time_code,), int(time_code))
+                if time_code > max_time_code:
+                    max_time_code = time_code
+            row_count += 1
+
+    metrics.count('sales_rows_read', row_count)
+
+    # Make the new keys durable before moving the watermark
+    with metrics.span('commit keys'):
+        added = {name: registry.commit() for name, registry in registries.items()}
+    for name, count in added.items():
+        metrics.count('new_keys', count, name)
+    with metrics.span('write tables'):
+        write_geography(read_geography(geography_file), output_dir)
+        write_dimensions(lambda name: registry_rows(name, registries[name]),
+                         [time_code for _, (time_code,) in registries['Time'].keys], output_dir, calendar)
+    save_watermark(registry_dir, {'source': os.path.abspath(sales_file), 'offset': end_offset,
+                                  'time_code': max_time_code})
+    return row_count, added
+
+def run_original_scripts():
+    # Run the original scripts one after the other, as in the manual build, and return the elapsed time
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    for script in ORIGINAL_SCRIPTS:
+        subprocess.run([sys.executable, script], cwd=script_dir, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def compare(sales_file, geography_file):
+    # Benchmark the single pass against the original scripts and check that the outputs are identical.
+    # The original scripts always read and write the default paths, so the comparison uses those files.
+    print("Running the original scripts...")
+    original_time = run_original_scripts()
+
+    print("Running the single-pass extractor...")
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        row_count = extract_dimensions(sales_file, geography_file, output_dir)
+        single_time = time.perf_counter() - start
+
+        files = [GEOGRAPHY['file']] + [spec['file'] for spec in DIMENSIONS.values()]
+        _, mismatch, errors = filecmp.cmpfiles(output_dir, TABLES_DIR, files, shallow=False)
+
+    print(f"Sales rows: {row_count}")
+    print(f"Original scripts:      {original_time:.2f} s ({row_count / original_time:,.0f} rows/s)")
+    print(f"Single-pass extractor: {single_time:.2f} s ({row_count / single_time:,.0f} rows/s)")
+    print(f"Speed-up: {original_time / single_time:.2f}x")
+    if mismatch or errors:
+        print(f"Outputs differ from the original scripts: {mismatch + errors}")
+        return False
+    print("Outputs are byte-identical to the original scripts.")
+    return True
+
+def benchmark_workers(sales_file, max_workers):
+    # Time the key collection with 1, 2, 4, ... up to max_workers processes and check the keys never change
+    counts = sorted({1, max_workers} | {2 ** power for power in range(max_workers.bit_length()) if 2 ** power <= max_workers})
+    reference = None
+    print(f"{'workers':>7} {'seconds':>8} {'rows/s':>12} {'speed-up':>8}")
+    for workers in counts:
+        start = time.perf_counter()
+        keys, row_count = scan_sales_parallel(sales_file, workers)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = (keys, elapsed)
+        elif keys != reference[0]:
+            print(f"Keys collected with {workers} workers differ from the sequential scan")
+            return False
+        print(f"{workers:>7} {elapsed:>8.2f} {row_count / elapsed:>12,.0f} {reference[1] / elapsed:>7.2f}x")
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract all the dimension tables with a single pass over the sales file.')
+    parser.add_argument('--sales', default=SALES_FILE,
+                        help="sales CSV file, or a quoted glob of shards, plain or .gz/.bz2/.xz (e.g. 'sales_*.csv.gz')")
+    parser.add_argument('--geography', default=GEOGRAPHY_FILE, help='geography CSV file')
+    parser.add_argument('--output-dir', default=TABLES_DIR, help='folder where the tables are written')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only read the sales past the stored watermark and keep the ids of the key registry')
+    parser.add_argument('--registry-dir', default=REGISTRY_DIR, help='folder of the key registry (with --incremental)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes deduplicating the sales file (or its shards)')
+    parser.add_argument('--calendar', action='store_true',
+                        help='write every day of the years of the sales to Time.csv, not only the days with sales')
+    parser.add_argument('--compact', action='store_true',
+                        help='deduplicate the keys with compact hash tables instead of Python sets (less memory)')
+    parser.add_argument('--memory-mb', type=float,
+                        help='memory for the keys of each dimension; past it new keys spill to disk (implies --compact)')
+    parser.add_argument('--spill-dir', help='folder of the spill files (default: the temporary folder)')
+    parser.add_argument('--benchmark-workers', action='store_true',
+                        help='measure the scaling from 1 to --workers processes')
+    parser.add_argument('--compare', action='store_true',
+                        help='benchmark against the original scripts and check the outputs are identical')
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.enable_from_args(args, 'extract_dimensions')
+    if args.memory_mb is not None:
+        args.compact = True
+    if args.compact and (args.workers > 1 or args.incremental):
+        parser.error('--compact and --memory-mb work on a full sequential scan (no --workers or --incremental)')
+    if args.incremental and is_sharded(expand_sources(args.sales)):
+        parser.error('--incremental resumes at a byte offset of a single plain sales file')
+
+    if args.compare:
+        sys.exit(0 if compare(args.sales, args.geography) else 1)
+    if args.benchmark_workers:
+        sys.exit(0 if benchmark_workers(args.sales, args.workers) else 1)
+
+    start = time.perf_counter()
+    if args.incremental:
+        row_count, added = extract_incremental(args.sales, args.geography, args.output_dir, args.registry_dir,
+                                                 args.calendar)
+        print('New keys: ' + ', '.join(f'{name} {count}' for name, count in added.items()))
+    else:
+        row_count = extract_dimensions(args.sales, args.geography, args.output_dir, args.workers, args.calendar,
+                                       args.compact, int(args.memory_mb * 1024 * 1024) if args.memory_mb else None,
+                                       args.spill_dir)
+    elapsed = time.perf_counter() - start
+    print(f"Dimension tables created from {row_count} sales rows in {elapsed:.2f} s ({row_count / elapsed:,.0f} rows/s).")
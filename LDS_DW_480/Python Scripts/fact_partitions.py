@@ -0,0 +1,450 @@
+import argparse  # Import argparse to read the command line options
+import csv  # Import the csv module for the partition and aggregate files
+import hashlib  # Import hashlib for the checksums of the partitions
+import json  # Import json to store the manifest
+import os  # Import os for path handling
+import shutil  # Import shutil to drop the aggregates on a rebuild
+import time  # Import time to measure the loads and the refreshes
+
+import numpy as np  # Import numpy to join and group whole batches at once
+
+import metrics
+from csv_chunks import iter_csv_batches, iter_csv_range, read_header
+from olap_cube import ATTRIBUTES, MDX_QUERIES, MEASURES, Cube, group, print_rows, read_table, typed
+from star_schema import FACT_FIELDS, FACT_FILE, TABLE_COLUMNS, TABLES_DIR
+
+# Partitioned fact table with an incremental aggregate store. The fact rows are split into one CSV file per
+# year or per month (by time_id), and a manifest records, for every partition, its size in bytes and how
+# many of those bytes are already summed into its aggregate. New sales are appended at the end of their
+# partitions, so the rows not yet aggregated are always a byte range at the end of each partition file:
+# a refresh reads only those ranges, adds their sums to the aggregates of the touched partitions and to the
+# totals, and leaves the other partitions alone. Appending a day of sales costs time proportional to the
+# day, not to the history. The aggregates are the base cuboid of the cube (every attribute of ATTRIBUTES,
+# keyed by member value so new dimension members do not change the existing keys), and the totals can be
+# loaded as a Cube to answer the MDX queries without reading the fact table.
+#
+# Aggregate files are versioned by load: a refresh writes new files and then replaces the manifest, which is
+# the only file pointing to them, so an interrupted refresh leaves the previous consistent state. A single
+# partition can be replaced (e.g. a reprocessed month) the same way: its new rows are written to a new
+# version of the partition file and the manifest switches to it in one step.
+#
+# The manifest also keeps, for every partition, its row count, its smallest and largest sale_id and a
+# SHA-256 checksum of its committed bytes, so partition_load.py can load the partitions in parallel and
+# skip the ones already loaded with the same content.
+
+PARTITIONS_DIR = os.path.join(TABLES_DIR, 'partitions')
+MANIFEST_FILE = 'manifest.json'
+AGGREGATES_DIR = 'aggregates'
+GRANULARITIES = {'year': 10000, 'month': 100}  # time_id // divisor is the partition key
+CHUNK_ROWS = 4096  # Fact rows read at a time
+COUNT_FIELD = 'sales_count'
+AGGREGATE_FIELDS = list(ATTRIBUTES) + list(MEASURES.values()) + [COUNT_FIELD]
+
+def partition_file(name):
+    return f'computer_sales_{name}.csv'
+
+def load_manifest(partitions_dir):
+    path = os.path.join(partitions_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+def save_manifest(partitions_dir, manifest):
+    # Write the manifest atomically: it commits the partition sizes and the aggregate files of a load
+    path = os.path.join(partitions_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+    os.replace(path + '.tmp', path)
+
+def file_checksum(path, size):
+    # SHA-256 of the first 'size' bytes of a file (the committed part of a partition)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        while size > 0:
+            block = source.read(min(size, 1024 * 1024))
+            if not block:
+                break
+            digest.update(block)
+            size -= len(block)
+    return digest.hexdigest()
+
+def partition_range(name, granularity):
+    # First and last time_id a partition can hold
+    divisor = GRANULARITIES[granularity]
+    return int(name) * divisor, int(name) * divisor + divisor - 1
+
+def new_manifest(granularity):
+    return {
+        'granularity': granularity,
+        # name -> {'file', 'rows', 'bytes', 'aggregated' (bytes summed), 'aggregate' (file),
+        #          'min_sale_id', 'max_sale_id', 'checksum' (SHA-256 of the committed bytes)}
+        'partitions': {},
+        'totals': None,  # Aggregate file with the totals of every partition
+        'loads': 0,
+        'last_load': None  # {'id', 'source', 'rows', 'touched': partitions written by the load}
+    }
+
+def write_partitions(fact_file, partitions_dir, manifest):
+    # Append the rows of a fact file to their partitions, creating the partitions not seen before.
+    # Returns the number of rows appended to each partition.
+    header, data_start = read_header(fact_file)
+    if header != FACT_FIELDS:
+        raise ValueError(f'{fact_file}: unexpected columns {header}')
+    time_column = header.index('time_id')
+    sale_column = header.index('sale_id')
+    divisor = GRANULARITIES[manifest['granularity']]
+    outputs, written, sale_ids = {}, {}, {}
+    try:
+        for rows, _ in iter_csv_batches(fact_file, data_start, CHUNK_ROWS):
+            keys = np.array([row[time_column] for row in rows], dtype=np.int64) // divisor
+            for key in np.unique(keys).tolist():
+                name = str(key)
+                if name not in outputs:
+                    entry = manifest['partitions'].get(name)
+                    path = os.path.join(partitions_dir, entry['file'] if entry else partition_file(name))
+                    if entry is None:
+                        outputs[name] = open(path, 'w', newline='')
+                        csv.writer(outputs[name]).writerow(FACT_FIELDS)
+                    else:
+                        # Drop what an interrupted load may have written after the committed size
+                        os.truncate(path, entry['bytes'])
+                        outputs[name] = open(path, 'a', newline='')
+                    written[name] = 0
+                selected = np.flatnonzero(keys == key).tolist()
+                csv.writer(outputs[name]).writerows(rows[index] for index in selected)
+                written[name] += len(selected)
+                ids = [int(rows[index][sale_column]) for index in selected]
+                low, high = sale_ids.get(name, (min(ids), max(ids)))
+                sale_ids[name] = (min(low, min(ids)), max(high, max(ids)))
+    finally:
+        for output in outputs.values():
+            output.close()
+    for name, count in written.items():
+        entry = manifest['partitions'].setdefault(name, {'file': partition_file(name), 'rows': 0, 'bytes': 0,
+                                                         'aggregated': None, 'aggregate': None})
+        path = os.path.join(partitions_dir, entry['file'])
+        if entry['aggregated'] is None:
+            entry['aggregated'] = read_header(path)[1]  # Nothing summed yet: the range starts after the header
+        entry['rows'] += count
+        entry['bytes'] = os.path.getsize(path)
+        low, high = sale_ids[name]
+        entry['min_sale_id'] = low if entry.get('min_sale_id') is None else min(entry['min_sale_id'], low)
+        entry['max_sale_id'] = high if entry.get('max_sale_id') is None else max(entry['max_sale_id'], high)
+        entry['checksum'] = file_checksum(path, entry['bytes'])
+    return written
+
+def partition_stats(path, begin, end):
+    # Rows and smallest and largest sale_id of a byte range of a partition file
+    rows, low, high = 0, None, None
+    sale_column = read_header(path)[0].index('sale_id')
+    for row in iter_csv_range(path, begin, end):
+        sale_id = int(row[sale_column])
+        low = sale_id if low is None else min(low, sale_id)
+        high = sale_id if high is None else max(high, sale_id)
+        rows += 1
+    return rows, low, high
+
+def ensure_partition_stats(partitions_dir, manifest):
+    # Add the sale_id range and the checksum to the partitions of a manifest written before they existed
+    missing = [entry for entry in manifest['partitions'].values() if entry.get('checksum') is None]
+    for entry in missing:
+        path = os.path.join(partitions_dir, entry['file'])
+        _, entry['min_sale_id'], entry['max_sale_id'] = partition_stats(path, read_header(path)[1], entry['bytes'])
+        entry['checksum'] = file_checksum(path, entry['bytes'])
+    if missing:
+        save_manifest(partitions_dir, manifest)
+    return manifest
+
+def replace_partition(fact_file, name, partitions_dir=PARTITIONS_DIR):
+    # Replace the content of one partition with the rows of a fact file (which must all belong to it).
+    # The rows go to a new version of the partition file, the totals are rebuilt from the aggregates of
+    # the other partitions, and the manifest switches to both at once; the partition aggregate is then
+    # recomputed by the next refresh. Returns the manifest.
+    manifest = load_manifest(partitions_dir)
+    if manifest is None:
+        raise FileNotFoundError(f'No partition manifest in {partitions_dir}')
+    header, data_start = read_header(fact_file)
+    if header != FACT_FIELDS:
+        raise ValueError(f'{fact_file}: unexpected columns {header}')
+    first_time_id, last_time_id = partition_range(name, manifest['granularity'])
+    time_column, sale_column = header.index('time_id'), header.index('sale_id')
+    version = manifest['loads'] + 1
+    file_name = f'computer_sales_{name}_{version}.csv'
+    path = os.path.join(partitions_dir, file_name)
+    rows, low, high = 0, None, None
+    with open(path, 'w', newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow(FACT_FIELDS)
+        for batch, _ in iter_csv_batches(fact_file, data_start, CHUNK_ROWS):
+            for row in batch:
+                if not first_time_id <= int(row[time_column]) <= last_time_id:
+                    output.close()
+                    os.remove(path)
+                    raise ValueError(f"{fact_file}: time_id {row[time_column]} is not in partition {name}")
+                sale_id = int(row[sale_column])
+                low = sale_id if low is None else min(low, sale_id)
+                high = sale_id if high is None else max(high, sale_id)
+            writer.writerows(batch)
+            rows += len(batch)
+
+    # Totals without the replaced partition, from the aggregates of the others (nothing is subtracted)
+    aggregates_dir = os.path.join(partitions_dir, AGGREGATES_DIR)
+    old = manifest['partitions'].get(name)
+    replaced = [old['file']] if old else []
+    if manifest['totals']:
+        totals = {}
+        for other, entry in manifest['partitions'].items():
+            if other != name and entry['aggregate']:
+                merge(totals, read_aggregate(os.path.join(aggregates_dir, entry['aggregate'])))
+        totals_file = f'totals_{version}.csv'
+        write_aggregate(os.path.join(aggregates_dir, totals_file), totals)
+        replaced.append(os.path.join(AGGREGATES_DIR, manifest['totals']))
+        manifest['totals'] = totals_file
+    if old and old['aggregate']:
+        replaced.append(os.path.join(AGGREGATES_DIR, old['aggregate']))
+    manifest['partitions'][name] = {'file': file_name, 'rows': rows, 'bytes': os.path.getsize(path),
+                                    'aggregated': read_header(path)[1], 'aggregate': None,
+                                    'min_sale_id': low, 'max_sale_id': high,
+                                    'checksum': file_checksum(path, os.path.getsize(path))}
+    manifest['loads'] = version
+    manifest['last_load'] = {'id': version, 'source': os.path.abspath(fact_file), 'rows': rows, 'touched': [name],
+                             'replaced': True}
+    save_manifest(partitions_dir, manifest)
+    metrics.count('fact_rows_loaded', rows)
+    # The previous versions are no longer referenced
+    for file_name in replaced:
+        os.remove(os.path.join(partitions_dir, file_name))
+    return manifest
+
+def load_fact(fact_file, partitions_dir=PARTITIONS_DIR, granularity=None, rebuild=False):
+    # Add a fact file to the partitioned table (replacing its whole content if 'rebuild') and record the
+    # partitions touched by the load in the manifest. Returns the manifest.
+    os.makedirs(partitions_dir, exist_ok=True)
+    manifest = None if rebuild else load_manifest(partitions_dir)
+    if manifest is None:
+        # Start over: the old partitions and aggregates are dropped
+        shutil.rmtree(os.path.join(partitions_dir, AGGREGATES_DIR), ignore_errors=True)
+        for file_name in os.listdir(partitions_dir):
+            if file_name.startswith('computer_sales_'):
+                os.remove(os.path.join(partitions_dir, file_name))
+        manifest = new_manifest(granularity or 'month')
+    elif granularity and granularity != manifest['granularity']:
+        raise ValueError(f"The partitions are by {manifest['granularity']}; use --rebuild to change it")
+    with metrics.span('write partitions'):
+        written = write_partitions(fact_file, partitions_dir, manifest)
+    metrics.count('fact_rows_loaded', sum(written.values()))
+    manifest['loads'] += 1
+    manifest['last_load'] = {'id': manifest['loads'], 'source': os.path.abspath(fact_file),
+                             'rows': sum(written.values()), 'touched': sorted(written)}
+    save_manifest(partitions_dir, manifest)
+    return manifest
+
+class DimensionJoin:
+    # Joins batches of fact rows to the attribute members of the cube through the foreign keys
+    def __init__(self, tables_dir=TABLES_DIR):
+        self.keys = {}  # Foreign key -> (sorted ids, position of each sorted id in the dimension table)
+        self.codes = {}  # Attribute -> code of every dimension row
+        self.members = {}  # Attribute -> members (as strings), the code is the position
+        tables = {}
+        for name, (table_name, column, foreign_key) in ATTRIBUTES.items():
+            if table_name not in tables:
+                tables[table_name] = read_table(tables_dir, table_name)
+            rows = tables[table_name]
+            if foreign_key not in self.keys:
+                id_column = TABLE_COLUMNS[table_name][0][0]
+                ids = np.array([int(row[id_column]) for row in rows], dtype=np.int64)
+                order = np.argsort(ids)
+                self.keys[foreign_key] = (ids[order], order)
+            self.members[name], self.codes[name] = np.unique(np.array([row[column] for row in rows]),
+                                                             return_inverse=True)
+
+    def aggregate(self, rows, header, store):
+        # Group a batch of fact rows by every attribute and add the sums to the store (member values -> sums)
+        positions = {name: index for index, name in enumerate(header)}
+        columns = list(zip(*rows))
+        dimension_rows = {}
+        for foreign_key, (ids, order) in self.keys.items():
+            values = np.array(columns[positions[foreign_key]], dtype=np.int64)
+            found = np.searchsorted(ids, values)
+            if np.any(found >= len(ids)) or np.any(ids[np.minimum(found, len(ids) - 1)] != values):
+                raise ValueError(f'{foreign_key} without a row in its dimension table')
+            dimension_rows[foreign_key] = order[found]
+        codes = [self.codes[name][dimension_rows[foreign_key]] for name, (_, _, foreign_key) in ATTRIBUTES.items()]
+        measures = {column: np.array(columns[positions[column]], dtype=np.float64) for column in MEASURES.values()}
+        group_codes, sums, counts = group(codes, [len(self.members[name]) for name in ATTRIBUTES], measures, None)
+        member_columns = [self.members[name][column].tolist() for name, column in zip(ATTRIBUTES, group_codes)]
+        sum_columns = [sums[column].tolist() for column in MEASURES.values()] + [counts.tolist()]
+        for key, values in zip(zip(*member_columns), zip(*sum_columns)):
+            add_group(store, key, values)
+
+def add_group(store, key, values):
+    current = store.get(key)
+    store[key] = list(values) if current is None else [total + value for total, value in zip(current, values)]
+
+def merge(store, other):
+    for key, values in other.items():
+        add_group(store, key, values)
+
+def read_aggregate(path):
+    store = {}
+    with open(path, 'r') as aggregate_file:
+        reader = csv.reader(aggregate_file)
+        next(reader)
+        attributes = len(ATTRIBUTES)
+        for row in reader:
+            store[tuple(row[:attributes])] = [float(value) for value in row[attributes:-1]] + [int(row[-1])]
+    return store
+
+def write_aggregate(path, store):
+    with open(path, 'w', newline='') as aggregate_file:
+        writer = csv.writer(aggregate_file)
+        writer.writerow(AGGREGATE_FIELDS)
+        writer.writerows(list(key) + values for key, values in sorted(store.items()))
+
+def aggregate_range(path, begin, end, join):
+    # Sums of the fact rows in a byte range of a partition file
+    header, _ = read_header(path)
+    store, batch = {}, []
+    for row in iter_csv_range(path, begin, end):
+        batch.append(row)
+        if len(batch) == CHUNK_ROWS:
+            join.aggregate(batch, header, store)
+            batch = []
+    if batch:
+        join.aggregate(batch, header, store)
+    return store
+
+def refresh_aggregates(partitions_dir=PARTITIONS_DIR, tables_dir=TABLES_DIR):
+    # Sum the rows appended since the last refresh into their partition aggregates and into the totals.
+    # Returns (partitions refreshed, rows read).
+    manifest = load_manifest(partitions_dir)
+    if manifest is None:
+        raise FileNotFoundError(f'No partition manifest in {partitions_dir}')
+    stale = sorted(name for name, entry in manifest['partitions'].items() if entry['aggregated'] < entry['bytes'])
+    if not stale:
+        return [], 0
+    aggregates_dir = os.path.join(partitions_dir, AGGREGATES_DIR)
+    os.makedirs(aggregates_dir, exist_ok=True)
+    version = manifest['loads']
+    join = DimensionJoin(tables_dir)
+    totals = read_aggregate(os.path.join(aggregates_dir, manifest['totals'])) if manifest['totals'] else {}
+    replaced, rows_read = [], 0
+    for name in stale:
+        entry = manifest['partitions'][name]
+        partition_start = time.perf_counter()
+        delta = aggregate_range(os.path.join(partitions_dir, entry['file']), entry['aggregated'], entry['bytes'], join)
+        metrics.observe('partition_refresh_seconds', time.perf_counter() - partition_start)
+        rows_read += sum(values[-1] for values in delta.values())
+        store = read_aggregate(os.path.join(aggregates_dir, entry['aggregate'])) if entry['aggregate'] else {}
+        merge(store, delta)
+        merge(totals, delta)
+        file_name = f'{name}_{version}.csv'
+        write_aggregate(os.path.join(aggregates_dir, file_name), store)
+        if entry['aggregate'] and entry['aggregate'] != file_name:
+            replaced.append(entry['aggregate'])
+        entry['aggregate'], entry['aggregated'] = file_name, entry['bytes']
+    file_name = f'totals_{version}.csv'
+    write_aggregate(os.path.join(aggregates_dir, file_name), totals)
+    if manifest['totals'] and manifest['totals'] != file_name:
+        replaced.append(manifest['totals'])
+    manifest['totals'] = file_name
+    save_manifest(partitions_dir, manifest)
+    metrics.count('partitions_refreshed', len(stale))
+    metrics.count('fact_rows_aggregated', rows_read)
+    # The previous versions are no longer referenced
+    for file_name in replaced:
+        os.remove(os.path.join(aggregates_dir, file_name))
+    return stale, rows_read
+
+def load_totals(partitions_dir=PARTITIONS_DIR):
+    manifest = load_manifest(partitions_dir)
+    if manifest is None or manifest['totals'] is None:
+        raise FileNotFoundError(f'No aggregates in {partitions_dir}; run a refresh first')
+    return read_aggregate(os.path.join(partitions_dir, AGGREGATES_DIR, manifest['totals']))
+
+def cube_from_totals(totals, tables_dir=TABLES_DIR):
+    # Cube whose fact rows are the groups of the totals, each one weighted by its number of sales
+    keys = list(totals)
+    values = np.array([totals[key] for key in keys], dtype=np.float64)
+    fact_codes, members, tables = {}, {}, {}
+    for position, (name, (table_name, column, _)) in enumerate(ATTRIBUTES.items()):
+        if table_name not in tables:
+            tables[table_name] = read_table(tables_dir, table_name)
+        group_members = np.array(typed(table_name, column, [key[position] for key in keys]))
+        table_members = np.array(typed(table_name, column, [row[column] for row in tables[table_name]]))
+        members[name] = np.unique(np.concatenate([table_members, group_members]))
+        fact_codes[name] = np.searchsorted(members[name], group_members).astype(np.int32)
+    measures = {name: values[:, index] for index, name in enumerate(MEASURES)}
+    return Cube(fact_codes, measures, members, fact_counts=values[:, -1].astype(np.int64))
+
+def check_totals(partitions_dir=PARTITIONS_DIR, tables_dir=TABLES_DIR, fact_file=None):
+    # Compare the incremental totals with the sums of a full scan of the partitions (or of a fact file)
+    join = DimensionJoin(tables_dir)
+    expected = {}
+    if fact_file:
+        merge(expected, aggregate_range(fact_file, read_header(fact_file)[1], os.path.getsize(fact_file), join))
+    else:
+        for entry in load_manifest(partitions_dir)['partitions'].values():
+            path = os.path.join(partitions_dir, entry['file'])
+            merge(expected, aggregate_range(path, read_header(path)[1], entry['bytes'], join))
+    totals = load_totals(partitions_dir)
+    if set(totals) != set(expected):
+        return f'{len(set(totals) ^ set(expected))} groups differ'
+    for key, values in expected.items():
+        if not np.allclose(totals[key], values, rtol=1e-9):
+            return f'{key}: {totals[key]} != {values}'
+    return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Partition the fact table by time and keep its aggregates up to date.')
+    parser.add_argument('--partitions-dir', default=PARTITIONS_DIR, help='folder of the partitions and the manifest')
+    parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the dimension tables')
+    parser.add_argument('--rebuild', nargs='?', const=os.path.join(TABLES_DIR, FACT_FILE), metavar='FACT_FILE',
+                        help='replace the partitions with the rows of a fact table (default: computer_sales.csv)')
+    parser.add_argument('--append', metavar='FACT_FILE', help='append the rows of a fact file (e.g. a new day of sales)')
+    parser.add_argument('--replace', nargs=2, metavar=('PARTITION', 'FACT_FILE'),
+                        help='replace one partition (e.g. 201403) with the rows of a fact file')
+    parser.add_argument('--granularity', choices=sorted(GRANULARITIES), help='partition by year or by month (rebuild only)')
+    parser.add_argument('--no-refresh', action='store_true', help='do not refresh the aggregates after the load')
+    parser.add_argument('--check', nargs='?', const='', metavar='FACT_FILE',
+                        help='compare the totals with a full scan of the partitions (or of a fact file)')
+    parser.add_argument('--queries', action='store_true', help='answer the MDX queries of the cube from the totals')
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.enable_from_args(args, 'fact_partitions')
+
+    for fact_file, rebuild in ((args.rebuild, True), (args.append, False)):
+        if fact_file:
+            start = time.perf_counter()
+            with metrics.span('rebuild' if rebuild else 'append'):
+                manifest = load_fact(fact_file, args.partitions_dir, args.granularity, rebuild)
+            load = manifest['last_load']
+            print(f"Load {load['id']}: {load['rows']} rows into {len(load['touched'])} of "
+                  f"{len(manifest['partitions'])} partitions in {time.perf_counter() - start:.2f} s")
+    if args.replace:
+        start = time.perf_counter()
+        with metrics.span('replace'):
+            manifest = replace_partition(args.replace[1], args.replace[0], args.partitions_dir)
+        print(f"Partition {args.replace[0]} replaced with {manifest['last_load']['rows']} rows "
+              f"in {time.perf_counter() - start:.2f} s")
+    if not args.no_refresh:
+        start = time.perf_counter()
+        with metrics.span('refresh'):
+            refreshed, rows_read = refresh_aggregates(args.partitions_dir, args.tables_dir)
+        names = ', '.join(refreshed) if len(refreshed) <= 12 else f'{refreshed[0]} to {refreshed[-1]}'
+        print(f"Refreshed {len(refreshed)} partition aggregates ({names or 'none stale'}) "
+              f"from {rows_read} rows in {time.perf_counter() - start:.2f} s")
+    if args.check is not None:
+        start = time.perf_counter()
+        mismatch = check_totals(args.partitions_dir, args.tables_dir, args.check or None)
+        print(f"Full scan in {time.perf_counter() - start:.2f} s: " +
+              ('totals identical.' if mismatch is None else f'mismatch, {mismatch}'))
+    if args.queries:
+        cube = cube_from_totals(load_totals(args.partitions_dir), args.tables_dir)
+        print(f"Cube loaded from {cube.fact_rows} aggregate groups")
+        for query, (brand, measure) in MDX_QUERIES.items():
+            print(f"\nMDXQuery{query}: top 5 {brand} by average monthly {measure} in Europe")
+            print_rows(cube.top_brands_by_region(brand, measure))
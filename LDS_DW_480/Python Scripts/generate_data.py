@@ -0,0 +1,215 @@
+import argparse  # Import argparse to read the command line options
+import csv  # Import the csv module for writing the small files
+import os  # Import os for path handling
+import time  # Import time to measure the generation
+
+import numpy as np  # Import numpy to draw whole chunks of sales at once
+
+import metrics
+from star_schema import GEOGRAPHY_FILE, SALES_FILE, country_currency_map
+
+# Synthetic source data at any scale: writes 'computer_sales.csv' and 'geography.csv' with the columns read
+# by cpu.py, gpu.py, ram.py, time.py and geograpy.py, plus 'fx_rates.csv' for currency.py. The output only
+# depends on the seed and the options. The catalogs have realistic sizes (hundreds of CPU, GPU and RAM
+# models, tens of regions) and the sales are skewed like real ones: product popularity follows a Zipf law,
+# a few regions sell much more than the others, sales grow over the years and are higher on weekends.
+# The USD measures are the local ones times the monthly rate of the currency of the region, rounded to
+# cents, so currency.py computes the same values from fx_rates.csv.
+
+FX_RATES_FILE = 'fx_rates.csv'
+GENERATED_DIR = '../Generated data'  # Default output, kept apart from the real sources in '../Original data'
+CHUNK_ROWS = 200000  # Sales generated and written at a time (about 200 MB of memory)
+
+SALES_FIELDS = ['sale_id', 'geo_id', 'time_code',
+                'ram_vendor_name', 'ram_brand', 'ram_name', 'ram_type', 'ram_size', 'ram_clock',
+                'cpu_vendor_name', 'cpu_brand', 'cpu_series', 'cpu_name', 'cpu_n_cores', 'cpu_socket',
+                'gpu_vendor_name', 'gpu_brand', 'gpu_processor_manufacturer', 'gpu_memory', 'gpu_memory_type',
+                'ram_sales', 'ram_sales_usd', 'cpu_sales', 'cpu_sales_usd',
+                'gpu_sales', 'gpu_sales_usd', 'total_sales', 'total_sales_usd']
+
+# Regions of every country of the currency map
+REGIONS = {
+    ('Europe', 'Germany'): ['Bayern', 'Berlin', 'Hamburg', 'Hessen', 'Nordrhein-Westfalen', 'Sachsen'],
+    ('Europe', 'Spain'): ['Andalucia', 'Cataluna', 'Madrid', 'Valencia'],
+    ('Oceania', 'Australia'): ['New South Wales', 'Queensland', 'Victoria', 'Western Australia'],
+    ('Europe', 'United Kingdom'): ['England', 'Northern Ireland', 'Scotland', 'Wales'],
+    ('Europe', 'Belgium'): ['Brussels', 'Flanders', 'Wallonia'],
+    ('North America', 'Canada'): ['Alberta', 'British Columbia', 'Ontario', 'Quebec'],
+    ('Oceania', 'New Zealand'): ['Auckland', 'Canterbury', 'Wellington'],
+    ('North America', 'United States of America'): ['California', 'Florida', 'Illinois', 'New York', 'Texas',
+                                                     'Washington'],
+    ('Europe', 'France'): ['Bretagne', 'Ile-de-France', 'Normandie', 'Provence'],
+    ('Europe', 'Ireland'): ['Connacht', 'Leinster', 'Munster'],
+    ('Europe', 'Italy'): ['Lazio', 'Lombardia', 'Piemonte', 'Sicilia', 'Toscana']
+}
+
+# Units of local currency per USD at the start, and monthly volatility
+CURRENCY_RATES = {'USD': (1.0, 0.0), 'EUR': (0.75, 0.02), 'GBP': (0.65, 0.02), 'AUD': (1.05, 0.025),
+                  'CAD': (1.02, 0.015), 'NZD': (1.2, 0.025)}
+
+def cpu_catalog():
+    # (vendor, brand, series, name, cores, socket, base price in USD)
+    catalog = []
+    lines = [('Intel', 'Intel', 'Intel Core i3', 4, 110), ('Intel', 'Intel', 'Intel Core i5', 6, 190),
+             ('Intel', 'Intel', 'Intel Core i7', 8, 310), ('Intel', 'Intel', 'Intel Core i9', 10, 480),
+             ('Intel', 'Intel', 'Intel Pentium', 2, 70), ('Intel', 'Intel', 'Intel Xeon', 16, 900),
+             ('AMD', 'AMD', 'AMD Ryzen 3', 4, 100), ('AMD', 'AMD', 'AMD Ryzen 5', 6, 170),
+             ('AMD', 'AMD', 'AMD Ryzen 7', 8, 290), ('AMD', 'AMD', 'AMD Ryzen 9', 12, 450),
+             ('AMD', 'AMD', 'AMD Athlon', 2, 60)]
+    sockets = {'Intel': ['LGA1150', 'LGA1151', 'LGA1200', 'LGA1700'], 'AMD': ['AM3+', 'AM4', 'AM5']}
+    for vendor, brand, series, cores, price in lines:
+        for generation, socket in enumerate(sockets[vendor]):
+            for model in range(6):
+                name = f"{series}-{generation + 4}{model * 100 + 400}{'K' if model % 3 == 2 else ''}"
+                catalog.append((vendor, brand, series, name, str(cores + 2 * (model // 3)), socket,
+                                price * (1 + 0.12 * model + 0.08 * generation)))
+    return catalog
+
+def gpu_catalog():
+    # (vendor, brand, processor manufacturer, memory, memory type, base price in USD)
+    catalog = []
+    for vendor, brand, manufacturer, memories, types, price in [
+            ('ASUS', 'ROG Strix', 'NVIDIA', (4, 6, 8, 12), ('GDDR5', 'GDDR6', 'GDDR6X'), 420),
+            ('MSI', 'Gaming X', 'NVIDIA', (4, 6, 8, 12), ('GDDR5', 'GDDR6', 'GDDR6X'), 380),
+            ('Gigabyte', 'Aorus', 'NVIDIA', (6, 8, 12, 24), ('GDDR6', 'GDDR6X'), 450),
+            ('EVGA', 'GeForce', 'NVIDIA', (2, 4, 6, 8), ('GDDR5', 'GDDR6'), 300),
+            ('Sapphire', 'Nitro+', 'AMD', (4, 8, 12, 16), ('GDDR5', 'GDDR6'), 340),
+            ('XFX', 'Radeon', 'AMD', (4, 8, 16), ('GDDR5', 'GDDR6'), 310),
+            ('PowerColor', 'Red Devil', 'AMD', (8, 12, 16), ('GDDR6',), 400),
+            ('Zotac', 'Twin Edge', 'NVIDIA', (2, 4, 6, 8), ('GDDR5', 'GDDR6'), 260)]:
+        for memory in memories:
+            for memory_type in types:
+                catalog.append((vendor, brand, manufacturer, str(memory), memory_type,
+                                price * (0.5 + memory / 10) * (1.3 if memory_type == 'GDDR6X' else 1.0)))
+    return catalog
+
+def ram_catalog():
+    # (vendor, brand, name, type, size, clock, base price in USD)
+    catalog = []
+    for vendor, brand, price in [('Kingston', 'Fury', 4.0), ('Kingston', 'ValueRAM', 3.2), ('Corsair', 'Vengeance', 4.4),
+                                 ('Corsair', 'Dominator', 5.5), ('G.Skill', 'Trident Z', 5.0), ('G.Skill', 'Ripjaws', 4.1),
+                                 ('Crucial', 'Ballistix', 3.8), ('Crucial', 'Crucial', 3.0)]:
+        for ram_type, clocks in [('DDR3', (1333, 1600)), ('DDR4', (2400, 3200, 3600)), ('DDR5', (4800, 6000))]:
+            for size in (4, 8, 16, 32, 64):
+                if ram_type == 'DDR3' and size > 16 or ram_type == 'DDR5' and size < 16:
+                    continue
+                for clock in clocks:
+                    catalog.append((vendor, brand, f'{brand} {size}GB {ram_type}-{clock}', ram_type, str(size),
+                                    str(clock), price * size * (1 + (clock - 1333) / 6000)))
+    return catalog
+
+def zipf_weights(size, skew, generator):
+    # Popularity of 'size' items in a random order: the k-th most popular weighs 1 / k^skew
+    weights = 1.0 / np.arange(1, size + 1) ** skew
+    return generator.permutation(weights) / weights.sum()
+
+def write_geography(output_dir):
+    # Write geography.csv; returns the currency of every geo_id
+    currencies = []
+    with open(os.path.join(output_dir, os.path.basename(GEOGRAPHY_FILE)), 'w', newline='') as geo_file:
+        writer = csv.writer(geo_file)
+        writer.writerow(['geo_id', 'continent', 'country', 'region'])
+        for (continent, country), regions in REGIONS.items():
+            for region in regions:
+                writer.writerow([len(currencies), continent, country, region])
+                currencies.append(country_currency_map[country])
+    return currencies
+
+def month_rates(months, generator):
+    # Random walk of the USD rate (USD for 1 unit) of every currency, one rate per month, rounded like the
+    # published rates so the USD measures can be recomputed from fx_rates.csv
+    rates = {}
+    for currency, (per_usd, volatility) in CURRENCY_RATES.items():
+        rates[currency] = np.round(1.0 / (per_usd * np.exp(np.cumsum(generator.normal(0, volatility, months)))), 6)
+    return rates
+
+def write_fx_rates(output_dir, first_day, rates):
+    # Write fx_rates.csv: one rate per currency and month, published on the first day of the month
+    first_month = first_day.astype('datetime64[M]')
+    with open(os.path.join(output_dir, FX_RATES_FILE), 'w', newline='') as fx_file:
+        writer = csv.writer(fx_file)
+        writer.writerow(['currency', 'date', 'usd_rate'])
+        for currency, values in rates.items():
+            for month, rate in enumerate(values.tolist()):
+                day = (first_month + month).astype('datetime64[D]')
+                writer.writerow([currency, str(day).replace('-', ''), rate])
+
+def generate(rows, output_dir, seed=0, first_day='2013-01-01', days=3000, skew=1.1, growth=1.5):
+    # Write the source files; returns the number of sales written
+    os.makedirs(output_dir, exist_ok=True)
+    generator = np.random.default_rng(seed)
+    currencies = write_geography(output_dir)
+
+    # Catalogs as CSV fragments, so a sale row is a join of precomputed strings
+    cpus, gpus, rams = cpu_catalog(), gpu_catalog(), ram_catalog()
+    fragments = {name: np.array([','.join(item[:-1]) for item in catalog], dtype=object)
+                 for name, catalog in (('cpu', cpus), ('gpu', gpus), ('ram', rams))}
+    prices = {name: np.array([item[-1] for item in catalog])
+              for name, catalog in (('cpu', cpus), ('gpu', gpus), ('ram', rams))}
+    popularity = {name: zipf_weights(len(catalog), skew, generator)
+                  for name, catalog in (('cpu', cpus), ('gpu', gpus), ('ram', rams))}
+    geo_weights = zipf_weights(len(currencies), skew / 2, generator)
+
+    # Days: more sales as the years go by and on weekends
+    first = np.datetime64(first_day, 'D')
+    calendar = np.arange(first, first + days)
+    weekday = (calendar.astype(np.int64) + 3) % 7
+    day_weights = (1 + growth * np.arange(days) / days) * np.where(weekday >= 5, 1.4, 1.0)
+    day_weights /= day_weights.sum()
+    time_codes = np.array([str(day).replace('-', '') for day in calendar], dtype=object)
+    month_of_day = (calendar.astype('datetime64[M]') - first.astype('datetime64[M]')).astype(np.int64)
+    rates = month_rates(int(month_of_day[-1]) + 1, generator)
+    write_fx_rates(output_dir, first, rates)
+    currency_names = sorted(CURRENCY_RATES)
+    currency_of_geo = np.array([currency_names.index(currency) for currency in currencies])
+    rate_table = np.array([rates[currency] for currency in currency_names])  # currency x month
+    # Local prices: the USD prices converted at the rate of the first month
+    local_factor = 1.0 / rate_table[:, 0]
+
+    with open(os.path.join(output_dir, os.path.basename(SALES_FILE)), 'w', newline='') as sales_file:
+        sales_file.write(','.join(SALES_FIELDS) + '\n')
+        for start in range(0, rows, CHUNK_ROWS):
+            size = min(CHUNK_ROWS, rows - start)
+            day = np.sort(generator.choice(days, size, p=day_weights))  # Sales arrive in time order
+            geo = generator.choice(len(currencies), size, p=geo_weights)
+            items = {name: generator.choice(len(weights), size, p=weights) for name, weights in popularity.items()}
+            currency = currency_of_geo[geo]
+            rate = rate_table[currency, month_of_day[day]]
+            local = {name: np.round(prices[name][items[name]] * local_factor[currency] *
+                                    generator.lognormal(0, 0.15, size), 2) for name in ('ram', 'cpu', 'gpu')}
+            local['total'] = np.round(local['ram'] + local['cpu'] + local['gpu'], 2)
+            columns = [map(str, range(start, start + size)), map(str, geo.tolist()), time_codes[day],
+                       fragments['ram'][items['ram']], fragments['cpu'][items['cpu']],
+                       fragments['gpu'][items['gpu']]]
+            for name in ('ram', 'cpu', 'gpu', 'total'):
+                columns.append(map(str, local[name].tolist()))
+                columns.append(map(str, np.round(local[name] * rate, 2).tolist()))
+            sales_file.write('\n'.join(map(','.join, zip(*columns))) + '\n')
+            metrics.count('sales_rows_written', size)
+    return rows
+
+def parse_count(text):
+    # Row counts with an optional k/M suffix: 500k, 10M
+    multiplier = {'k': 10**3, 'm': 10**6}.get(text[-1].lower(), 1)
+    return int(float(text[:-1] if multiplier > 1 else text) * multiplier)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic source data (sales, geography, exchange rates).')
+    parser.add_argument('--rows', type=parse_count, default=10**6, help='number of sales, e.g. 1M, 10M, 100M')
+    parser.add_argument('--output-dir', default=GENERATED_DIR, help='folder of the generated source files')
+    parser.add_argument('--force', action='store_true', help="allow overwriting the real sources in '../Original data'")
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+    parser.add_argument('--first-day', default='2013-01-01', help='first day of sales (YYYY-MM-DD)')
+    parser.add_argument('--days', type=int, default=3000, help='number of days with sales')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of the product popularity')
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    if os.path.abspath(args.output_dir) == os.path.abspath(os.path.dirname(SALES_FILE)) and not args.force and \
+            any(os.path.exists(os.path.join(args.output_dir, os.path.basename(path))) for path in (SALES_FILE, GEOGRAPHY_FILE)):
+        parser.error(f"'{args.output_dir}' holds the real source data; use another --output-dir or --force to overwrite it")
+    metrics.enable_from_args(args, 'generate_data')
+
+    start = time.perf_counter()
+    rows = generate(args.rows, args.output_dir, args.seed, args.first_day, args.days, args.skew)
+    elapsed = time.perf_counter() - start
+    print(f"{rows:,} sales written to '{args.output_dir}' in {elapsed:.1f} s ({rows / elapsed:,.0f} rows/s)")
@@ -0,0 +1,92 @@
+import csv  # Import the csv module to store the keys
+import io  # Import io to parse the registry file from memory
+import json  # Import json to store the watermark
+import os  # Import os for path handling and fsync
+
+# Persistent surrogate-key registry: each dimension keeps an append-only file with one 'id,key...' line per
+# natural key, so a key keeps its id across runs and new keys get the next free id. The file is read back
+# into an in-memory index (natural key -> id) when the registry is opened.
+
+WATERMARK_FILE = 'watermark.json'
+
+class KeyRegistry:
+    def __init__(self, path):
+        self.path = path
+        self.index = {}  # Natural key -> surrogate id
+        self.keys = []  # (id, natural key) pairs in the order they were registered
+        self.next_id = 0
+        self.pending = []  # New pairs not yet written to disk
+        self._load()
+
+    def _load(self):
+        # Read the existing registry, if any
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as registry_file:
+            data = registry_file.read()
+
+        # A run interrupted while appending can leave a partial last line: drop it
+        end = data.rfind(b'\n') + 1
+        if end != len(data):
+            with open(self.path, 'r+b') as registry_file:
+                registry_file.truncate(end)
+            data = data[:end]
+
+        for row in csv.reader(io.StringIO(data.decode('utf-8'), newline='')):
+            surrogate_id, key = int(row[0]), tuple(row[1:])
+            self.index[key] = surrogate_id
+            self.keys.append((surrogate_id, key))
+            self.next_id = max(self.next_id, surrogate_id + 1)
+
+    def get(self, key):
+        # Return the id of a natural key, or None if the key is not registered
+        return self.index.get(key)
+
+    def get_or_add(self, key, surrogate_id=None):
+        # Return the id of a natural key, registering it with the next id (or the given one) if it is new
+        existing = self.index.get(key)
+        if existing is not None:
+            return existing
+        if surrogate_id is None:
+            surrogate_id = self.next_id
+        self.next_id = max(self.next_id, surrogate_id + 1)
+        self.index[key] = surrogate_id
+        self.keys.append((surrogate_id, key))
+        self.pending.append((surrogate_id, key))
+        return surrogate_id
+
+    def commit(self):
+        # Append the new keys to the registry file and make them durable
+        if not self.pending:
+            return 0
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a', newline='', encoding='utf-8') as registry_file:
+            writer = csv.writer(registry_file, lineterminator='\n')
+            for surrogate_id, key in self.pending:
+                writer.writerow([surrogate_id, *key])
+            registry_file.flush()
+            os.fsync(registry_file.fileno())
+        added = len(self.pending)
+        self.pending = []
+        return added
+
+    def __len__(self):
+        return len(self.keys)
+
+def load_watermark(registry_dir):
+    # Read the watermark of the last incremental run (empty if there was none)
+    path = os.path.join(registry_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as watermark_file:
+        return json.load(watermark_file)
+
+def save_watermark(registry_dir, watermark):
+    # Write the watermark atomically, so an interrupted run keeps the previous one
+    os.makedirs(registry_dir, exist_ok=True)
+    path = os.path.join(registry_dir, WATERMARK_FILE)
+    with open(path + '.tmp', 'w') as watermark_file:
+        json.dump(watermark, watermark_file, indent=2)
+        watermark_file.flush()
+        os.fsync(watermark_file.fileno())
+    os.replace(path + '.tmp', path)
@@ -1,193 +1,348 @@
-import csv  # Import the CSV module to read and process CSV files
-import pyodbc  # Import the pyodbc module for database connectivity
+import argparse  # Import argparse to read the command line options
+import os  # Import os for path handling
+import time  # Import time to measure the load throughput
 import tqdm as tq  # Import tqdm for progress bars
 
-# Database connection setup
-server = 'tcp:lds.di.unipi.it'
-database = 'Group_ID_480_DB'
-username = 'Group_ID_480'
-password = '779ENI6E1'
+import metrics  # Spans, counters and latency histograms of the run (off unless requested)
 
-# Creating a connection string with placeholders for driver, server, database, and user credentials
-connectionString = f'DRIVER={{SQL Server}};SERVER={server};DATABASE={database};UID={username};PWD={password}'
+from csv_chunks import iter_csv_batches, read_header  # CSV batches with their byte offsets
+from db_backends import add_backend_arguments, backend_from_args  # Database backends (SQL Server, SQLite)
+from adaptive_batch import BATCH_SIZES_FILE, AdaptiveBatchSize, load_batch_sizes, save_batch_sizes  # Batch sizing
+from load_pipeline import pipelined, read_batches  # Batches of typed rows, optionally read by a producer thread
+from load_checkpoint import (clear_checkpoints, create_checkpoint_table, read_checkpoint, resume_position,
+                             with_retries, write_checkpoint)  # Checkpoint journal of the loads
+from star_schema import TABLES_DIR, column_converters, convert_row  # Typed conversion of the CSV values
+from upsert import Upserter, create_hash_table, forget_hashes  # Upsert through staging tables with content hashes
+
+# Command line options
+parser = argparse.ArgumentParser(description='Load the star schema tables into the database.')
+add_backend_arguments(parser)
+metrics.add_metrics_arguments(parser)
+parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the CSV tables')
+parser.add_argument('--columnar', action='store_true',
+                    help="read the tables from the typed columnar files written by columnar.py instead of the CSV files")
+parser.add_argument('--bulk-reload', action='store_true',
+                    help='empty the tables by truncation and load them without foreign keys and secondary indexes, '
+                         'validating them once at the end')
+parser.add_argument('--pipeline-depth', type=int, default=0,
+                    help='read and convert the CSV files in a separate thread, buffering up to this many batches')
+parser.add_argument('--adaptive-batch', action='store_true',
+                    help='adapt the batch size of each table to the measured rows/s and save the chosen sizes')
+parser.add_argument('--min-batch-size', type=int, default=100, help='smallest batch size (with --adaptive-batch)')
+parser.add_argument('--max-batch-size', type=int, default=50000, help='largest batch size (with --adaptive-batch)')
+parser.add_argument('--batch-memory-mb', type=int, default=64,
+                    help='memory available for the batches in flight (with --adaptive-batch)')
+parser.add_argument('--pinned-batch-sizes', action='store_true',
+                    help=f"use the batch sizes saved by --adaptive-batch in '{BATCH_SIZES_FILE}'")
+parser.add_argument('--checkpoint', action='store_true',
+                    help='commit every batch together with its position in a checkpoint journal, so the load can be resumed')
+parser.add_argument('--resume', action='store_true',
+                    help='continue an interrupted --checkpoint load after the last committed batch')
+parser.add_argument('--retries', type=int, default=5,
+                    help='retries of a batch after a transient database error, with exponential backoff')
+parser.add_argument('--upsert', action='store_true',
+                    help='refresh existing tables: only new and changed rows (by content hash) are sent, through a '
+                         'staging table merged into the table (MERGE on SQL Server, ON CONFLICT on SQLite)')
+parser.add_argument('--quality-gate', action='store_true',
+                    help='check the fact rows before inserting them and write the bad ones, with their reasons, '
+                         'to computer_sales_quality_rejects.csv instead of failing the batch')
+args = parser.parse_args()
+metrics.enable_from_args(args, 'loadData')
+if args.resume:
+    args.checkpoint = True
+if args.checkpoint and (args.bulk_reload or args.columnar):
+    parser.error('--checkpoint and --resume cannot be combined with --bulk-reload or --columnar')
+if args.upsert and (args.bulk_reload or args.checkpoint or args.columnar):
+    parser.error('--upsert cannot be combined with --bulk-reload, --checkpoint or --columnar')
+if args.quality_gate and (args.checkpoint or args.columnar):
+    parser.error('--quality-gate checks the CSV load; run quality_gate.py before a --checkpoint or --columnar load')
+
+# Database backend selected on the command line (the SQL Server of the course by default)
+backend = backend_from_args(args)
 
 # Print message indicating the attempt to connect to the database
-print(f"Connecting to database '{database}' on server '{server}' with user '{username}'...")
+print(f"Connecting to {backend.describe()}...")
 
-# Establish a connection to the database using the connection string
-cnxn = pyodbc.connect(connectionString)
+# Establish a connection to the database
+with metrics.span('connect'):
+    cnxn = backend.connect()
 cursor = cnxn.cursor()  # Create a cursor object to execute SQL queries
 
-# Enable fast executemany for faster bulk insertions into the database
-cursor.fast_executemany = True
-
 # Confirm successful connection
 print('Connection established successfully.\n')
 
 # List of dimension tables and corresponding CSV files
 dimension_tables_and_files = [
-    ('Geography', '../Tables CSV/geography.csv'),
-    ('Time', '../Tables CSV/Time.csv'),
-    ('Cpu', '../Tables CSV/CPU.csv'),
-    ('Gpu', '../Tables CSV/GPU.csv'),
-    ('Ram', '../Tables CSV/RAM.csv')
+    ('Geography', os.path.join(args.tables_dir, 'geography.csv')),
+    ('Time', os.path.join(args.tables_dir, 'Time.csv')),
+    ('Cpu', os.path.join(args.tables_dir, 'CPU.csv')),
+    ('Gpu', os.path.join(args.tables_dir, 'GPU.csv')),
+    ('Ram', os.path.join(args.tables_dir, 'RAM.csv'))
 ]
 
 # Fact table and corresponding CSV file
-fact_table_and_file = ('Computer_sales', '../Tables CSV/computer_sales.csv')
+fact_table_and_file = ('Computer_sales', os.path.join(args.tables_dir, 'computer_sales.csv'))
 
 # Batch size for bulk inserts
 BATCH_SIZE = 1000
 
 # Function to check if a table exists and create it if it doesn't
 def check_and_create_table(table_name, headers, is_fact_table=False):
-    # Check if the table exists in the database by querying the information schema
-    cursor.execute("SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = ?", table_name)
-    table_exists = cursor.fetchone()  # Fetch the result (None if the table doesn't exist)
+    # Check if the table exists in the database (information schema on SQL Server, sqlite_master on SQLite)
+    with metrics.span('table_exists'):
+        table_exists = backend.table_exists(cursor, table_name)
 
     if not table_exists:  # If the table doesn't exist
         print(f"Table '{table_name}' does not exist. Creating it...")
 
-        if is_fact_table:  # If the table is the fact table, create it with foreign keys
-            create_table_query = f"""
-            CREATE TABLE {table_name} (
-                sale_id INT PRIMARY KEY,
-                geo_id INT,
-                time_id INT,
-                ram_id INT,
-                cpu_id INT,
-                gpu_id INT,
-                ram_sales FLOAT,
-                ram_sales_usd FLOAT,
-                cpu_sales FLOAT,
-                cpu_sales_usd FLOAT,
-                gpu_sales FLOAT,
-                gpu_sales_usd FLOAT,
-                total_sales FLOAT,
-                total_sales_usd FLOAT,
-                FOREIGN KEY (geo_id) REFERENCES Geography(geo_id),
-                FOREIGN KEY (time_id) REFERENCES Time(time_id),
-                FOREIGN KEY (ram_id) REFERENCES Ram(ram_id),
-                FOREIGN KEY (cpu_id) REFERENCES Cpu(cpu_id),
-                FOREIGN KEY (gpu_id) REFERENCES Gpu(gpu_id)
-            )
-            """
-        else:  # If the table is a dimension table, create it based on the table name
-            create_table_query = {
-                'Cpu': """
-                CREATE TABLE Cpu (
-                    cpu_id INT PRIMARY KEY,
-                    cpu_vendor_name VARCHAR(255),
-                    cpu_brand VARCHAR(255),
-                    cpu_series VARCHAR(255),
-                    cpu_name VARCHAR(255),
-                    cpu_n_cores INT,
-                    cpu_socket VARCHAR(255)
-                )
-                """,
-                'Gpu': """
-                CREATE TABLE Gpu (
-                    gpu_id INT PRIMARY KEY,
-                    gpu_vendor_name VARCHAR(255),
-                    gpu_brand VARCHAR(255),
-                    cpu_series VARCHAR(255),
-                    gpu_processor_manufacturer VARCHAR(255),
-                    gpu_memory FLOAT,
-                    gpu_memory_type VARCHAR(255)
-                )
-                """,
-                'Ram': """
-                CREATE TABLE Ram (
-                    ram_id INT PRIMARY KEY,
-                    ram_vendor_name VARCHAR(255),
-                    ram_brand VARCHAR(255),
-                    ram_name VARCHAR(255),
-                    ram_type VARCHAR(255),
-                    ram_size FLOAT,
-                    ram_clock FLOAT
-                )
-                """,
-                'Time': """
-                CREATE TABLE Time (
-                    time_id INT PRIMARY KEY,
-                    day INT,
-                    month INT,
-                    year INT,
-                    day_of_week VARCHAR(255),
-                    week INT,
-                    quarter VARCHAR(255)
-                )
-                """,
-                'Geography': """
-                CREATE TABLE Geography (
-                    geo_id INT PRIMARY KEY,
-                    continent VARCHAR(255),
-                    country VARCHAR(255),
-                    region VARCHAR(255),
-                    currency VARCHAR(255)
-                )
-                """
-            }[table_name]
-        
-        # Execute the create table query
-        print(f"Executing Create Table Query: {create_table_query}")
-        cursor.execute(create_table_query)
+        # Build the CREATE TABLE statement from the shared table definitions and execute it
+        # (the fact table also gets the foreign keys to the dimension tables)
+        # (in bulk reload mode the foreign keys are added after the load)
+        with metrics.span('create_table'):
+            query = backend.create_table(cursor, table_name, foreign_keys=not args.bulk_reload)
+        print(f"Executed Create Table Query: {query}")
         print(f"Table '{table_name}' created successfully.")
     else:  # If the table already exists
         print(f"Table '{table_name}' already exists. Proceeding to populate it...")
 
-# Function to populate a table with data from a CSV file using batch loading
+# Batch sizes saved by a previous adaptive run, and the ones chosen by this run
+pinned_batch_sizes = load_batch_sizes() if args.pinned_batch_sizes else {}
+chosen_batch_sizes = {}
+
+# Function to populate a table with data from a CSV file using batch loading.
+# With --pipeline-depth the CSV file is read and converted by a producer thread while this thread inserts.
+# With --adaptive-batch the batch size follows the rows/s measured for each executemany.
+# With --upsert only the new and changed rows are sent, through the staging table of the table.
 def populate_table(table_name, file_name):
     print(f"\nProcessing table '{table_name}' with file '{file_name}'...")
 
-    # Open the CSV file
-    with open(file_name, 'r') as file:
-        reader = csv.reader(file, delimiter=',')  # Create a CSV reader object
-        headers = next(reader)  # Read the header row (column names)
-        print(f"CSV headers: {headers}")
+    batch_size = pinned_batch_sizes.get(table_name, BATCH_SIZE)
+    controller = None
+    if args.adaptive_batch:
+        # Batches in flight: the one being inserted plus the ones buffered by the producer thread
+        controller = AdaptiveBatchSize(batch_size, args.min_batch_size, args.max_batch_size,
+                                       args.batch_memory_mb * 1024 * 1024, buffers=args.pipeline_depth + 1)
+        batch_size = controller.current
+
+    # Read the CSV file in batches of typed rows; the first item is the header row (column names).
+    # With --quality-gate the fact rows are checked first and the bad ones written to the reject file.
+    gate = None
+    if args.quality_gate and table_name == fact_table_and_file[0]:
+        from quality_gate import QualityGate  # Needs numpy, only imported when requested
+        gate = QualityGate(args.tables_dir)
+    batches = read_batches(file_name, table_name, batch_size, gate)
+    if args.pipeline_depth:
+        batches = pipelined(batches, args.pipeline_depth)
+    headers = next(batches)
+    print(f"CSV headers: {headers}")
 
-        # Check if the table exists and create it if necessary
-        is_fact_table = (table_name == fact_table_and_file[0])
-        check_and_create_table(table_name, headers, is_fact_table)
+    # Check if the table exists and create it if necessary
+    is_fact_table = (table_name == fact_table_and_file[0])
+    check_and_create_table(table_name, headers, is_fact_table)
 
-        # Prepare the SQL insert query dynamically based on the headers
-        columns = ", ".join(headers)
-        placeholders = ", ".join(['?'] * len(headers))  # '?' placeholders for parameterized query
-        insert_query = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
+    # Prepare the SQL insert query dynamically based on the headers, using the bulk path of the backend
+    upserter = None
+    if args.upsert:
+        create_hash_table(backend, cursor)
+        upserter = Upserter(backend, cursor, table_name, headers)
+        print(f"Upserting through the staging table '{upserter.staging}' "
+              f"({len(upserter.hashes)} rows loaded before with their hash)")
+    else:
+        forget_hashes(backend, cursor, table_name)  # Hashes of an earlier --upsert, committed with the rows
+        insert_query = backend.prepare_insert(cursor, table_name, headers)
         print(f"Prepared SQL Insert Query: {insert_query}")
 
-        rows = []  # Initialize an empty list to hold rows for batch insertion
-        row_count = 0  # Counter for total rows
+    row_count = 0  # Counter for total rows
+    start = time.perf_counter()
+
+    # Display a progress bar during the loading process
+    with tq.tqdm(desc=f'Loading {table_name}', unit='rows') as pbar:
+        for rows in batches:
+            batch_start = time.perf_counter()
+            if upserter:
+                metrics.count('rows_sent', upserter.upsert(rows), table_name)
+            else:
+                backend.insert_rows(cursor, insert_query, rows)
+                metrics.count('rows_inserted', len(rows), table_name)
+            batch_seconds = time.perf_counter() - batch_start
+            metrics.observe('executemany_seconds', batch_seconds, table_name)
+            if controller:
+                controller.record(len(rows), batch_seconds, rows[0])
+            row_count += len(rows)
+            pbar.update(len(rows))  # Update progress bar
+
+    # Commit the transaction to save the inserted data
+    print(f"Committing the transactions for table '{table_name}'...")
+    with metrics.span('commit'):
+        cnxn.commit()
+    # With --upsert the rows are only compared; the summary tells how many were sent
+    report_throughput(table_name, row_count, time.perf_counter() - start,
+                      'compared with' if upserter else 'inserted into')
+    if upserter:
+        upserter.close()
+        print(upserter.summary())
+    if gate:
+        gate.close()
+        print(gate.summary())
+    if controller:
+        chosen_batch_sizes[table_name] = controller.chosen()
+        steps = ', '.join(f'{size}: {rate:,.0f} rows/s' for size, rate in controller.history)
+        print(f"Batch size chosen for '{table_name}': {controller.chosen()} (measured {steps or 'no full batch'})")
+
+# Function to print the number of rows loaded into a table and the throughput
+def report_throughput(table_name, row_count, elapsed, action='inserted into'):
+    print(f"{row_count} rows {action} '{table_name}' successfully "
+          f"in {elapsed:.2f} s ({row_count / elapsed if elapsed else 0:,.0f} rows/s).")
+
+# Function to populate a table from its typed columnar copy: values are already typed, so nothing is parsed
+def populate_table_columnar(table_name):
+    from columnar import ColumnarTable, columnar_dir  # Needs numpy, only imported when requested
+
+    table = ColumnarTable(os.path.join(columnar_dir(args.tables_dir), table_name))
+    print(f"\nProcessing table '{table_name}' from its columnar files ({table.num_rows} rows)...")
+    check_and_create_table(table_name, table.columns, table_name == fact_table_and_file[0])
+    forget_hashes(backend, cursor, table_name)
+
+    insert_query = backend.prepare_insert(cursor, table_name, table.columns)
+    print(f"Prepared SQL Insert Query: {insert_query}")
+    start = time.perf_counter()
 
-        # Display a progress bar during the loading process
-        with tq.tqdm(desc=f'Loading {table_name}', unit='rows') as pbar:
-            for row in reader:
-                rows.append(row)
-                row_count += 1
+    with tq.tqdm(desc=f'Loading {table_name}', unit='rows', total=table.num_rows) as pbar:
+        for rows in table.iter_rows(BATCH_SIZE):
+            batch_start = time.perf_counter()
+            backend.insert_rows(cursor, insert_query, rows)
+            metrics.observe('executemany_seconds', time.perf_counter() - batch_start, table_name)
+            metrics.count('rows_inserted', len(rows), table_name)
+            pbar.update(len(rows))
 
-                # If the batch size is reached, insert the batch into the database
-                if len(rows) == BATCH_SIZE:
-                    cursor.executemany(insert_query, rows)
-                    pbar.update(len(rows))  # Update progress bar
-                    rows.clear()  # Clear the batch list after insertion
+    print(f"Committing the transactions for table '{table_name}'...")
+    with metrics.span('commit'):
+        cnxn.commit()
+    report_throughput(table_name, table.num_rows, time.perf_counter() - start)
+
+# Function to open a new connection after a transient error (the previous one may be broken)
+def reconnect():
+    global cnxn, cursor
+    try:
+        cnxn.close()
+    except Exception:
+        pass  # The connection is already lost
+    print("Reconnecting to the database...")
+    cnxn = backend.connect()
+    cursor = cnxn.cursor()
+
+# Function to populate a table committing every batch together with its checkpoint. A resumed load starts
+# right after the last committed batch, and a transient error only costs the batch in flight.
+def populate_table_checkpointed(table_name, file_name):
+    print(f"\nProcessing table '{table_name}' with file '{file_name}' (checkpointed)...")
+    headers, data_start = read_header(file_name)
+    checkpoint = read_checkpoint(cursor, table_name) if args.resume else None
+    if checkpoint and checkpoint['completed']:
+        print(f"Table '{table_name}' was already loaded ({checkpoint['rows']} rows), skipping it.")
+        return
+    offset, row_count = resume_position(checkpoint, file_name, data_start)
+    if row_count:
+        print(f"Resuming table '{table_name}' after {row_count} committed rows (byte {offset}).")
+
+    check_and_create_table(table_name, headers, table_name == fact_table_and_file[0])
+    forget_hashes(backend, cursor, table_name)
+    cnxn.commit()
+    converters = column_converters(table_name, headers)
+    start = time.perf_counter()
+    loaded = 0  # Rows loaded by this run
+
+    def insert_batch(rows, end_offset, total_rows):
+        # One attempt: insert the batch, move the checkpoint and commit both in the same transaction
+        insert_query = backend.prepare_insert(cursor, table_name, headers)
+        batch_start = time.perf_counter()
+        backend.insert_rows(cursor, insert_query, rows)
+        insert_end = time.perf_counter()
+        write_checkpoint(cursor, table_name, file_name, end_offset, total_rows)
+        cnxn.commit()
+        metrics.observe('executemany_seconds', insert_end - batch_start, table_name)
+        metrics.observe('commit_seconds', time.perf_counter() - insert_end, table_name)
 
-            # Insert any remaining rows that didn't complete a full batch
-            if rows:
-                cursor.executemany(insert_query, rows)
-                pbar.update(len(rows))
+    with tq.tqdm(desc=f'Loading {table_name}', unit='rows', initial=row_count) as pbar:
+        for batch, end_offset in iter_csv_batches(file_name, offset, BATCH_SIZE):
+            rows = [convert_row(converters, row) for row in batch]
+            with_retries(lambda: insert_batch(rows, end_offset, row_count + len(rows)), backend, reconnect, args.retries)
+            metrics.count('rows_inserted', len(rows), table_name)
+            row_count += len(rows)
+            loaded += len(rows)
+            pbar.update(len(rows))
 
-        # Commit the transaction to save the inserted data
-        print(f"Committing the transactions for table '{table_name}'...")
+    def complete():
+        write_checkpoint(cursor, table_name, file_name, os.path.getsize(file_name), row_count, completed=True)
         cnxn.commit()
-        print(f"{row_count} rows inserted into '{table_name}' successfully.")
+    with_retries(complete, backend, reconnect, args.retries)
+    report_throughput(table_name, loaded, time.perf_counter() - start)
+
+# Bulk reload, first phase: empty the existing tables in reverse foreign key order (fact table first).
+# Foreign keys are dropped and secondary indexes disabled, so the inserts only write the table data.
+def clear_tables():
+    disabled_indexes = {}
+    existing = [table_name for table_name, _ in reversed(dimension_tables_and_files + [fact_table_and_file])
+                if backend.table_exists(cursor, table_name)]
+    for table_name in existing:
+        backend.drop_foreign_keys(cursor, table_name)
+    for table_name in existing:
+        print(f"Truncating table '{table_name}'...")
+        backend.truncate_table(cursor, table_name)
+        forget_hashes(backend, cursor, table_name)
+        disabled_indexes[table_name] = backend.disable_indexes(cursor, table_name)
+    cnxn.commit()
+    return disabled_indexes
+
+# Bulk reload, last phase: rebuild the indexes and validate the foreign keys of the fact table in one step
+def restore_constraints(disabled_indexes):
+    for table_name, indexes in disabled_indexes.items():
+        if indexes:
+            print(f"Rebuilding {len(indexes)} indexes of table '{table_name}'...")
+            backend.rebuild_indexes(cursor, table_name, indexes)
+    print(f"Adding and validating the foreign keys of table '{fact_table_and_file[0]}'...")
+    backend.add_foreign_keys(cursor, fact_table_and_file[0])
+    cnxn.commit()
 
 try:
-    # Populate dimension tables first
-    for table_name, file_name in dimension_tables_and_files:
-        populate_table(table_name, file_name)
+    phase_times = {}  # Time spent in each phase of a bulk reload
+    if args.bulk_reload:
+        start = time.perf_counter()
+        with metrics.span('clear'):
+            disabled_indexes = clear_tables()
+        phase_times['clear'] = time.perf_counter() - start
+
+    if args.checkpoint:
+        # A new checkpointed load starts with an empty journal; a resumed one keeps it
+        create_checkpoint_table(backend, cursor)
+        if not args.resume:
+            clear_checkpoints(cursor)
+        cnxn.commit()
+
+    # Populate dimension tables first, then the fact table
+    start = time.perf_counter()
+    for table_name, file_name in dimension_tables_and_files + [fact_table_and_file]:
+        with metrics.span(table_name):
+            if args.checkpoint:
+                populate_table_checkpointed(table_name, file_name)
+            elif args.columnar:
+                populate_table_columnar(table_name)
+            else:
+                populate_table(table_name, file_name)
+    phase_times['insert'] = time.perf_counter() - start
+
+    if chosen_batch_sizes:
+        save_batch_sizes(chosen_batch_sizes)
+        print(f"\nChosen batch sizes saved to '{BATCH_SIZES_FILE}' (use --pinned-batch-sizes to reuse them): "
+              f"{chosen_batch_sizes}")
 
-    # Populate the fact table after dimension tables
-    populate_table(*fact_table_and_file)
+    if args.bulk_reload:
+        start = time.perf_counter()
+        with metrics.span('constraints and indexes'):
+            restore_constraints(disabled_indexes)
+        phase_times['constraints and indexes'] = time.perf_counter() - start
+        print("\nBulk reload phases:")
+        for phase, elapsed in phase_times.items():
+            print(f"  {phase:<24} {elapsed:8.2f} s")
 
 finally:
     # Ensure cursor and connection are closed even if an error occurs
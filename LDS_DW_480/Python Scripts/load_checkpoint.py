@@ -0,0 +1,70 @@
+import os  # Import os for path handling
+import time  # Import time to wait between retries
+
+# Checkpoint journal of the loads: for each table, the byte offset in the source CSV file after the last
+# committed batch and the number of rows committed so far. The journal is a table of the target database
+# updated in the same transaction as each batch, so it can never be ahead of or behind the loaded data:
+# a resumed load starts exactly after the last committed batch.
+
+CHECKPOINT_TABLE = 'Load_checkpoint'
+
+def create_checkpoint_table(backend, cursor):
+    if not backend.table_exists(cursor, CHECKPOINT_TABLE):
+        cursor.execute(f"""CREATE TABLE {CHECKPOINT_TABLE} (
+    table_name VARCHAR(255) PRIMARY KEY,
+    source_file VARCHAR(1024),
+    source_offset BIGINT,
+    row_count BIGINT,
+    completed INT
+)""")
+
+def read_checkpoint(cursor, table_name):
+    # Return the checkpoint of a table as a dictionary, or None if the table has no checkpoint
+    cursor.execute(f"SELECT source_file, source_offset, row_count, completed FROM {CHECKPOINT_TABLE} "
+                   "WHERE table_name = ?", (table_name,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return {'source_file': row[0], 'offset': row[1], 'rows': row[2], 'completed': bool(row[3])}
+
+def write_checkpoint(cursor, table_name, source_file, offset, row_count, completed=False):
+    # Record the position of a table; the caller commits it together with the batch it describes
+    source_file = os.path.abspath(source_file)
+    cursor.execute(f"UPDATE {CHECKPOINT_TABLE} SET source_file = ?, source_offset = ?, row_count = ?, completed = ? "
+                   "WHERE table_name = ?", (source_file, offset, row_count, int(completed), table_name))
+    if cursor.rowcount == 0:
+        cursor.execute(f"INSERT INTO {CHECKPOINT_TABLE} (table_name, source_file, source_offset, row_count, completed) "
+                       "VALUES (?, ?, ?, ?, ?)", (table_name, source_file, offset, row_count, int(completed)))
+
+def clear_checkpoints(cursor):
+    cursor.execute(f"DELETE FROM {CHECKPOINT_TABLE}")
+
+def resume_position(checkpoint, source_file, data_start):
+    # Return (offset, rows) to resume a table from, checking the checkpoint belongs to the same source file
+    if checkpoint is None:
+        return data_start, 0
+    if checkpoint['source_file'] != os.path.abspath(source_file):
+        raise ValueError(f"The checkpoint refers to '{checkpoint['source_file']}', not to '{source_file}'")
+    offset = checkpoint['offset']
+    with open(source_file, 'rb') as source:
+        source.seek(offset - 1)
+        if offset > os.fstat(source.fileno()).st_size or source.read(1) != b'\n':
+            raise ValueError(f"'{source_file}' changed since the checkpoint: offset {offset} is not a line start")
+    return offset, checkpoint['rows']
+
+def with_retries(operation, backend, reconnect, retries=5, backoff=1.0, max_wait=60.0):
+    # Run an operation, retrying it after transient errors (dropped connection, timeout, lock) with an
+    # exponential backoff. The uncommitted work of the failed attempt is lost, so 'operation' must redo the
+    # whole in-flight batch; 'reconnect' is called before each new attempt.
+    attempt = 0
+    while True:
+        try:
+            return operation()
+        except Exception as error:
+            if attempt >= retries or not backend.is_transient(error):
+                raise
+            wait = min(backoff * 2 ** attempt, max_wait)
+            attempt += 1
+            print(f"\nTransient error: {error}. Retrying in {wait:.1f} s (attempt {attempt} of {retries})...")
+            time.sleep(wait)
+            reconnect()
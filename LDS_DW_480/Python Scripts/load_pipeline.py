@@ -0,0 +1,137 @@
+import argparse  # Import argparse to read the command line options
+import csv  # Import the csv module for reading CSV files
+import os  # Import os for path handling
+import queue  # Import queue for the bounded buffer between the two threads
+import threading  # Import threading to run the producer
+import time  # Import time to measure the throughput
+
+import metrics
+from db_backends import add_backend_arguments, backend_from_args
+from star_schema import FACT_FILE, FACT_TABLE, TABLES_DIR, column_converters, convert_row
+from upsert import forget_hashes
+
+# Double-buffered load pipeline: a producer thread reads the CSV file, converts the values and groups the
+# rows into batches, while the loading thread sends the previous batches to the database. The two threads
+# talk through a bounded queue, so at most 'depth' batches wait in memory. CSV parsing then overlaps with
+# the network round trips of executemany instead of alternating with them.
+
+_END = object()  # Marks the end of the batches
+
+def read_batches(file_name, table_name, batch_size, gate=None):
+    # Yield the converted rows of a CSV file in batches; the first item is the header.
+    # 'batch_size' is either a number or a function returning the size of the next batch.
+    # With a quality gate (quality_gate.QualityGate) every batch is checked and converted by the gate, and
+    # the rejected rows go to its reject file instead of the database.
+    next_size = batch_size if callable(batch_size) else lambda: batch_size
+    with open(file_name, 'r') as file:
+        reader = csv.reader(file)
+        headers = next(reader)
+        yield headers
+        converters = column_converters(table_name, headers)
+        if gate is not None:
+            gate.start(headers)
+        batch = []
+        size = next_size()
+        batch_start = time.perf_counter()
+        for row in reader:
+            batch.append(row if gate is not None else convert_row(converters, row))
+            if len(batch) >= size:
+                if gate is not None:
+                    batch = gate.filter(batch, typed=True)
+                # Reading and converting time of the batch (the consumer's time is not counted)
+                metrics.observe('csv_batch_seconds', time.perf_counter() - batch_start, table_name)
+                if batch:
+                    yield batch
+                batch = []
+                size = next_size()
+                batch_start = time.perf_counter()
+        if gate is not None and batch:
+            batch = gate.filter(batch, typed=True)
+        if batch:
+            yield batch
+
+def pipelined(items, depth):
+    # Iterate 'items' in a producer thread, at most 'depth' items ahead of the consumer.
+    # An error in the producer is raised again in the consumer.
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()  # Set when the consumer stops early
+
+    def offer(item):
+        # Put an item in the buffer, giving up if the consumer has stopped
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not offer(item):
+                    return
+            offer(_END)
+        except BaseException as error:
+            offer(error)
+
+    producer = threading.Thread(target=produce, name='csv-producer', daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+def load_fact(backend, tables_dir, batch_size, depth):
+    # Load the fact table once, serially (depth 0) or pipelined, into an emptied table; return rows and seconds
+    file_name = os.path.join(tables_dir, FACT_FILE)
+    cnxn = backend.connect()
+    cursor = cnxn.cursor()
+    try:
+        if backend.table_exists(cursor, FACT_TABLE):
+            backend.truncate_table(cursor, FACT_TABLE)
+            forget_hashes(backend, cursor, FACT_TABLE)
+        else:
+            backend.create_table(cursor, FACT_TABLE, foreign_keys=False)
+        cnxn.commit()
+
+        start = time.perf_counter()
+        batches = read_batches(file_name, FACT_TABLE, batch_size)
+        if depth:
+            batches = pipelined(batches, depth)
+        headers = next(batches)
+        insert_query = backend.prepare_insert(cursor, FACT_TABLE, headers)
+        row_count = 0
+        for batch in batches:
+            backend.insert_rows(cursor, insert_query, batch)
+            row_count += len(batch)
+        cnxn.commit()
+        return row_count, time.perf_counter() - start
+    finally:
+        cnxn.close()
+
+if __name__ == '__main__':
+    # Benchmark: load the fact table serially and then pipelined, and compare the throughput
+    parser = argparse.ArgumentParser(description='Measure the fact table load with and without the pipeline.')
+    add_backend_arguments(parser)
+    parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the CSV tables')
+    parser.add_argument('--batch-size', type=int, default=1000, help='rows sent with each executemany')
+    parser.add_argument('--pipeline-depth', type=int, default=4, help='batches buffered between the two threads')
+    args = parser.parse_args()
+
+    backend = backend_from_args(args)
+    print(f"Loading '{FACT_TABLE}' into {backend.describe()} (the table is emptied before each run)...")
+    results = {}
+    for label, depth in (('serial', 0), (f'pipelined (depth {args.pipeline_depth})', args.pipeline_depth)):
+        row_count, elapsed = load_fact(backend, args.tables_dir, args.batch_size, depth)
+        results[label] = elapsed
+        print(f"  {label:<24} {row_count} rows in {elapsed:.2f} s ({row_count / elapsed:,.0f} rows/s)")
+    serial, piped = results.values()
+    print(f"Speed-up: {serial / piped:.2f}x")
@@ -0,0 +1,501 @@
+import argparse  # Import argparse to read the command line options
+import glob  # Import glob to find the MDX files
+import heapq  # Import heapq for the bounded heap of TOPCOUNT
+import os  # Import os for path handling
+import re  # Import re to split the MDX text into tokens
+import time  # Import time to measure every operator
+
+import numpy as np  # Import numpy for the bitmaps and the group-bys
+
+import metrics
+from olap_cube import ATTRIBUTES, COUNT, MEASURES, Cube, group, scale_cube
+from star_schema import TABLES_DIR
+
+# Executor for the subset of MDX used by the queries in LDS_DC_480/MDX Queries, running on the star schema
+# tables instead of SSAS. Supported: WITH MEMBER / SET, SELECT ... ON COLUMNS / ROWS with NON EMPTY,
+# FROM, WHERE slicers (members, tuples of members, sets of members), [Dim].[Attribute].MEMBERS, members,
+# {sets}, (tuples), crossjoins with '*', EXCEPT, TOPCOUNT, AVG and SUM.
+# - Slicers are resolved through bitmap indexes built once for every member of every attribute: the
+#   bitmaps of the slicer are combined with AND/OR on packed bits, then the selected fact rows are kept.
+# - Cell values come from group-bys of the selected rows, one per combination of attributes used by the
+#   query, so a TOPCOUNT or an AVG over hundreds of members only reads the fact rows once.
+# - TOPCOUNT keeps its best tuples in a bounded heap instead of sorting the whole set.
+# Every operator records its calls, time and output, printed as the query plan with --explain.
+
+MDX_DIR = '../../LDS_DC_480/MDX Queries'
+
+ALL = -1  # Code of the All member of an attribute
+DEFAULT_MEASURE = 'Ram Sales'  # First measure of the SSAS cube
+
+# Cube dimensions, as in the SSAS project: dimension -> attributes of the in-memory cube
+DIMENSION_OF = {name: table_name for name, (table_name, _, _) in ATTRIBUTES.items()}
+
+TOKEN = re.compile(r"\s+|--[^\n]*|//[^\n]*|/\*.*?\*/|(\[[^\]]*\]|\d+(?:\.\d+)?|[A-Za-z_]\w*|[{}(),.*])", re.S)
+FUNCTIONS = {'TOPCOUNT', 'EXCEPT', 'AVG', 'SUM'}
+
+class MdxError(Exception):
+    pass
+
+# Syntax tree. Every node keeps the statistics of its operator for the query plan.
+
+class Node:
+    def __init__(self, label, children=()):
+        self.label = label
+        self.children = list(children)
+        self.calls = 0
+        self.seconds = 0.0
+        self.output = 0  # Tuples (sets) or non-empty values (numbers) produced
+
+class Members(Node):  # [Dim].[Attribute].MEMBERS
+    def __init__(self, attribute):
+        super().__init__(f'Members {attribute}')
+        self.attribute = attribute
+
+class Member(Node):  # [Dim].[Attribute].[Member], [Measures].[Name]
+    def __init__(self, attribute, name):
+        super().__init__(f'Member [{attribute}].[{name}]')
+        self.attribute, self.name = attribute, name
+
+class NamedSet(Node):  # [Name] defined by WITH SET
+    def __init__(self, name):
+        super().__init__(f'Named set [{name}]')
+        self.name = name
+
+class SetLiteral(Node):  # { ... }
+    def __init__(self, items):
+        super().__init__('Set', items)
+
+class Tuple(Node):  # ( a, b ): crossjoin of its elements
+    def __init__(self, items):
+        super().__init__('Tuple', items)
+
+class CrossJoin(Node):  # a * b
+    def __init__(self, left, right):
+        super().__init__('CrossJoin', [left, right])
+
+class Function(Node):  # TOPCOUNT, EXCEPT, AVG, SUM
+    def __init__(self, name, arguments):
+        super().__init__(name.upper(), arguments)
+        self.name = name.upper()
+
+class Number(Node):
+    def __init__(self, value):
+        super().__init__(f'Number {value}')
+        self.value = value
+
+class Query:
+    def __init__(self):
+        self.members = {}  # Calculated measure -> expression
+        self.sets = {}  # Named set -> expression
+        self.axes = []  # (axis name, NON EMPTY, set expression)
+        self.cube = None
+        self.slicer = None
+
+def tokenize(text):
+    return [match.group(1) for match in TOKEN.finditer(text) if match.group(1)]
+
+class Parser:
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def peek(self, offset=0):
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else None
+
+    def keyword(self, *words):
+        # Consume the keywords if they come next (case insensitive)
+        if all((self.peek(index) or '').upper() == word for index, word in enumerate(words)):
+            self.position += len(words)
+            return True
+        return False
+
+    def expect(self, token):
+        found = self.peek()
+        if found is None or found.upper() != token.upper():
+            raise MdxError(f"Expected '{token}' but found '{found}'")
+        self.position += 1
+        return found
+
+    def name(self):
+        token = self.peek()
+        if token is None or not token.startswith('['):
+            raise MdxError(f"Expected a [name] but found '{token}'")
+        self.position += 1
+        return token[1:-1]
+
+    def query(self):
+        query = Query()
+        if self.keyword('WITH'):
+            while True:
+                if self.keyword('MEMBER'):
+                    path = self.path()
+                    if len(path) != 2 or path[0] != 'Measures':
+                        raise MdxError('Only calculated measures are supported: ' + '.'.join(path))
+                    self.expect('AS')
+                    query.members[path[1]] = self.expression()
+                elif self.keyword('SET'):
+                    name = self.name()
+                    self.expect('AS')
+                    query.sets[name] = self.expression()
+                else:
+                    break
+        self.expect('SELECT')
+        while True:
+            non_empty = self.keyword('NON', 'EMPTY')
+            expression = self.expression()
+            self.expect('ON')
+            axis = self.peek().upper()
+            self.position += 1
+            query.axes.append(({'0': 'COLUMNS', '1': 'ROWS'}.get(axis, axis), non_empty, expression))
+            if self.peek() != ',':
+                break
+            self.position += 1
+        self.expect('FROM')
+        query.cube = self.name()
+        if self.keyword('WHERE'):
+            query.slicer = self.expression()
+        if self.peek() is not None:
+            raise MdxError(f"Unexpected '{self.peek()}' at the end of the query")
+        return query
+
+    def path(self):
+        # [a].[b].[c] -> ['a', 'b', 'c'] (MEMBERS is kept as a plain word)
+        parts = [self.name()]
+        while self.peek() == '.':
+            self.position += 1
+            token = self.peek()
+            if token and token.upper() == 'MEMBERS':
+                self.position += 1
+                parts.append('MEMBERS')
+            else:
+                parts.append(self.name())
+        return parts
+
+    def expression(self):
+        node = self.term()
+        while self.peek() == '*':
+            self.position += 1
+            node = CrossJoin(node, self.term())
+        return node
+
+    def items(self, closing):
+        items = []
+        if self.peek() != closing:
+            items.append(self.expression())
+            while self.peek() == ',':
+                self.position += 1
+                items.append(self.expression())
+        self.expect(closing)
+        return items
+
+    def term(self):
+        token = self.peek()
+        if token is None:
+            raise MdxError('Unexpected end of the query')
+        if token == '{':
+            self.position += 1
+            return SetLiteral(self.items('}'))
+        if token == '(':
+            self.position += 1
+            items = self.items(')')
+            return items[0] if len(items) == 1 else Tuple(items)
+        if token[0].isdigit():
+            self.position += 1
+            return Number(float(token))
+        if token.upper() in FUNCTIONS and self.peek(1) == '(':
+            self.position += 2
+            return Function(token, self.items(')'))
+        if token.startswith('['):
+            path = self.path()
+            if len(path) == 1:
+                return NamedSet(path[0])
+            if path[0] == 'Measures':
+                return Member('Measures', path[1])
+            if len(path) == 3:
+                attribute = path[1]
+                if DIMENSION_OF.get(attribute) != path[0]:
+                    raise MdxError(f"Unknown attribute [{path[0]}].[{attribute}]")
+                return Members(attribute) if path[2] == 'MEMBERS' else Member(attribute, path[2])
+            raise MdxError('Unsupported reference ' + '.'.join(f'[{part}]' for part in path))
+        raise MdxError(f"Unexpected '{token}'")
+
+class Executor:
+    def __init__(self, cube):
+        self.cube = cube
+        start = time.perf_counter()
+        # Bitmap index: attribute -> one packed bitmap of the fact rows per member
+        self.bitmaps = {name: [np.packbits(codes == code) for code in range(cube.cardinalities[name])]
+                        for name, codes in cube.fact_codes.items()}
+        self.index_seconds = time.perf_counter() - start
+
+    def member_code(self, attribute, name):
+        if attribute == 'Measures':
+            if name not in MEASURES and name != COUNT and name not in self.query.members:
+                raise MdxError(f"Unknown measure [{name}]")
+            return name
+        if name == 'All':
+            return ALL
+        matches = [code for code, member in enumerate(self.cube.members[attribute].tolist()) if str(member) == name]
+        if not matches:
+            raise MdxError(f"Unknown member [{attribute}].[{name}]")
+        return matches[0]
+
+    def member_name(self, attribute, code):
+        if attribute == 'Measures':
+            return code
+        return 'All' if code == ALL else str(self.cube.members[attribute][code])
+
+    def timed(self, node, evaluate, *arguments):
+        start = time.perf_counter()
+        result = evaluate(node, *arguments)
+        node.calls += 1
+        node.seconds += time.perf_counter() - start
+        if isinstance(result, list):
+            node.output += len(result)
+        elif result is not None:
+            node.output += 1
+        return result
+
+    # Sets: lists of tuples, a tuple being a tuple of (attribute, member code) pairs
+
+    def tuples(self, node, context):
+        return self.timed(node, self._tuples, context)
+
+    def _tuples(self, node, context):
+        if isinstance(node, Members):
+            return [((node.attribute, code),) for code in [ALL] + list(range(self.cube.cardinalities[node.attribute]))]
+        if isinstance(node, Member):
+            return [((node.attribute, self.member_code(node.attribute, node.name)),)]
+        if isinstance(node, NamedSet):
+            if node.name not in self.named_sets:
+                raise MdxError(f"Unknown set [{node.name}]")
+            return self.named_sets[node.name]
+        if isinstance(node, SetLiteral):
+            result = []
+            for item in node.children:
+                result.extend(self.tuples(item, context))
+            return result
+        if isinstance(node, (Tuple, CrossJoin)):
+            result = [()]
+            for item in node.children:
+                result = [left + right for left in result for right in self.tuples(item, context)]
+            return result
+        if isinstance(node, Function) and node.name == 'EXCEPT':
+            removed = set(self.tuples(node.children[1], context))
+            return [item for item in self.tuples(node.children[0], context) if item not in removed]
+        if isinstance(node, Function) and node.name == 'TOPCOUNT':
+            candidates = self.tuples(node.children[0], context)
+            count = int(self.value(node.children[1], context))
+            expression = node.children[2] if len(node.children) > 2 else None
+
+            def score(index):
+                value = self.value_at(expression, context, candidates[index])
+                return -np.inf if value is None else value
+            # Bounded heap of the 'count' best tuples; ties keep the order of the set
+            best = heapq.nlargest(count, range(len(candidates)), key=score)
+            return [candidates[index] for index in best]
+        raise MdxError(f"'{node.label}' is not a set")
+
+    # Numbers: None is an empty cell
+
+    def value(self, node, context):
+        return self.timed(node, self._value, context)
+
+    def _value(self, node, context):
+        if isinstance(node, Number):
+            return node.value
+        if isinstance(node, Member) and node.attribute == 'Measures':
+            return self.measure(node.name, context)
+        if isinstance(node, Function) and node.name in ('AVG', 'SUM'):
+            values = [self.value_at(node.children[1] if len(node.children) > 1 else None, context, item)
+                      for item in self.tuples(node.children[0], context)]
+            values = [value for value in values if value is not None]  # Empty cells are skipped
+            if not values:
+                return None
+            return sum(values) / len(values) if node.name == 'AVG' else sum(values)
+        # A tuple or a member used as a number: the current measure at that coordinate
+        items = self.tuples(node, context)
+        if len(items) != 1:
+            raise MdxError(f"'{node.label}' is a set, not a value")
+        return self.value_at(None, context, items[0])
+
+    def value_at(self, expression, context, coordinates):
+        # Evaluate an expression (the current measure if None) with the coordinates overriding the context
+        context = dict(context)
+        context.update(coordinates)
+        if expression is None:
+            return self.measure(context['Measures'], context)
+        return self.value(expression, context)
+
+    def measure(self, name, context):
+        if name in self.query.members:
+            context = dict(context, Measures=name)
+            return self.value(self.query.members[name], context)
+        attributes = tuple(attribute for attribute in ATTRIBUTES if context.get(attribute, ALL) != ALL)
+        cells = self.cells(attributes)
+        index = cells['index'].get(tuple(context[attribute] for attribute in attributes))
+        if index is None:
+            return None
+        return float(cells['counts'][index]) if name == COUNT else float(cells['sums'][name][index])
+
+    def cells(self, attributes):
+        # Group the rows selected by the slicer by the attributes (once per combination of attributes)
+        cells = self.cell_cache.get(attributes)
+        if cells is None:
+            start = time.perf_counter()
+            codes, sums, counts = group([self.rows_codes[attribute] for attribute in attributes],
+                                        [self.cube.cardinalities[attribute] for attribute in attributes],
+                                        self.rows_measures, self.rows_counts)
+            index = {key: position for position, key in enumerate(zip(*[column.tolist() for column in codes]))} \
+                if attributes else ({(): 0} if len(counts) else {})
+            cells = self.cell_cache[attributes] = {'index': index, 'sums': sums, 'counts': counts}
+            self.scans.append((attributes, self.selected_rows, len(counts),
+                               time.perf_counter() - start))
+        return cells
+
+    def apply_slicer(self, slicer):
+        # Combine the bitmaps of the slicer: members of a tuple with AND, tuples of a set with OR
+        rows = self.cube.fact_rows
+        if slicer is None:
+            mask = np.ones(rows, dtype=bool)
+        else:
+            selected = None
+            for item in self.tuples(slicer, {}):
+                bits = np.full((rows + 7) // 8, 0xFF, dtype=np.uint8)
+                for attribute, code in item:
+                    if attribute == 'Measures':
+                        self.default_measure = code
+                        if code in MEASURES:
+                            self.used_measures.add(code)
+                    elif code != ALL:
+                        bits &= self.bitmaps[attribute][code]
+                selected = bits if selected is None else selected | bits
+            mask = np.unpackbits(selected, count=rows).astype(bool)
+        # Only the attributes and the measures used by the query are kept
+        self.rows_codes = {name: codes[mask] for name, codes in self.cube.fact_codes.items()
+                           if name in self.used_attributes}
+        self.rows_measures = {name: self.cube.fact_measures[name][mask] for name in self.used_measures}
+        self.rows_counts = self.cube.fact_counts[mask] if self.cube.fact_counts is not None else None
+        return int(mask.sum())
+
+    def references(self):
+        # Attributes and stored measures referenced anywhere in the query
+        attributes, measures = set(), {self.default_measure}
+        nodes = list(self.query.members.values()) + list(self.query.sets.values()) + \
+            [expression for _, _, expression in self.query.axes] + [self.query.slicer] * (self.query.slicer is not None)
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, (Member, Members)):
+                if node.attribute == 'Measures':
+                    if node.name in MEASURES:
+                        measures.add(node.name)
+                else:
+                    attributes.add(node.attribute)
+            nodes.extend(node.children)
+        return attributes, measures
+
+    def execute(self, text):
+        # Run a query; return the column tuples, the row tuples and the cells (rows x columns)
+        self.timings = {}
+        start = time.perf_counter()
+        self.query = Parser(text).query()
+        self.timings['Parse'] = time.perf_counter() - start
+        self.named_sets, self.cell_cache, self.scans = {}, {}, []
+        self.default_measure = DEFAULT_MEASURE
+        self.used_attributes, self.used_measures = self.references()
+
+        start = time.perf_counter()
+        self.selected_rows = self.apply_slicer(self.query.slicer)
+        self.timings['Slicer (bitmaps)'] = time.perf_counter() - start
+
+        context = {'Measures': self.default_measure}
+        start = time.perf_counter()
+        for name, expression in self.query.sets.items():
+            self.named_sets[name] = self.tuples(expression, context)
+        self.timings['Named sets'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        axes = {}
+        for axis, non_empty, expression in self.query.axes:
+            axes[axis] = (non_empty, self.tuples(expression, context))
+        columns = axes.get('COLUMNS', (False, [()]))[1]
+        rows = axes.get('ROWS', (False, [()]))[1]
+        cells = [[self.value_at(None, context, row + column) for column in columns] for row in rows]
+        # NON EMPTY removes the rows (or columns) whose cells are all empty
+        if axes.get('ROWS', (False,))[0]:
+            kept = [index for index, values in enumerate(cells) if any(value is not None for value in values)]
+            rows, cells = [rows[index] for index in kept], [cells[index] for index in kept]
+        if axes.get('COLUMNS', (False,))[0] and cells:
+            kept = [index for index in range(len(columns)) if any(values[index] is not None for values in cells)]
+            columns, cells = [columns[index] for index in kept], [[values[index] for index in kept] for values in cells]
+        self.timings['Axes and cells'] = time.perf_counter() - start
+        return columns, rows, cells
+
+    def explain(self):
+        # Return the query plan with the statistics of every operator
+        lines = [f"Bitmap index: {sum(len(bitmaps) for bitmaps in self.bitmaps.values())} bitmaps of "
+                 f"{self.cube.fact_rows} rows, built in {self.index_seconds * 1000:.2f} ms",
+                 f"Parse: {self.timings['Parse'] * 1000:.2f} ms",
+                 f"Slicer: {self.selected_rows} of {self.cube.fact_rows} rows selected in "
+                 f"{self.timings['Slicer (bitmaps)'] * 1000:.2f} ms"]
+
+        def walk(node, depth):
+            lines.append(f"{'  ' * depth}{node.label:<50} calls {node.calls:>6}  out {node.output:>7}  "
+                         f"{node.seconds * 1000:>9.2f} ms")
+            for child in node.children:
+                walk(child, depth + 1)
+
+        # Calculated members are shown once; their statistics add up every place they are used
+        for name, expression in self.query.members.items():
+            lines.append(f"Calculated member [Measures].[{name}]:")
+            walk(expression, 1)
+        for name, expression in self.query.sets.items():
+            lines.append(f"Named set [{name}] ({self.timings['Named sets'] * 1000:.2f} ms for all sets):")
+            walk(expression, 1)
+        for axis, non_empty, expression in self.query.axes:
+            lines.append(f"Axis {axis}{' (NON EMPTY)' if non_empty else ''}:")
+            walk(expression, 1)
+        lines.append(f"Axes and cells: {self.timings['Axes and cells'] * 1000:.2f} ms")
+        for attributes, rows, groups, seconds in self.scans:
+            lines.append(f"Aggregate by {' x '.join(attributes) or '(all)'}: {rows} rows -> {groups} cells "
+                         f"in {seconds * 1000:.2f} ms")
+        return '\n'.join(lines)
+
+def format_tuple(executor, item):
+    return ', '.join(executor.member_name(attribute, code) for attribute, code in item) or '(all)'
+
+def print_result(executor, columns, rows, cells):
+    headers = [format_tuple(executor, column) for column in columns]
+    print(f"  {'':<50} " + ' '.join(f'{header:>20}' for header in headers))
+    for row, values in zip(rows, cells):
+        print(f"  {format_tuple(executor, row):<50} " +
+              ' '.join(f"{'(empty)' if value is None else format(value, ',.2f'):>20}" for value in values))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run MDX queries on the star schema tables.')
+    parser.add_argument('files', nargs='*', help='MDX files (default: the queries of the data cube project)')
+    parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the CSV tables')
+    parser.add_argument('--columnar', action='store_true', help='read the fact table from its columnar copy')
+    parser.add_argument('--scale-rows', type=int, help='sample the fact table up to this many rows (benchmark)')
+    parser.add_argument('--explain', action='store_true', help='print the query plan with the time of every operator')
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.enable_from_args(args, 'mdx_executor')
+
+    cube = Cube.from_tables(args.tables_dir, columnar=args.columnar)
+    if args.scale_rows:
+        cube = scale_cube(cube, args.scale_rows)
+    executor = Executor(cube)
+    for file_name in args.files or sorted(glob.glob(os.path.join(MDX_DIR, '*.mdx'))):
+        with open(file_name, 'r', encoding='utf-8-sig') as mdx_file:
+            text = mdx_file.read()
+        start = time.perf_counter()
+        with metrics.span(os.path.basename(file_name)):
+            columns, rows, cells = executor.execute(text)
+        elapsed = time.perf_counter() - start
+        metrics.observe('query_seconds', elapsed)
+        print(f"\n{os.path.basename(file_name)}: {len(rows)} rows in {elapsed * 1000:.2f} ms")
+        print_result(executor, columns, rows, cells)
+        if args.explain:
+            print('\nQuery plan:\n' + executor.explain())
@@ -0,0 +1,250 @@
+import atexit  # Import atexit to write the reports when the script ends
+import json  # Import json to write the run report
+import os  # Import os for the process id and path handling
+import re  # Import re to turn metric names into Prometheus names
+import sys  # Import sys to record the command line
+import threading  # Import threading for the per-thread span stacks and the lock
+import time  # Import time for the wall-clock and CPU clocks
+from bisect import bisect_left  # Import bisect_left to find the bucket of an observation
+
+try:
+    import resource  # Peak RSS on Linux and macOS
+except ImportError:  # Windows
+    resource = None
+
+# Metrics of a pipeline run: named spans (wall and CPU time, calls, peak RSS when they end), counters
+# (rows read, written, rejected...) and latency histograms (one observation per batch: parsing,
+# executemany, commit...). At the end of the run they are written as a JSON run report and/or as a
+# Prometheus text-format file, e.g. for the node exporter textfile collector.
+#
+# Metrics are off by default, and then span(), count() and observe() are module functions that do nothing:
+# the scripts call them as metrics.span(...) etc., so enable() only has to replace the module functions and
+# a disabled call costs one attribute lookup and an empty call. Spans nest per thread: a span opened inside
+# another one is recorded as 'outer/inner'.
+
+# Upper bounds of the histogram buckets in seconds: 0.1 ms to about 52 s, doubling
+BUCKETS = tuple(0.0001 * 2 ** power for power in range(20))
+PROMETHEUS_PREFIX = 'lds_'
+
+class _NoSpan:
+    # Span used when the metrics are off
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *error):
+        return False
+
+NO_SPAN = _NoSpan()
+
+def _no_span(name):
+    return NO_SPAN
+
+def _no_count(name, value=1, table=None):
+    pass
+
+def _no_observe(name, seconds, table=None):
+    pass
+
+# Module functions called by the scripts, replaced by enable()
+span, count, observe = _no_span, _no_count, _no_observe
+enabled = False
+registry = None
+
+def peak_rss_bytes():
+    # Peak resident set size of the process so far, or None where it cannot be measured
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Bytes on macOS, KB on Linux
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket holding the quantile (the maximum for the +Inf bucket)
+        target, seen = fraction * self.count, 0
+        for bound, bucket in zip(BUCKETS + (self.max,), self.buckets):
+            seen += bucket
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum_seconds': self.sum, 'min_seconds': self.min if self.count else None,
+                'max_seconds': self.max, 'mean_seconds': self.sum / self.count if self.count else None,
+                'p50_seconds': self.quantile(0.5), 'p95_seconds': self.quantile(0.95),
+                'p99_seconds': self.quantile(0.99)}
+
+class Span:
+    __slots__ = ('registry', 'name', 'path', 'wall', 'cpu')
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        stack = self.registry.stack()
+        self.path = f'{stack[-1]}/{self.name}' if stack else self.name
+        stack.append(self.path)
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *error):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        self.registry.stack().pop()
+        self.registry.record_span(self.path, wall, cpu)
+        return False
+
+class Registry:
+    def __init__(self, job):
+        self.job = job
+        self.started = time.time()
+        self.start_wall = time.perf_counter()
+        self.spans = {}  # Path -> [calls, wall seconds, CPU seconds, peak RSS at the end]
+        self.counters = {}  # (name, table) -> value
+        self.histograms = {}  # (name, table) -> Histogram
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def span(self, name):
+        return Span(self, name)
+
+    def record_span(self, path, wall, cpu):
+        peak = peak_rss_bytes()
+        with self.lock:
+            entry = self.spans.get(path)
+            if entry is None:
+                entry = self.spans[path] = [0, 0.0, 0.0, None]
+            entry[0] += 1
+            entry[1] += wall
+            entry[2] += cpu
+            entry[3] = peak
+
+    def count(self, name, value=1, table=None):
+        with self.lock:
+            self.counters[name, table] = self.counters.get((name, table), 0) + value
+
+    def observe(self, name, seconds, table=None):
+        with self.lock:
+            histogram = self.histograms.get((name, table))
+            if histogram is None:
+                histogram = self.histograms[name, table] = Histogram()
+            histogram.add(seconds)
+
+    def report(self):
+        # The run report as a dictionary
+        def keyed(items):
+            return {name if table is None else f'{name}[{table}]': value for (name, table), value in items}
+        peak = peak_rss_bytes()
+        return {
+            'job': self.job,
+            'command': sys.argv,
+            'pid': os.getpid(),
+            'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+            'wall_seconds': time.perf_counter() - self.start_wall,
+            'cpu_seconds': time.process_time(),
+            'peak_rss_mb': peak / 1024 / 1024 if peak is not None else None,
+            'spans': {path: {'calls': calls, 'wall_seconds': wall, 'cpu_seconds': cpu,
+                             'peak_rss_mb': rss / 1024 / 1024 if rss is not None else None}
+                      for path, (calls, wall, cpu, rss) in self.spans.items()},
+            'counters': keyed(self.counters.items()),
+            'histograms': keyed((key, histogram.summary()) for key, histogram in self.histograms.items())
+        }
+
+    def prometheus(self):
+        # The metrics in the Prometheus text exposition format
+        def name_of(name):
+            return PROMETHEUS_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+        def labels(**values):
+            values = {key: value for key, value in values.items() if value is not None}
+            return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in values.items()) + '}'
+
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        job = self.job
+        lines = []
+        families = [('span_wall_seconds_total', 'counter', 'Wall-clock time spent in the span', 1),
+                    ('span_cpu_seconds_total', 'counter', 'CPU time of the thread spent in the span', 2),
+                    ('span_calls_total', 'counter', 'Times the span was entered', 0)]
+        for family, kind, description, index in families:
+            lines += [f'# HELP {name_of(family)} {description}', f'# TYPE {name_of(family)} {kind}']
+            lines += [f'{name_of(family)}{labels(job=job, span=path)} {entry[index]}' for path, entry in self.spans.items()]
+        for name in sorted({name for name, _ in self.counters}):
+            metric = name_of(name) + '_total'
+            lines += [f'# TYPE {metric} counter']
+            lines += [f'{metric}{labels(job=job, table=table)} {value}'
+                      for (counter, table), value in self.counters.items() if counter == name]
+        for name in sorted({name for name, _ in self.histograms}):
+            metric = name_of(name)
+            lines += [f'# TYPE {metric} histogram']
+            for (histogram_name, table), histogram in self.histograms.items():
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS + (float('inf'),), histogram.buckets):
+                    cumulative += bucket
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    lines.append(f'{metric}_bucket{labels(job=job, table=table, le=le)} {cumulative}')
+                lines.append(f'{metric}_sum{labels(job=job, table=table)} {histogram.sum}')
+                lines.append(f'{metric}_count{labels(job=job, table=table)} {histogram.count}')
+        peak = peak_rss_bytes()
+        if peak is not None:
+            lines += [f'# TYPE {name_of("peak_rss_bytes")} gauge', f'{name_of("peak_rss_bytes")}{labels(job=job)} {peak}']
+        lines += [f'# TYPE {name_of("run_wall_seconds")} gauge',
+                  f'{name_of("run_wall_seconds")}{labels(job=job)} {time.perf_counter() - self.start_wall}']
+        return '\n'.join(lines) + '\n'
+
+def write_file(path, text):
+    # Write atomically, so a collector never reads half a file
+    with open(path + '.tmp', 'w') as output:
+        output.write(text)
+    os.replace(path + '.tmp', path)
+
+def enable(job, report_file=None, prometheus_file=None):
+    # Turn the metrics on; the reports are written when the script ends
+    global span, count, observe, enabled, registry
+    registry = Registry(job)
+    span, count, observe, enabled = registry.span, registry.count, registry.observe, True
+
+    def write_reports():
+        if report_file:
+            write_file(report_file, json.dumps(registry.report(), indent=2))
+        if prometheus_file:
+            write_file(prometheus_file, registry.prometheus())
+    atexit.register(write_reports)
+    return registry
+
+def add_metrics_arguments(parser):
+    # Add the options turning the metrics on to a command line parser
+    parser.add_argument('--metrics-report', metavar='FILE', help='write a JSON run report with the metrics of the run')
+    parser.add_argument('--metrics-prometheus', metavar='FILE', help='write the metrics in the Prometheus text format')
+
+def enable_from_args(args, job):
+    # Turn the metrics on if a report was requested on the command line
+    if args.metrics_report or args.metrics_prometheus:
+        return enable(job, args.metrics_report, args.metrics_prometheus)
+    return None
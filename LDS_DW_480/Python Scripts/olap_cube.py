@@ -0,0 +1,306 @@
+import argparse  # Import argparse to read the command line options
+import csv  # Import the csv module for reading the dimension tables
+import os  # Import os for path handling
+import time  # Import time to measure the build and the queries
+from itertools import combinations  # Import combinations to enumerate the cuboids of the lattice
+
+import numpy as np  # Import numpy for the encoded columns and the group-bys
+
+import metrics
+from star_schema import FACT_FILE, FACT_TABLE, TABLE_COLUMNS, TABLE_FILES, TABLES_DIR
+
+# In-memory OLAP cube over the star schema tables, modelled on the SSAS 'Group ID 480 Cube' (LDS_DC_480).
+# Every dimension attribute used by the cube is dictionary-encoded on the fact rows, with its members in
+# key order like the SSAS attributes (OrderBy Key). The cube materializes some aggregate cuboids (group-bys
+# on a subset of the attributes, with the sum of every measure and the number of sales), chosen greedily
+# by benefit per byte under a memory budget: a cuboid is worth its size if it is much smaller than the
+# smallest materialized cuboid every query below it would otherwise read (Harinarayan, Rajaraman and
+# Ullman). Queries read the smallest materialized cuboid containing their attributes, or the fact table.
+
+MEMORY_BUDGET = 64 * 1024 * 1024  # Bytes available for the materialized cuboids
+DENSE_GROUPS = 1 << 20  # Largest number of possible groups summed with a dense array instead of a sort
+
+# Attributes of the cube: name -> (dimension table, column of the table, foreign key of the fact table)
+ATTRIBUTES = {
+    'Continent': ('Geography', 'continent', 'geo_id'),
+    'Region': ('Geography', 'region', 'geo_id'),
+    'Year': ('Time', 'year', 'time_id'),
+    'Month': ('Time', 'month', 'time_id'),
+    'Cpu Brand': ('Cpu', 'cpu_brand', 'cpu_id'),
+    'Gpu Brand': ('Gpu', 'gpu_brand', 'gpu_id'),
+    'Ram Brand': ('Ram', 'ram_brand', 'ram_id')
+}
+
+# Measures of the cube: name -> column of the fact table (all aggregated with SUM, as in the SSAS cube)
+MEASURES = {
+    'Ram Sales': 'ram_sales', 'Ram Sales Usd': 'ram_sales_usd',
+    'Cpu Sales': 'cpu_sales', 'Cpu Sales Usd': 'cpu_sales_usd',
+    'Gpu Sales': 'gpu_sales', 'Gpu Sales Usd': 'gpu_sales_usd',
+    'Total Sales': 'total_sales', 'Total Sales Usd': 'total_sales_usd'
+}
+COUNT = 'Computer Sales Count'
+
+# The three MDX queries of LDS_DC_480/MDX Queries: brand attribute and measure of each
+MDX_QUERIES = {
+    'CPU': ('Cpu Brand', 'Cpu Sales'),
+    'GPU': ('Gpu Brand', 'Gpu Sales'),
+    'RAM': ('Ram Brand', 'Ram Sales')
+}
+
+def read_table(tables_dir, table_name):
+    # Read a dimension table as a list of rows (dictionaries)
+    with open(os.path.join(tables_dir, TABLE_FILES[table_name]), 'r') as table_file:
+        return [row for row in csv.DictReader(table_file)]
+
+def typed(table_name, column, values):
+    # Convert the values of a column to the Python type of its SQL type, so members sort by key
+    sql_type = dict(TABLE_COLUMNS[table_name])[column]
+    convert = {'INT': int, 'FLOAT': float}.get(sql_type, str)
+    return [convert(value) for value in values]
+
+def pack(codes, cardinalities):
+    # Combine the codes of several attributes into a single integer key
+    key = np.zeros(len(codes[0]) if codes else 1, dtype=np.int64)
+    for column, cardinality in zip(codes, cardinalities):
+        key *= cardinality
+        key += column
+    return key
+
+def group(codes, cardinalities, measures, counts, mask=None):
+    # Group rows by the given attribute codes, summing the measures and the counts.
+    # Returns (codes of each group, sums per measure, counts); with no attributes, a single group.
+    if mask is not None:
+        codes = [column[mask] for column in codes]
+        measures = {name: values[mask] for name, values in measures.items()}
+        counts = counts[mask] if counts is not None else None
+    size = len(next(iter(measures.values())))
+    space = int(np.prod(cardinalities, dtype=np.float64)) if codes else 1
+    if space <= DENSE_GROUPS:
+        # Few possible groups: sum straight into an array indexed by the key, without sorting the rows
+        inverse = pack(codes, cardinalities) if codes else np.zeros(size, dtype=np.int64)
+        row_counts = np.bincount(inverse, weights=counts, minlength=space)
+        keys = np.flatnonzero(np.bincount(inverse, minlength=space))
+        sums = {name: np.bincount(inverse, weights=values, minlength=space)[keys] for name, values in measures.items()}
+        group_counts = row_counts[keys].astype(np.int64)
+    else:
+        keys, inverse = np.unique(pack(codes, cardinalities), return_inverse=True)
+        sums = {name: np.bincount(inverse, weights=values, minlength=len(keys)) for name, values in measures.items()}
+        group_counts = np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+    # Unpack the group keys back into attribute codes
+    group_codes = []
+    for cardinality in reversed(cardinalities):
+        group_codes.append((keys % cardinality).astype(np.int32))
+        keys = keys // cardinality
+    return group_codes[::-1], sums, group_counts
+
+class Cuboid:
+    # Materialized group-by on a set of attributes
+    def __init__(self, attributes, codes, sums, counts):
+        self.attributes = attributes
+        self.codes = dict(zip(attributes, codes))
+        self.sums = sums
+        self.counts = counts
+        self.size = len(counts)
+
+    def nbytes(self):
+        return sum(array.nbytes for array in self.codes.values()) + \
+            sum(array.nbytes for array in self.sums.values()) + self.counts.nbytes
+
+class Cube:
+    def __init__(self, fact_codes, fact_measures, members, memory_budget=MEMORY_BUDGET, fact_counts=None):
+        # fact_codes: attribute -> code of every fact row; fact_measures: measure -> values of every fact row;
+        # members: attribute -> array of the members in key order (the code is the position);
+        # fact_counts: number of sales of every row when the rows are already aggregates (None: one each)
+        self.fact_codes = fact_codes
+        self.fact_measures = fact_measures
+        self.fact_counts = fact_counts
+        self.members = members
+        self.cardinalities = {name: len(values) for name, values in members.items()}
+        self.fact_rows = len(next(iter(fact_measures.values())))
+        self.memory_budget = memory_budget
+        self.cuboids = {}  # frozenset of attributes -> Cuboid
+        self.last_source = None  # Cuboid (or 'fact table') read by the last query
+
+    @classmethod
+    def from_tables(cls, tables_dir=TABLES_DIR, memory_budget=MEMORY_BUDGET, columnar=False):
+        # Build the cube from the CSV tables, or from the columnar copy of the fact table
+        fact_columns = sorted({foreign_key for _, _, foreign_key in ATTRIBUTES.values()}) + list(MEASURES.values())
+        if columnar:
+            from columnar import ColumnarTable, columnar_dir
+            table = ColumnarTable(os.path.join(columnar_dir(tables_dir), FACT_TABLE))
+            fact = {name: np.asarray(table.column(name)) for name in fact_columns}
+        else:
+            with open(os.path.join(tables_dir, FACT_FILE), 'r') as fact_file:
+                reader = csv.reader(fact_file)
+                header = next(reader)
+                positions = [header.index(name) for name in fact_columns]
+                columns = list(zip(*([row[position] for position in positions] for row in reader if row)))
+            types = dict(TABLE_COLUMNS[FACT_TABLE])
+            fact = {name: np.array(values, dtype=np.int64 if types[name] == 'INT' else np.float64)
+                    for name, values in zip(fact_columns, columns)}
+
+        fact_codes, members, tables = {}, {}, {}
+        for name, (table_name, column, foreign_key) in ATTRIBUTES.items():
+            if table_name not in tables:
+                tables[table_name] = read_table(tables_dir, table_name)
+            rows = tables[table_name]
+            id_column = TABLE_COLUMNS[table_name][0][0]
+            ids = np.array([int(row[id_column]) for row in rows], dtype=np.int64)
+            members[name], code_of_row = np.unique(np.array(typed(table_name, column, [row[column] for row in rows])),
+                                                   return_inverse=True)
+            # Join the fact rows to the dimension rows through the sorted ids
+            order = np.argsort(ids)
+            fact_codes[name] = code_of_row[order[np.searchsorted(ids[order], fact[foreign_key])]].astype(np.int32)
+        return cls(fact_codes, {name: fact[column] for name, column in MEASURES.items()}, members, memory_budget)
+
+    def estimate_sizes(self):
+        # Exact number of groups of every cuboid of the lattice, derived from the base cuboid (all attributes)
+        attributes = tuple(ATTRIBUTES)
+        base_codes, _, _ = group([self.fact_codes[name] for name in attributes],
+                                 [self.cardinalities[name] for name in attributes], {'rows': np.zeros(self.fact_rows)}, None)
+        sizes = {}
+        for count in range(len(attributes) + 1):
+            for subset in combinations(range(len(attributes)), count):
+                if subset:
+                    keys = pack([base_codes[index] for index in subset],
+                                [self.cardinalities[attributes[index]] for index in subset])
+                    sizes[frozenset(attributes[index] for index in subset)] = len(np.unique(keys))
+                else:
+                    sizes[frozenset()] = 1
+        return sizes
+
+    def select_cuboids(self, sizes):
+        # Greedy selection: repeatedly pick the cuboid with the highest benefit per byte that fits the budget.
+        # The benefit of a cuboid is the number of rows saved, summed over every cuboid it can answer, compared
+        # to the smallest source they currently have (the fact table at the start).
+        row_bytes = {cuboid: 4 * len(cuboid) + 8 * (len(MEASURES) + 1) for cuboid in sizes}
+        cost = {cuboid: self.fact_rows for cuboid in sizes}  # Rows read to answer each cuboid
+        selected, used = [], 0
+        while True:
+            best, best_ratio = None, 0.0
+            for candidate, size in sizes.items():
+                if candidate in selected or used + size * row_bytes[candidate] > self.memory_budget:
+                    continue
+                benefit = sum(cost[other] - size for other in sizes if other <= candidate and cost[other] > size)
+                ratio = benefit / (size * row_bytes[candidate])
+                if ratio > best_ratio:
+                    best, best_ratio = candidate, ratio
+            if best is None:
+                return selected
+            selected.append(best)
+            used += sizes[best] * row_bytes[best]
+            for other in sizes:
+                if other <= best:
+                    cost[other] = min(cost[other], sizes[best])
+
+    def materialize(self, attribute_sets=None):
+        # Materialize the given cuboids, or the ones chosen under the memory budget; each one is computed from
+        # the smallest cuboid already materialized that contains it
+        if attribute_sets is None:
+            attribute_sets = self.select_cuboids(self.estimate_sizes())
+        for attributes in sorted(attribute_sets, key=len, reverse=True):
+            attributes = tuple(name for name in ATTRIBUTES if name in attributes)
+            codes, sums, counts = self.aggregate(attributes)
+            self.cuboids[frozenset(attributes)] = Cuboid(attributes, codes, sums, counts)
+        return list(self.cuboids.values())
+
+    def source_for(self, attributes):
+        # Smallest materialized cuboid containing all the attributes, or None for the fact table
+        candidates = [cuboid for key, cuboid in self.cuboids.items() if key >= attributes]
+        return min(candidates, key=lambda cuboid: cuboid.size) if candidates else None
+
+    def aggregate(self, group_by, filters=None, measures=None):
+        # Slice, dice and roll up: group by 'group_by' the rows whose attributes are in 'filters'
+        # (attribute -> allowed members). Returns (codes per attribute, sums per measure, counts).
+        filters = filters or {}
+        measures = measures or list(MEASURES)
+        source = self.source_for(frozenset(group_by) | frozenset(filters))
+        if source is None:
+            self.last_source = 'fact table'
+            codes, values, counts = self.fact_codes, self.fact_measures, self.fact_counts
+        else:
+            self.last_source = source
+            codes, values, counts = source.codes, source.sums, source.counts
+        mask = None
+        for name, allowed in filters.items():
+            matches = np.isin(codes[name], np.flatnonzero(np.isin(self.members[name], allowed)))
+            mask = matches if mask is None else mask & matches
+        return group([codes[name] for name in group_by], [self.cardinalities[name] for name in group_by],
+                     {name: values[name] for name in measures}, counts, mask)
+
+    def average_over_months(self, group_by, filters, measure):
+        # AVG([Time].[Month].MEMBERS, measure) for every group: the members of [Time].[Month] include its
+        # All member, and empty months are skipped, so the average is (total + sum of the months) / (1 + months)
+        codes, sums, counts = self.aggregate(list(group_by) + ['Month'], filters, [measure])
+        groups, group_sums, _ = group(codes[:-1], [self.cardinalities[name] for name in group_by],
+                                      {measure: sums[measure], 'months': (counts > 0).astype(np.float64)}, None)
+        averages = 2 * group_sums[measure] / (1 + group_sums['months'])
+        return groups, averages
+
+    def top_brands_by_region(self, brand, measure, continent='Europe', count=5):
+        # The MDX queries: the 'count' brands with the highest average monthly sales in the continent, then
+        # each of them on every region of the continent (the All region first, as in SSAS)
+        filters = {'Continent': np.array([continent])}
+        (brand_codes,), averages = self.average_over_months([brand], filters, measure)
+        top = np.argsort(-averages, kind='stable')[:count]  # TOPCOUNT keeps the order of ties
+        filters[brand] = self.members[brand][brand_codes[top]]
+        (region_brands, regions), region_averages = self.average_over_months([brand, 'Region'], filters, measure)
+        rows = []
+        for position in top.tolist():
+            brand_code = brand_codes[position]
+            rows.append((self.members[brand][brand_code], 'All', float(averages[position])))
+            for index in np.flatnonzero(region_brands == brand_code).tolist():
+                rows.append((self.members[brand][brand_code], self.members['Region'][regions[index]],
+                             float(region_averages[index])))
+        return rows
+
+def print_rows(rows):
+    for brand, region, value in rows:
+        print(f"  {str(brand):<28} {str(region):<28} {value:>16,.2f}")
+
+def scale_cube(cube, rows, seed=0):
+    # Cube over 'rows' fact rows sampled from the given cube, to benchmark large fact tables
+    sample = np.random.default_rng(seed).integers(0, cube.fact_rows, rows)
+    return Cube({name: codes[sample] for name, codes in cube.fact_codes.items()},
+                {name: values[sample] for name, values in cube.fact_measures.items()}, cube.members, cube.memory_budget,
+                cube.fact_counts[sample] if cube.fact_counts is not None else None)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answer the MDX queries of the cube from materialized aggregates.')
+    parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the CSV tables')
+    parser.add_argument('--columnar', action='store_true', help='read the fact table from its columnar copy')
+    parser.add_argument('--memory-mb', type=float, default=MEMORY_BUDGET / 1024 / 1024,
+                        help='memory available for the materialized cuboids')
+    parser.add_argument('--scale-rows', type=int, help='sample the fact table up to this many rows (benchmark)')
+    parser.add_argument('--no-cuboids', action='store_true', help='answer every query from the fact table')
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.enable_from_args(args, 'olap_cube')
+
+    start = time.perf_counter()
+    with metrics.span('load'):
+        cube = Cube.from_tables(args.tables_dir, int(args.memory_mb * 1024 * 1024), args.columnar)
+    if args.scale_rows:
+        cube = scale_cube(cube, args.scale_rows)
+    print(f"Fact table: {cube.fact_rows} rows loaded in {time.perf_counter() - start:.2f} s")
+
+    if not args.no_cuboids:
+        start = time.perf_counter()
+        with metrics.span('materialize'):
+            cuboids = cube.materialize()
+        print(f"{len(cuboids)} cuboids materialized in {time.perf_counter() - start:.2f} s, "
+              f"{sum(cuboid.nbytes() for cuboid in cuboids) / 1024:,.0f} KB:")
+        for cuboid in sorted(cuboids, key=lambda cuboid: -cuboid.size):
+            print(f"  {' x '.join(cuboid.attributes) or '(all)':<60} {cuboid.size:>10} rows")
+
+    for query, (brand, measure) in MDX_QUERIES.items():
+        start = time.perf_counter()
+        with metrics.span(f'MDXQuery{query}'):
+            rows = cube.top_brands_by_region(brand, measure)
+        elapsed = time.perf_counter() - start
+        metrics.observe('query_seconds', elapsed)
+        source = cube.last_source
+        source = source if isinstance(source, str) else ' x '.join(source.attributes)
+        print(f"\nMDXQuery{query}: top 5 {brand} by average monthly {measure} in Europe "
+              f"({elapsed * 1000:.2f} ms, read from {source})")
+        print_rows(rows)
@@ -0,0 +1,167 @@
+import argparse  # Import argparse to read the command line options
+import os  # Import os for path handling
+import queue  # Import queue to hold the idle connections of the pool
+import threading  # Import threading to protect the shared counters
+import time  # Import time to measure the throughput
+from concurrent.futures import ThreadPoolExecutor  # Import the thread pool running the loads
+from contextlib import contextmanager  # Import contextmanager to borrow connections with a 'with' block
+
+import metrics
+from csv_chunks import chunk_ranges, iter_csv_range, read_header
+from db_backends import add_backend_arguments, backend_from_args
+from star_schema import FACT_TABLE, TABLE_COLUMNS, TABLE_FILES, TABLES_DIR, column_converters, convert_row
+from upsert import forget_hashes
+
+# Parallel loader: a small pool of database connections loads the five dimension tables concurrently, then
+# splits the fact table into ranges of rows and inserts each range on its own connection. The fact table is
+# only loaded once every dimension is committed, so foreign keys are always satisfied. Most of the time of
+# a load is spent waiting on the network, so threads are enough to keep several connections busy.
+
+BATCH_SIZE = 1000  # Rows sent with each executemany
+
+class ConnectionPool:
+    # Fixed-size pool of connections; a connection is used by a single thread at a time
+    def __init__(self, connect, size):
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(connect())
+        self.size = size
+
+    @contextmanager
+    def connection(self):
+        # Borrow a connection, giving it back when the block ends
+        cnxn = self.connections.get()
+        try:
+            yield cnxn
+        finally:
+            self.connections.put(cnxn)
+
+    def close(self):
+        for _ in range(self.size):
+            self.connections.get().close()
+
+def create_tables(backend, pool, table_names):
+    # Create the missing tables on one connection, dimensions first because of the foreign keys
+    with pool.connection() as cnxn:
+        cursor = cnxn.cursor()
+        for table_name in table_names:
+            if not backend.table_exists(cursor, table_name):
+                print(f"Table '{table_name}' does not exist. Creating it...")
+                backend.create_table(cursor, table_name)
+        cnxn.commit()
+
+def forget_table_hashes(backend, pool, table_names):
+    # Drop the row hashes of loadData.py --upsert for the tables about to be loaded by other means
+    with pool.connection() as cnxn:
+        cursor = cnxn.cursor()
+        for table_name in table_names:
+            forget_hashes(backend, cursor, table_name)
+        cnxn.commit()
+
+def insert_rows(backend, pool, table_name, rows, batch_size=BATCH_SIZE):
+    # Insert the rows on a connection of the pool and commit them; return the number of rows and the first
+    # and last primary key seen
+    columns = [name for name, _ in TABLE_COLUMNS[table_name]]
+    converters = column_converters(table_name, columns)
+    row_count, first_id, last_id = 0, None, None
+    with pool.connection() as cnxn:
+        cursor = cnxn.cursor()
+        insert_query = backend.prepare_insert(cursor, table_name, columns)
+        batch = []
+        for row in rows:
+            batch.append(convert_row(converters, row))
+            if len(batch) == batch_size:
+                batch_start = time.perf_counter()
+                backend.insert_rows(cursor, insert_query, batch)
+                metrics.observe('executemany_seconds', time.perf_counter() - batch_start, table_name)
+                row_count += len(batch)
+                first_id = batch[0][0] if first_id is None else first_id
+                last_id = batch[-1][0]
+                batch = []
+        if batch:
+            batch_start = time.perf_counter()
+            backend.insert_rows(cursor, insert_query, batch)
+            metrics.observe('executemany_seconds', time.perf_counter() - batch_start, table_name)
+            row_count += len(batch)
+            first_id = batch[0][0] if first_id is None else first_id
+            last_id = batch[-1][0]
+        commit_start = time.perf_counter()
+        cnxn.commit()
+        metrics.observe('commit_seconds', time.perf_counter() - commit_start, table_name)
+    metrics.count('rows_inserted', row_count, table_name)
+    return row_count, first_id, last_id
+
+def load_range(backend, pool, table_name, file_name, begin, end, batch_size=BATCH_SIZE):
+    # Load one byte range of a CSV file, timing it
+    start = time.perf_counter()
+    row_count, first_id, last_id = insert_rows(backend, pool, table_name, iter_csv_range(file_name, begin, end), batch_size)
+    return table_name, row_count, first_id, last_id, time.perf_counter() - start
+
+def print_throughput(name, row_count, elapsed):
+    print(f"  {name:<28} {row_count:>10} rows {elapsed:>8.2f} s {row_count / elapsed if elapsed else 0:>12,.0f} rows/s")
+
+def parallel_load(backend, tables_dir=TABLES_DIR, connections=4, fact_partitions=None, batch_size=BATCH_SIZE):
+    # Load the dimension tables concurrently, then the fact table split into ranges; return the statistics
+    fact_partitions = fact_partitions or connections
+    files = {table_name: os.path.join(tables_dir, file_name) for table_name, file_name in TABLE_FILES.items()}
+    dimensions = [table_name for table_name in files if table_name != FACT_TABLE]
+    stats = {}
+    stats_lock = threading.Lock()
+
+    def record(result):
+        table_name, row_count, _, _, elapsed = result
+        with stats_lock:
+            rows, seconds = stats.get(table_name, (0, 0.0))
+            # Ranges of the same table run concurrently: its time is the one of the slowest range
+            stats[table_name] = (rows + row_count, max(seconds, elapsed))
+
+    pool = ConnectionPool(backend.connect, connections)
+    total_start = time.perf_counter()
+    try:
+        with metrics.span('create tables'):
+            create_tables(backend, pool, dimensions + [FACT_TABLE])
+            forget_table_hashes(backend, pool, dimensions + [FACT_TABLE])
+
+        # The dimension tables are independent: load them all at once
+        print(f"Loading {len(dimensions)} dimension tables on {connections} connections...")
+        with ThreadPoolExecutor(connections) as executor:
+            tasks = []
+            for table_name in dimensions:
+                _, data_start = read_header(files[table_name])
+                tasks.append(executor.submit(load_range, backend, pool, table_name, files[table_name], data_start,
+                                             os.path.getsize(files[table_name]), batch_size))
+            for task in tasks:
+                record(task.result())
+
+        # Every dimension is committed: the fact table can be loaded, one range of sale ids per connection
+        ranges = chunk_ranges(files[FACT_TABLE], fact_partitions)
+        print(f"Loading '{FACT_TABLE}' in {len(ranges)} ranges...")
+        with ThreadPoolExecutor(connections) as executor:
+            tasks = [executor.submit(load_range, backend, pool, FACT_TABLE, files[FACT_TABLE], begin, end, batch_size)
+                     for begin, end in ranges]
+            for index, task in enumerate(tasks):
+                result = task.result()
+                record(result)
+                print(f"  range {index}: sale_id {result[2]} to {result[3]}, {result[1]} rows in {result[4]:.2f} s")
+    finally:
+        pool.close()
+    total_time = time.perf_counter() - total_start
+
+    print("\nThroughput:")
+    for table_name, (row_count, elapsed) in stats.items():
+        print_throughput(table_name, row_count, elapsed)
+    print_throughput('Total', sum(rows for rows, _ in stats.values()), total_time)
+    return stats, total_time
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load the star schema tables with a pool of concurrent connections.')
+    parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the CSV tables')
+    parser.add_argument('--connections', type=int, default=4, help='size of the connection pool')
+    parser.add_argument('--fact-partitions', type=int, help='number of ranges of the fact table (default: one per connection)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='rows sent with each executemany')
+    add_backend_arguments(parser)
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.enable_from_args(args, 'parallel_load')
+
+    parallel_load(backend_from_args(args), args.tables_dir, args.connections, args.fact_partitions, args.batch_size)
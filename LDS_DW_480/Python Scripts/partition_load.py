@@ -0,0 +1,176 @@
+import argparse  # Import argparse to read the command line options
+import os  # Import os for path handling
+import time  # Import time to measure the throughput
+from concurrent.futures import ThreadPoolExecutor  # Import the thread pool running the loads
+
+import metrics
+from csv_chunks import iter_csv_range, read_header
+from db_backends import add_backend_arguments, backend_from_args
+from fact_partitions import (PARTITIONS_DIR, ensure_partition_stats, file_checksum, load_manifest,
+                             partition_range)
+from parallel_load import BATCH_SIZE, ConnectionPool, create_tables, forget_table_hashes, load_range, print_throughput
+from star_schema import FACT_TABLE, TABLE_FILES, TABLES_DIR, column_converters, convert_row
+from upsert import forget_hashes
+
+# Partition-parallel load of the fact table written by fact_partitions.py. Every partition is loaded on its
+# own connection of a pool, in a single transaction that deletes the rows of its time_id range and inserts
+# the partition file, so a partition is replaced atomically in the database: a failed load leaves the
+# previous content of the partition. A journal table records the checksum of every loaded partition (in the
+# same transaction), so the partitions whose checksum has not changed since their last load are skipped and a
+# reprocessed partition only costs its own rows.
+
+PARTITION_TABLE = 'Partition_loads'
+
+def create_journal(backend, cursor):
+    if not backend.table_exists(cursor, PARTITION_TABLE):
+        cursor.execute(f"""CREATE TABLE {PARTITION_TABLE} (
+    partition_name VARCHAR(32) PRIMARY KEY,
+    first_time_id INT,
+    last_time_id INT,
+    checksum VARCHAR(64),
+    row_count BIGINT,
+    min_sale_id BIGINT,
+    max_sale_id BIGINT
+)""")
+
+def read_journal(cursor):
+    # Partition name -> (first time_id, last time_id, checksum) of the loaded partitions
+    cursor.execute(f"SELECT partition_name, first_time_id, last_time_id, checksum FROM {PARTITION_TABLE}")
+    return {row[0]: (row[1], row[2], row[3]) for row in cursor.fetchall()}
+
+def load_partition(backend, pool, partitions_dir, name, entry, time_range, batch_size=BATCH_SIZE):
+    # Replace the rows of one partition in a single transaction, together with its journal row
+    path = os.path.join(partitions_dir, entry['file'])
+    header, data_start = read_header(path)
+    converters = column_converters(FACT_TABLE, header)
+    start = time.perf_counter()
+    row_count = 0
+    with pool.connection() as cnxn:
+        cursor = cnxn.cursor()
+        try:
+            cursor.execute(f"DELETE FROM {FACT_TABLE} WHERE time_id BETWEEN ? AND ?", time_range)
+            insert_query = backend.prepare_insert(cursor, FACT_TABLE, header)
+            batch = []
+            # Only the committed bytes: a load of fact_partitions.py may be appending past them
+            for row in iter_csv_range(path, data_start, entry['bytes']):
+                batch.append(convert_row(converters, row))
+                if len(batch) == batch_size:
+                    batch_start = time.perf_counter()
+                    backend.insert_rows(cursor, insert_query, batch)
+                    metrics.observe('executemany_seconds', time.perf_counter() - batch_start, FACT_TABLE)
+                    row_count += len(batch)
+                    batch = []
+            if batch:
+                backend.insert_rows(cursor, insert_query, batch)
+                row_count += len(batch)
+            if row_count != entry['rows']:
+                raise ValueError(f"Partition {name}: {row_count} rows read, the manifest records {entry['rows']}")
+            cursor.execute(f"DELETE FROM {PARTITION_TABLE} WHERE partition_name = ?", (name,))
+            cursor.execute(f"INSERT INTO {PARTITION_TABLE} (partition_name, first_time_id, last_time_id, checksum, "
+                           "row_count, min_sale_id, max_sale_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (name, *time_range, entry['checksum'], row_count, entry['min_sale_id'], entry['max_sale_id']))
+            commit_start = time.perf_counter()
+            cnxn.commit()
+            metrics.observe('commit_seconds', time.perf_counter() - commit_start, FACT_TABLE)
+        except Exception:
+            cnxn.rollback()
+            raise
+    metrics.count('rows_inserted', row_count, FACT_TABLE)
+    return name, row_count, time.perf_counter() - start
+
+def partition_load(backend, partitions_dir=PARTITIONS_DIR, tables_dir=TABLES_DIR, connections=4, dimensions=False,
+                   force=False, verify=False, batch_size=BATCH_SIZE):
+    # Load the changed partitions of the fact table (every partition with 'force'); with 'dimensions' the
+    # dimension tables are loaded first. Returns (partitions loaded, partitions skipped, rows loaded).
+    manifest = load_manifest(partitions_dir)
+    if manifest is None:
+        raise FileNotFoundError(f'No partition manifest in {partitions_dir}; run fact_partitions.py first')
+    ensure_partition_stats(partitions_dir, manifest)
+    if verify:
+        # Check the files against the manifest before loading anything
+        for name, entry in manifest['partitions'].items():
+            if file_checksum(os.path.join(partitions_dir, entry['file']), entry['bytes']) != entry['checksum']:
+                raise ValueError(f"Partition {name}: '{entry['file']}' does not match its checksum")
+
+    pool = ConnectionPool(backend.connect, connections)
+    total_start = time.perf_counter()
+    try:
+        dimension_tables = [table_name for table_name in TABLE_FILES if table_name != FACT_TABLE]
+        with metrics.span('create tables'):
+            create_tables(backend, pool, dimension_tables + [FACT_TABLE])
+        with pool.connection() as cnxn:
+            cursor = cnxn.cursor()
+            create_journal(backend, cursor)
+            cnxn.commit()
+
+        if dimensions:
+            print(f"Loading {len(dimension_tables)} dimension tables on {connections} connections...")
+            forget_table_hashes(backend, pool, dimension_tables)
+            with metrics.span('dimensions'), ThreadPoolExecutor(connections) as executor:
+                tasks = []
+                for table_name in dimension_tables:
+                    path = os.path.join(tables_dir, TABLE_FILES[table_name])
+                    tasks.append(executor.submit(load_range, backend, pool, table_name, path, read_header(path)[1],
+                                                 os.path.getsize(path), batch_size))
+                for task in tasks:
+                    table_name, row_count, _, _, elapsed = task.result()
+                    print_throughput(table_name, row_count, elapsed)
+
+        with pool.connection() as cnxn:
+            cursor = cnxn.cursor()
+            journal = read_journal(cursor)
+            # Partitions of an earlier layout (e.g. by year before a rebuild by month) are dropped first, so
+            # their rows outside the new partitions do not survive
+            for name, (first_time_id, last_time_id, _) in journal.items():
+                if name not in manifest['partitions']:
+                    print(f"Dropping partition {name}, no longer in the manifest...")
+                    cursor.execute(f"DELETE FROM {FACT_TABLE} WHERE time_id BETWEEN ? AND ?",
+                                   (first_time_id, last_time_id))
+                    cursor.execute(f"DELETE FROM {PARTITION_TABLE} WHERE partition_name = ?", (name,))
+                    forget_hashes(backend, cursor, FACT_TABLE)  # Row hashes of loadData.py --upsert
+            cnxn.commit()
+
+        pending, skipped = [], []
+        for name, entry in sorted(manifest['partitions'].items()):
+            loaded = journal.get(name)
+            if not force and loaded is not None and loaded[2] == entry['checksum']:
+                skipped.append(name)
+            else:
+                pending.append(name)
+        if pending:
+            # Once, before the loads: a delete of the same rows in every partition transaction would serialize them
+            forget_table_hashes(backend, pool, [FACT_TABLE])
+        print(f"Loading {len(pending)} of {len(manifest['partitions'])} partitions of '{FACT_TABLE}' "
+              f"on {connections} connections ({len(skipped)} unchanged)...")
+        rows_loaded = 0
+        with metrics.span('partitions'), ThreadPoolExecutor(connections) as executor:
+            tasks = [executor.submit(load_partition, backend, pool, partitions_dir, name, manifest['partitions'][name],
+                                     partition_range(name, manifest['granularity']), batch_size)
+                     for name in pending]
+            for task in tasks:
+                name, row_count, elapsed = task.result()
+                rows_loaded += row_count
+                print_throughput(f'partition {name}', row_count, elapsed)
+        metrics.count('partitions_loaded', len(pending))
+        metrics.count('partitions_skipped', len(skipped))
+    finally:
+        pool.close()
+    print_throughput('Total', rows_loaded, time.perf_counter() - total_start)
+    return pending, skipped, rows_loaded
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load the partitions of the fact table in parallel, skipping the unchanged ones.')
+    parser.add_argument('--partitions-dir', default=PARTITIONS_DIR, help='folder of the partitions and the manifest')
+    parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the dimension tables (with --dimensions)')
+    parser.add_argument('--connections', type=int, default=4, help='size of the connection pool')
+    parser.add_argument('--dimensions', action='store_true', help="load the dimension tables first (into empty tables)")
+    parser.add_argument('--force', action='store_true', help='load every partition, even the unchanged ones')
+    parser.add_argument('--verify', action='store_true', help='check the checksums of the partition files first')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='rows sent with each executemany')
+    add_backend_arguments(parser)
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.enable_from_args(args, 'partition_load')
+
+    partition_load(backend_from_args(args), args.partitions_dir, args.tables_dir, args.connections, args.dimensions,
+                   args.force, args.verify, args.batch_size)
@@ -0,0 +1,264 @@
+import argparse  # Import argparse to read the command line options
+import csv  # Import the csv module for reading and writing CSV files
+import os  # Import os for path handling
+import shutil  # Import shutil to copy the tables of the regression check
+import sqlite3  # Import sqlite3 to read the database of the regression check
+import tempfile  # Import tempfile for the scratch folder of the regression check
+import time  # Import time to measure the throughput
+from operator import itemgetter  # Import itemgetter to read a column of the rows
+
+import numpy as np  # Import numpy to check whole columns of a batch at once
+
+import metrics
+from csv_chunks import iter_csv_batches, read_header
+from star_schema import FACT_FILE, FACT_TABLE, FOREIGN_KEYS, SALES_MEASURES, TABLE_FILES, TABLES_DIR
+
+# Data-quality gate of the fact table, run before the load so that a bad value is routed to a reject file
+# with its reasons instead of aborting a whole executemany batch (or surfacing later as an SSIS error row
+# with only ErrorCode/ErrorColumn). The checks work on a batch of rows at a time, one column at a time:
+#   - every id (sale_id and foreign keys) and measure parses as a number (measures finite and not negative);
+#   - total_sales and total_sales_usd equal the sum of the RAM, CPU and GPU measures;
+#   - the '_usd' measures of a row share one exchange rate (the one of its totals);
+#   - every foreign key exists in its dimension table;
+#   - time_id is a valid YYYYMMDD day.
+# Amounts are rounded to cents, so sums and conversions are compared with a tolerance of two cents.
+
+REJECT_FILE = 'computer_sales_quality_rejects.csv'
+BATCH_ROWS = 65536  # Rows checked at a time by the command line gate
+TOLERANCE = 0.02 + 1e-9  # Two cents of rounding
+COMPONENTS = ['ram', 'cpu', 'gpu']
+
+def parse_column(rows, position, dtype):
+    # Parse a column of a batch of rows; returns (numbers, mask of the values that are not numbers)
+    parse = int if dtype == np.int64 else float
+    try:
+        # int() and float() are faster than NumPy's conversion of string arrays
+        numbers = np.fromiter(map(parse, map(itemgetter(position), rows)), dtype=dtype, count=len(rows))
+        return numbers, np.zeros(len(rows), dtype=bool)
+    except (ValueError, OverflowError):
+        # At least one bad value: parse one by one (only for the batches with an error)
+        numbers, bad = np.zeros(len(rows), dtype=dtype), np.zeros(len(rows), dtype=bool)
+        for index, row in enumerate(rows):
+            try:
+                numbers[index] = parse(row[position])
+            except (ValueError, OverflowError):
+                bad[index] = True
+        return numbers, bad
+
+def valid_days(time_ids):
+    # Mask of the YYYYMMDD codes that are real days
+    year, month, day = time_ids // 10000, time_ids // 100 % 100, time_ids % 100
+    valid = (year >= 1) & (year <= 9999) & (month >= 1) & (month <= 12) & (day >= 1)
+    months = np.where(valid, (year - 1970) * 12 + month - 1, 0).astype('datetime64[M]')
+    days_in_month = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+    return valid & (day <= days_in_month)
+
+class QualityGate:
+    # Checks batches of fact rows against the dimension tables of 'tables_dir' and writes the rejected rows,
+    # with their reasons, to 'reject_file'
+    def __init__(self, tables_dir=TABLES_DIR, reject_file=None):
+        # Sorted ids of every dimension referenced by the fact table
+        self.keys = {}
+        for column, table in FOREIGN_KEYS[FACT_TABLE]:
+            with open(os.path.join(tables_dir, TABLE_FILES[table]), 'r') as dimension_file:
+                reader = csv.reader(dimension_file)
+                next(reader)
+                self.keys[column] = np.unique(np.array([row[0] for row in reader if row], dtype=np.int64))
+        self.reject_path = reject_file or os.path.join(tables_dir, REJECT_FILE)
+        self.reject_file = None
+        self.reject_writer = None
+        self.header = None
+        self.line = 1  # Line 1 is the header
+        self.checked = 0
+        self.rejected = 0
+        self.reasons = {}  # Reason -> rows
+
+    def start(self, header):
+        # Open the reject file for a fact file with this header
+        self.header = header
+        self.positions = {name: index for index, name in enumerate(header)}
+        missing = [column for column, _ in FOREIGN_KEYS[FACT_TABLE] if column not in self.positions]
+        missing += [column for column in SALES_MEASURES if column not in self.positions]
+        if missing:
+            raise ValueError(f"The fact table has no column {', '.join(missing)}")
+        self.reject_file = open(self.reject_path, 'w', newline='')
+        self.reject_writer = csv.writer(self.reject_file)
+        self.reject_writer.writerow(['line', 'reason'] + header)
+        # Typed rows can be built from the parsed columns when every column is an id or a measure
+        self.typed_columns = set(header) <= {'sale_id', *SALES_MEASURES, *(column for column, _ in FOREIGN_KEYS[FACT_TABLE])}
+
+    def problems(self, rows):
+        # Check a batch of rows of the right width; returns the (reason, mask of the rows failing it) pairs
+        # and the parsed values of every checked column (for the typed rows)
+        positions = self.positions
+        failures = []
+        values = {}  # Column -> parsed values of this batch
+        if 'sale_id' in positions:
+            values['sale_id'], bad = parse_column(rows, positions['sale_id'], np.int64)
+            failures.append(('sale_id not an integer', bad))
+        ids, unparsed_ids = {}, {}
+        for column, _ in FOREIGN_KEYS[FACT_TABLE]:
+            ids[column], bad = parse_column(rows, positions[column], np.int64)
+            values[column] = ids[column]
+            unparsed_ids[column] = bad
+            failures.append((f'{column} not an integer', bad))
+            # The id must exist in its dimension (ids that did not parse are already rejected)
+            keys = self.keys[column]
+            found = np.searchsorted(keys, ids[column])
+            known = keys[np.minimum(found, len(keys) - 1)] == ids[column] if len(keys) else np.zeros(len(rows), bool)
+            failures.append((f'unknown {column}', ~known & ~bad))
+        failures.append(('invalid time_id', ~valid_days(ids['time_id']) & ~unparsed_ids['time_id']))
+
+        measures = {}
+        unparsed = np.zeros(len(rows), dtype=bool)
+        for column in SALES_MEASURES:
+            values[column], bad = parse_column(rows, positions[column], np.float64)
+            bad |= ~np.isfinite(values[column])
+            failures.append((f'{column} not a number', bad))
+            failures.append((f'negative {column}', (values[column] < 0) & ~bad))
+            measures[column] = np.where(bad, 0.0, values[column])
+            unparsed |= bad
+        # The consistency checks only make sense on rows whose measures all parsed
+        for suffix in ('_sales', '_sales_usd'):
+            parts = sum(measures[component + suffix] for component in COMPONENTS)
+            failures.append((f'total{suffix} is not the sum of its components',
+                             (np.abs(measures['total' + suffix] - parts) > TOLERANCE) & ~unparsed))
+        total, total_usd = measures['total_sales'], measures['total_sales_usd']
+        rate = np.divide(total_usd, total, out=np.zeros(len(rows)), where=total > 0)
+        for component in COMPONENTS:
+            expected = measures[component + '_sales'] * rate
+            failures.append((f'{component}_sales_usd inconsistent with {component}_sales',
+                             (np.abs(measures[component + '_sales_usd'] - expected) > TOLERANCE) & ~unparsed))
+        return failures, values
+
+    def filter(self, rows, typed=False):
+        # Return the rows passing every check, writing the others to the reject file. With 'typed' the rows
+        # are returned as tuples of the parsed values (ints and floats, like star_schema.convert_row), so a
+        # loader does not need to convert them again.
+        width = len(self.header)
+        first_line = self.line + 1
+        self.line += len(rows)
+        sized = [len(row) == width for row in rows]
+        checked_rows = rows if all(sized) else [row for row, ok in zip(rows, sized) if ok]
+        self.checked += sum(1 for row in rows if row)  # Blank lines are skipped
+        failures, values = self.problems(checked_rows) if checked_rows else ([], {})
+        bad = np.zeros(len(checked_rows), dtype=bool)
+        for _, mask in failures:
+            bad |= mask
+
+        if bad.any() or len(checked_rows) != len(rows):
+            rejects = [(index, f'expected {width} columns, found {len(row)}')
+                       for index, (row, ok) in enumerate(zip(rows, sized)) if row and not ok]
+            checked_index = np.flatnonzero(sized)
+            for index in np.flatnonzero(bad).tolist():
+                reasons = [reason for reason, mask in failures if mask[index]]
+                rejects.append((int(checked_index[index]), '; '.join(reasons)))
+            for index, reason in sorted(rejects):
+                self.reject_writer.writerow([first_line + index, reason] + rows[index])
+                for single in reason.split('; '):
+                    self.reasons[single] = self.reasons.get(single, 0) + 1
+            self.rejected += len(rejects)
+            metrics.count('quality_rows_rejected', len(rejects), FACT_TABLE)
+
+        if not checked_rows:
+            return []  # Every row of the batch had the wrong number of columns
+        if typed and self.typed_columns:
+            keep = ~bad
+            columns = [values[name][keep].tolist() if bad.any() else values[name].tolist()
+                       for name in self.header]
+            return list(zip(*columns))
+        if not bad.any():
+            return checked_rows
+        return [row for row, keep in zip(checked_rows, (~bad).tolist()) if keep]
+
+    def close(self):
+        if self.reject_file is not None:
+            self.reject_file.close()
+            self.reject_file = None
+
+    def summary(self):
+        lines = [f"Quality gate: {self.checked} rows checked, {self.rejected} rejected to '{self.reject_path}'."]
+        lines += [f"  {reason}: {rows}" for reason, rows in sorted(self.reasons.items(), key=lambda item: -item[1])]
+        return '\n'.join(lines)
+
+def gate_fact(fact_file, tables_dir=TABLES_DIR, output_file=None, reject_file=None, batch_rows=BATCH_ROWS):
+    # Check the fact file and write the rows passing the gate to 'output_file' (by default the fact file
+    # itself is replaced once the check is complete); returns the gate with its counts
+    output_file = output_file or fact_file
+    gate = QualityGate(tables_dir, reject_file)
+    header, data_start = read_header(fact_file)
+    gate.start(header)
+    try:
+        with open(output_file + '.tmp', 'w', newline='') as output:
+            writer = csv.writer(output)
+            writer.writerow(header)
+            for rows, _ in iter_csv_batches(fact_file, data_start, batch_rows):
+                batch_start = time.perf_counter()
+                rows = gate.filter(rows)
+                metrics.observe('quality_batch_seconds', time.perf_counter() - batch_start)
+                writer.writerows(rows)
+    finally:
+        gate.close()
+    os.replace(output_file + '.tmp', output_file)
+    metrics.count('quality_rows_checked', gate.checked, FACT_TABLE)
+    return gate
+
+def regression_check(tables_dir=TABLES_DIR, good_rows=2000):
+    # A batch whose rows all have the wrong width must give no rows, even as the first batch and after
+    # batches of good rows; with loadData.py --quality-gate every good row is loaded once. Returns True if so.
+    from benchmark import run_stage  # Runs a script of this folder in its own process
+    scratch = tempfile.mkdtemp(prefix='gate-check-')
+    try:
+        for file_name in TABLE_FILES.values():
+            if file_name != FACT_FILE:
+                shutil.copy(os.path.join(tables_dir, file_name), scratch)
+        with open(os.path.join(tables_dir, FACT_FILE), 'r') as source:
+            lines = [line for _, line in zip(range(good_rows + 1), source)]
+        with open(os.path.join(scratch, FACT_FILE), 'w') as fact_file:
+            fact_file.writelines(lines + ['1,2,3\n'])
+        header = next(csv.reader(lines[:1]))
+
+        ok = True
+        gate = QualityGate(scratch, os.path.join(scratch, REJECT_FILE))
+        gate.start(header)
+        first = gate.filter([['1', '2', '3']], typed=True)
+        good = gate.filter(list(csv.reader(lines[1:])), typed=True)
+        last = gate.filter([['1', '2', '3']], typed=True)
+        gate.close()
+        print(f"Gate: {len(first)} rows from a first batch of short rows, {len(good)} from {good_rows} good rows, "
+              f"{len(last)} from a later batch of short rows")
+        ok &= first == [] and len(good) == good_rows and last == []
+
+        database = os.path.join(scratch, 'check.sqlite')
+        run_stage(['loadData.py', '--backend', 'sqlite', '--database', database, '--tables-dir', scratch,
+                   '--quality-gate'])
+        with sqlite3.connect(database) as cnxn:
+            loaded, distinct = cnxn.execute(f'SELECT COUNT(*), COUNT(DISTINCT sale_id) FROM {FACT_TABLE}').fetchone()
+        print(f"loadData.py --quality-gate: {loaded} fact rows loaded ({distinct} distinct sale ids)")
+        ok &= loaded == distinct == good_rows
+        print('Quality gate check passed.' if ok else 'Quality gate check FAILED.')
+        return ok
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the fact table before the load and move the bad rows to a reject file.')
+    parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the dimension and fact tables')
+    parser.add_argument('--fact', help='fact table CSV file (default: computer_sales.csv in the tables folder)')
+    parser.add_argument('--output', help='file of the rows passing the gate (default: replace the fact file)')
+    parser.add_argument('--rejects', help=f'reject file (default: {REJECT_FILE} in the tables folder)')
+    parser.add_argument('--batch-rows', type=int, default=BATCH_ROWS, help='rows checked at a time')
+    parser.add_argument('--regression-check', action='store_true',
+                        help='check the gate on batches without any valid row, on a scratch copy of the tables')
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.enable_from_args(args, 'quality_gate')
+
+    if args.regression_check:
+        raise SystemExit(0 if regression_check(args.tables_dir) else 1)
+    start = time.perf_counter()
+    gate = gate_fact(args.fact or os.path.join(args.tables_dir, FACT_FILE), args.tables_dir, args.output,
+                     args.rejects, args.batch_rows)
+    elapsed = time.perf_counter() - start
+    print(gate.summary())
+    print(f"Checked in {elapsed:.2f} s ({gate.checked / elapsed:,.0f} rows/s).")
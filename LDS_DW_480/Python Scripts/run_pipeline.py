@@ -0,0 +1,229 @@
+import argparse  # Import argparse to read the command line options
+import ast  # Import ast to find the local modules imported by the scripts of the stages
+import hashlib  # Import hashlib for the content hashes of the files
+import json  # Import json to store the state of the last build
+import os  # Import os for path handling
+import shlex  # Import shlex to split the extra options of the load
+import sys  # Import sys to tell the built-in modules from the scripts of this folder
+import time  # Import time to measure the stages
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait  # Import the pool running the stages
+
+from benchmark import run_stage
+from star_schema import FACT_FILE, FACT_REJECT_FILE, GEOGRAPHY_FILE, SALES_FILE, TABLE_FILES, TABLES_DIR
+
+# Build of the whole data warehouse as a dependency graph: the original scripts (geograpy.py, time.py,
+# cpu.py, gpu.py, ram.py), the fact builder and loadData.py are declared with the files they read and write,
+# and a stage depends on the stages writing its inputs. Independent stages run at the same time, each in its
+# own process. A stage is skipped when the content hashes of its inputs, of its code (the script and the
+# modules of this folder it imports) and its command line are those of its last successful run, and its
+# outputs are still the files that run wrote. A rebuild without changes only reads the state file: the
+# hash of a file is computed again only when its size or modification time changed.
+#
+# The load has no output file: it is skipped when the tables and the options of loadData.py did not change,
+# so a database modified by other means needs --force load. By default it runs with --upsert, so a rerun
+# only sends the rows that changed.
+
+CACHE_DIR = '../Pipeline cache'  # State of the last build and output of every stage
+STATE_FILE = 'state.json'
+LOAD_ARGUMENTS = '--upsert'
+
+def table_path(file_name):
+    return os.path.join(TABLES_DIR, file_name)
+
+def pipeline_stages(load_arguments=LOAD_ARGUMENTS):
+    # Stage name -> command (a script of this folder and its options), input and output files
+    dimension_files = [table_path(TABLE_FILES[name]) for name in ('Geography', 'Time', 'Cpu', 'Gpu', 'Ram')]
+    return {
+        'geography': {'command': ['geograpy.py'], 'inputs': [GEOGRAPHY_FILE],
+                      'outputs': [table_path('geography.csv')]},
+        'time': {'command': ['time.py'], 'inputs': [SALES_FILE], 'outputs': [table_path('Time.csv')]},
+        'cpu': {'command': ['cpu.py'], 'inputs': [SALES_FILE], 'outputs': [table_path('CPU.csv')]},
+        'gpu': {'command': ['gpu.py'], 'inputs': [SALES_FILE], 'outputs': [table_path('GPU.csv')]},
+        'ram': {'command': ['ram.py'], 'inputs': [SALES_FILE], 'outputs': [table_path('RAM.csv')]},
+        'fact': {'command': ['build_fact.py'], 'inputs': [SALES_FILE] + dimension_files,
+                 'outputs': [table_path(FACT_FILE), table_path(FACT_REJECT_FILE)]},
+        'load': {'command': ['loadData.py'] + shlex.split(load_arguments),
+                 'inputs': dimension_files + [table_path(FACT_FILE)], 'outputs': []}
+    }
+
+def dependencies(stages):
+    # Stage -> stages writing one of its inputs
+    writers = {path: name for name, stage in stages.items() for path in stage['outputs']}
+    return {name: sorted({writers[path] for path in stage['inputs'] if path in writers}) for name, stage in stages.items()}
+
+def select_stages(stages, targets):
+    # The target stages and every stage they depend on
+    needs = dependencies(stages)
+    selected, pending = set(), list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending += needs[name]
+    return {name: stage for name, stage in stages.items() if name in selected}
+
+def local_modules(script, scripts_dir):
+    # The script and the modules of this folder it imports, directly or not ('import time' is the
+    # built-in module, not time.py)
+    found, pending = set(), [script]
+    while pending:
+        path = pending.pop()
+        if path in found:
+            continue
+        found.add(path)
+        with open(os.path.join(scripts_dir, path), 'r') as source:
+            tree = ast.parse(source.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = name.split('.')[0]
+                if module not in sys.builtin_module_names and os.path.exists(os.path.join(scripts_dir, module + '.py')):
+                    pending.append(module + '.py')
+    return sorted(found)
+
+class FileHashes:
+    # Content hashes of files, reused from the previous build while the size and modification time of a
+    # file are unchanged
+    def __init__(self, known):
+        self.known = known  # Path -> {'size', 'mtime_ns', 'sha256'}
+
+    def __call__(self, path):
+        try:
+            status = os.stat(path)
+        except FileNotFoundError:
+            return None
+        entry = self.known.get(path)
+        if entry is None or entry['size'] != status.st_size or entry['mtime_ns'] != status.st_mtime_ns:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as hashed_file:
+                for block in iter(lambda: hashed_file.read(1 << 20), b''):
+                    digest.update(block)
+            entry = {'size': status.st_size, 'mtime_ns': status.st_mtime_ns, 'sha256': digest.hexdigest()}
+            self.known[path] = entry
+        return entry['sha256']
+
+def stage_key(stage, file_hash, scripts_dir):
+    # Hash of everything a stage depends on: command line, code and inputs (an input must exist)
+    inputs = {path: file_hash(path) for path in stage['inputs']}
+    missing = [path for path, digest in inputs.items() if digest is None]
+    if missing:
+        raise FileNotFoundError(f"Missing input {', '.join(missing)}")
+    code = {path: file_hash(os.path.join(scripts_dir, path)) for path in local_modules(stage['command'][0], scripts_dir)}
+    content = json.dumps({'command': stage['command'], 'code': code, 'inputs': inputs}, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def is_current(name, stage, key, state, file_hash):
+    # True when the last run of the stage had this key and its outputs were not changed since
+    previous = state['stages'].get(name)
+    if previous is None or previous['key'] != key:
+        return False
+    return all(file_hash(path) == previous['outputs'].get(path) for path in stage['outputs'])
+
+def load_state(cache_dir):
+    path = os.path.join(cache_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {'files': {}, 'stages': {}}
+    with open(path, 'r') as state_file:
+        return json.load(state_file)
+
+def save_state(cache_dir, state):
+    # Written after every stage, so an interrupted build keeps the stages it completed
+    path = os.path.join(cache_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def run_pipeline(stages, jobs=4, force=(), cache_dir=CACHE_DIR, dry_run=False):
+    # Run the stages that are not current, up to 'jobs' at a time; returns stage -> 'ran', 'skipped',
+    # 'failed' or 'not run' (a stage after a failed one)
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    os.makedirs(cache_dir, exist_ok=True)
+    state = load_state(cache_dir)
+    file_hash = FileHashes(state['files'])
+    needs = {name: [need for need in stage_needs if need in stages] for name, stage_needs in dependencies(stages).items()
+             if name in stages}
+    outcome = {}
+    running = {}  # Future -> (stage, key)
+    with ThreadPoolExecutor(jobs) as executor:
+        while len(outcome) < len(stages):
+            # Decide on every stage whose dependencies are done
+            started = {name for name, _ in running.values()}
+            for name, stage in stages.items():
+                if name in outcome or name in started or any(need not in outcome for need in needs[name]):
+                    continue
+                if any(outcome[need] in ('failed', 'not run') for need in needs[name]):
+                    outcome[name] = 'not run'
+                    continue
+                if dry_run and any(outcome[need] == 'ran' for need in needs[name]):
+                    # The inputs will change, the key cannot be known yet
+                    outcome[name] = 'ran'
+                    print(f"{name}: would run {' '.join(stage['command'])}")
+                    continue
+                try:
+                    key = stage_key(stage, file_hash, scripts_dir)
+                except (FileNotFoundError, SyntaxError) as error:
+                    outcome[name] = 'failed'
+                    print(f"{name}: FAILED, {error}")
+                    continue
+                if name not in force and is_current(name, stage, key, state, file_hash):
+                    outcome[name] = 'skipped'
+                    print(f"{name}: up to date")
+                elif dry_run:
+                    outcome[name] = 'ran'
+                    print(f"{name}: would run {' '.join(stage['command'])}")
+                else:
+                    print(f"{name}: running {' '.join(stage['command'])}...")
+                    running[executor.submit(run_stage, stage['command'])] = (name, key)
+                    started.add(name)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, key = running.pop(future)
+                try:
+                    seconds, peak_rss, output = future.result()
+                except RuntimeError as error:
+                    outcome[name] = 'failed'
+                    print(f"{name}: FAILED\n{error}")
+                    continue
+                with open(os.path.join(cache_dir, f'{name}.log'), 'w') as log_file:
+                    log_file.write(output)
+                state['stages'][name] = {'key': key, 'seconds': round(seconds, 3),
+                                         'outputs': {path: file_hash(path) for path in stages[name]['outputs']}}
+                outcome[name] = 'ran'
+                print(f"{name}: done in {seconds:.2f} s, peak RSS {peak_rss:,.0f} MB")
+                save_state(cache_dir, state)
+    if not dry_run:
+        save_state(cache_dir, state)
+    return outcome
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the data warehouse, rerunning only the stages whose inputs or code changed.')
+    parser.add_argument('targets', nargs='*', help='stages to bring up to date, with the stages they depend on (default: all)')
+    parser.add_argument('--jobs', type=int, default=4, help='stages run at the same time')
+    parser.add_argument('--force', nargs='+', default=[], metavar='STAGE', help='run these stages even if they are up to date')
+    parser.add_argument('--load-args', default=LOAD_ARGUMENTS,
+                        help=f'options of loadData.py, e.g. --load-args="--backend sqlite --database dw.sqlite --upsert" '
+                             f'(default: {LOAD_ARGUMENTS})')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='folder of the build state and the stage logs')
+    parser.add_argument('--dry-run', action='store_true', help='only print the stages that would run')
+    args = parser.parse_args()
+
+    stages = pipeline_stages(args.load_args)
+    unknown = [name for name in args.targets + args.force if name not in stages]
+    if unknown:
+        parser.error(f"unknown stage {', '.join(unknown)} (stages: {', '.join(stages)})")
+    if args.targets:
+        stages = select_stages(stages, args.targets)
+
+    start = time.perf_counter()
+    outcome = run_pipeline(stages, args.jobs, set(args.force), args.cache_dir, args.dry_run)
+    counts = {result: sum(1 for value in outcome.values() if value == result) for result in ('ran', 'skipped', 'failed', 'not run')}
+    print(f"Build finished in {time.perf_counter() - start:.2f} s: "
+          + ', '.join(f'{count} {result}' for result, count in counts.items() if count) + '.')
+    raise SystemExit(1 if counts['failed'] else 0)
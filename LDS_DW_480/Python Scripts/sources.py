@@ -0,0 +1,139 @@
+import argparse  # Import argparse to read the command line options
+import bz2  # Import bz2 to read .bz2 shards
+import csv  # Import the csv module to read the shards
+import glob  # Import glob to expand the patterns of the shards
+import gzip  # Import gzip to read .gz shards
+import lzma  # Import lzma to read .xz shards
+import multiprocessing  # Import multiprocessing to process the shards on several cores
+import os  # Import os for path handling
+import shutil  # Import shutil to remove the benchmark shards
+import tempfile  # Import tempfile to write the benchmark shards in a scratch folder
+import time  # Import time to measure the throughput
+
+from star_schema import SALES_FILE
+
+# Sharded and compressed sources: the sales can be given as one file or as a glob pattern of shards (e.g.
+# '../Original data/sales_*.csv.gz'), each shard being a CSV file with the same header, plain or compressed
+# with gzip, bzip2 or xz. Compressed shards are decompressed while they are read, never to disk. The shards
+# are read in sorted order, so a run over the shards gives the same result as a run over their
+# concatenation; the scripts processing the shards in parallel merge the results of the workers in that
+# same order.
+
+CODECS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+def expand_sources(pattern):
+    # The shards matching a glob pattern, in sorted order; a path without wildcards is returned as it is
+    # (so a missing file fails when it is opened, like before)
+    if not glob.has_magic(pattern):
+        return [pattern]
+    paths = sorted(glob.glob(pattern))
+    if not paths:
+        raise FileNotFoundError(f"No sales shard matches '{pattern}'")
+    return paths
+
+def is_compressed(path):
+    return os.path.splitext(path)[1].lower() in CODECS
+
+def is_sharded(paths):
+    # True when the sources cannot be read as one plain file (byte offsets, seeks)
+    return len(paths) > 1 or any(is_compressed(path) for path in paths)
+
+def open_source(path):
+    # Open a shard as text, decompressing on the fly by its extension
+    opener = CODECS.get(os.path.splitext(path)[1].lower())
+    if opener is None:
+        return open(path, 'r')
+    return opener(path, 'rt')
+
+def source_header(paths):
+    # Header of the first shard
+    with open_source(paths[0]) as source:
+        return next(csv.reader(source))
+
+def source_rows(paths, header=None):
+    # Yield the data rows of every shard in order, checking that every shard has the same header
+    header = header or source_header(paths)
+    for path in paths:
+        with open_source(path) as source:
+            reader = csv.reader(source)
+            shard_header = next(reader, None)
+            if shard_header is None:
+                continue  # Empty shard
+            if shard_header != header:
+                raise ValueError(f"The header of '{path}' differs from the one of '{paths[0]}'")
+            yield from reader
+
+def map_shards(function, tasks, workers=1, initializer=None, initargs=()):
+    # Apply 'function' to every task, in parallel if workers > 1; results are yielded in task order
+    if workers <= 1 or len(tasks) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(function, tasks)
+        return
+    with multiprocessing.Pool(min(workers, len(tasks)), initializer, initargs) as pool:
+        yield from pool.imap(function, tasks)
+
+def split_sales(sales_file, output_dir, shards, codec=None):
+    # Split a sales file into shards of about the same number of rows (each with the header), compressed
+    # with 'codec' ('gz', 'bz2', 'xz' or None); returns the glob pattern of the shards
+    with open(sales_file, 'r') as sales:
+        reader = csv.reader(sales)
+        header = next(reader)
+        rows = list(reader)
+    os.makedirs(output_dir, exist_ok=True)
+    extension = f'.csv.{codec}' if codec else '.csv'
+    opener = CODECS.get(f'.{codec}', open) if codec else open
+    size = -(-len(rows) // shards)
+    for index in range(shards):
+        with opener(os.path.join(output_dir, f'sales_{index:04d}{extension}'), 'wt', newline='') as shard:
+            writer = csv.writer(shard)
+            writer.writerow(header)
+            writer.writerows(rows[index * size:(index + 1) * size])
+    return os.path.join(output_dir, f'sales_*{extension}')
+
+def benchmark(sales_file, shards, workers):
+    # Throughput of the key scan of extract_dimensions over the plain file and over plain and compressed
+    # shards, with one and with 'workers' processes
+    from extract_dimensions import scan_sales_parallel
+    reference = None
+    scratch = tempfile.mkdtemp(prefix='shards-')
+    try:
+        cases = [('single file', sales_file)]
+        for codec in (None, 'gz', 'bz2', 'xz'):
+            cases.append((f"{shards} shards {codec or 'plain'}",
+                          split_sales(sales_file, os.path.join(scratch, codec or 'plain'), shards, codec)))
+        print(f"{'source':<20} {'MB':>8} {'workers':>7} {'seconds':>8} {'rows/s':>12}")
+        for label, pattern in cases:
+            size = sum(os.path.getsize(path) for path in expand_sources(pattern)) / 1024 / 1024
+            for worker_count in sorted({1, workers}):
+                start = time.perf_counter()
+                keys, row_count = scan_sales_parallel(pattern, worker_count)
+                elapsed = time.perf_counter() - start
+                if reference is None:
+                    reference = keys
+                elif keys != reference:
+                    print(f"Keys read from {label} with {worker_count} workers differ from the single file")
+                    return False
+                print(f"{label:<20} {size:>8.1f} {worker_count:>7} {elapsed:>8.2f} {row_count / elapsed:>12,.0f}")
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split the sales into (compressed) shards or measure the throughput of sharded sources.')
+    parser.add_argument('--sales', default=SALES_FILE, help='sales CSV file')
+    parser.add_argument('--split', metavar='DIR', help='write the shards of the sales file to this folder')
+    parser.add_argument('--shards', type=int, default=8, help='number of shards')
+    parser.add_argument('--codec', choices=['gz', 'bz2', 'xz'], help='compression of the shards')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='measure the key scan over the plain file and over plain and compressed shards')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes of the benchmark')
+    args = parser.parse_args()
+
+    if args.split:
+        pattern = split_sales(args.sales, args.split, args.shards, args.codec)
+        print(f"Shards written: '{pattern}'.")
+    elif args.benchmark:
+        raise SystemExit(0 if benchmark(args.sales, args.shards, args.workers) else 1)
+    else:
+        parser.error('nothing to do: use --split DIR or --benchmark')
@@ -0,0 +1,199 @@
+from datetime import datetime  # Import the datetime module to handle date and time operations
+from functools import lru_cache  # Import lru_cache to parse each time code only once
+
+# Shared definitions of the star schema used by the extraction and loading scripts.
+# All paths are relative to the 'Python Scripts' folder, like in the original scripts.
+
+# Source files and output folder
+SALES_FILE = '../Original data/computer_sales.csv'
+GEOGRAPHY_FILE = '../Original data/geography.csv'
+TABLES_DIR = '../Tables CSV'
+REGISTRY_DIR = '../Key registry'  # Surrogate-key registry used by the incremental runs
+
+# Dimensions extracted from the sales file.
+# 'key' lists the source columns forming the natural key (the same tuples built in cpu.py, gpu.py, ram.py and time.py),
+# 'fields' lists the columns of the output CSV file, starting with the surrogate id.
+DIMENSIONS = {
+    'Cpu': {
+        'file': 'CPU.csv',
+        'id': 'cpu_id',
+        'key': ['cpu_vendor_name', 'cpu_brand', 'cpu_series', 'cpu_name', 'cpu_n_cores', 'cpu_socket'],
+        'fields': ['cpu_id', 'cpu_vendor_name', 'cpu_brand', 'cpu_series', 'cpu_name', 'cpu_n_cores', 'cpu_socket']
+    },
+    'Gpu': {
+        'file': 'GPU.csv',
+        'id': 'gpu_id',
+        # Note that 'cpu_series' is part of the GPU key, as in gpu.py
+        'key': ['gpu_vendor_name', 'gpu_brand', 'cpu_series', 'gpu_processor_manufacturer', 'gpu_memory', 'gpu_memory_type'],
+        'fields': ['gpu_id', 'gpu_vendor_name', 'gpu_brand', 'cpu_series', 'gpu_processor_manufacturer', 'gpu_memory', 'gpu_memory_type']
+    },
+    'Ram': {
+        'file': 'RAM.csv',
+        'id': 'ram_id',
+        'key': ['ram_vendor_name', 'ram_brand', 'ram_name', 'ram_type', 'ram_size', 'ram_clock'],
+        'fields': ['ram_id', 'ram_vendor_name', 'ram_brand', 'ram_name', 'ram_type', 'ram_size', 'ram_clock']
+    },
+    'Time': {
+        'file': 'Time.csv',
+        'id': 'time_id',
+        # The time code itself (YYYYMMDD) is used as the time_id, the other columns are derived from it
+        'key': ['time_code'],
+        'fields': ['time_id', 'day', 'month', 'year', 'day_of_week', 'week', 'quarter']
+    }
+}
+
+# Geography dimension, read from its own source file
+GEOGRAPHY = {
+    'file': 'geography.csv',
+    'id': 'geo_id',
+    'fields': ['geo_id', 'continent', 'country', 'region', 'currency']
+}
+
+# Dictionary mapping countries to their currencies (same as geograpy.py)
+country_currency_map = {
+    'Germany': 'EUR',  # Euro
+    'Spain': 'EUR',    # Euro
+    'Australia': 'AUD', # Australian Dollar
+    'United Kingdom': 'GBP', # British Pound
+    'Belgium': 'EUR',   # Euro
+    'Canada': 'CAD',    # Canadian Dollar
+    'New Zealand': 'NZD', # New Zealand Dollar
+    'United States of America': 'USD', # US Dollar
+    'France': 'EUR',    # Euro
+    'Ireland': 'EUR',   # Euro
+    'Italy': 'EUR'      # Euro
+}
+
+@lru_cache(maxsize=None)
+def parse_time_code(time_code):
+    # Memoized: the same codes come back in every run and every chunk; callers must not modify the result.
+    # Convert the time code (in 'YYYYMMDD' format) to a datetime object
+    dt = datetime.strptime(str(time_code), "%Y%m%d")
+
+    # Extract and return different components of the date (same as time.py)
+    return {
+        'day': dt.day,  # Day of the month
+        'month': dt.month,  # Month of the year
+        'year': dt.year,  # Year
+        'day_of_week': dt.strftime('%A'),  # Day of the week as a full name (e.g., 'Monday')
+        'week': dt.isocalendar()[1],  # ISO calendar week of the year
+        'quarter': f"Q{(dt.month - 1) // 3 + 1}"  # Quarter of the year formatted as 'Q1', 'Q2', etc.
+    }
+
+# Fact table written by the fact builder and loaded last by loadData.py
+FACT_TABLE = 'Computer_sales'
+FACT_FILE = 'computer_sales.csv'
+FACT_REJECT_FILE = 'computer_sales_rejects.csv'
+
+# Sales measures, copied unchanged from the sales file to the fact table
+SALES_MEASURES = ['ram_sales', 'ram_sales_usd', 'cpu_sales', 'cpu_sales_usd',
+                  'gpu_sales', 'gpu_sales_usd', 'total_sales', 'total_sales_usd']
+
+# Columns of the fact table, in the same order as its CREATE TABLE statement
+FACT_FIELDS = ['sale_id', 'geo_id', 'time_id', 'ram_id', 'cpu_id', 'gpu_id'] + SALES_MEASURES
+
+# Columns and SQL types of every table of the data warehouse, used to build the CREATE TABLE statements
+# and the typed columnar files. The first column of each table is its primary key.
+TABLE_COLUMNS = {
+    'Geography': [
+        ('geo_id', 'INT'),
+        ('continent', 'VARCHAR(255)'),
+        ('country', 'VARCHAR(255)'),
+        ('region', 'VARCHAR(255)'),
+        ('currency', 'VARCHAR(255)')
+    ],
+    'Time': [
+        ('time_id', 'INT'),
+        ('day', 'INT'),
+        ('month', 'INT'),
+        ('year', 'INT'),
+        ('day_of_week', 'VARCHAR(255)'),
+        ('week', 'INT'),
+        ('quarter', 'VARCHAR(255)')
+    ],
+    'Cpu': [
+        ('cpu_id', 'INT'),
+        ('cpu_vendor_name', 'VARCHAR(255)'),
+        ('cpu_brand', 'VARCHAR(255)'),
+        ('cpu_series', 'VARCHAR(255)'),
+        ('cpu_name', 'VARCHAR(255)'),
+        ('cpu_n_cores', 'INT'),
+        ('cpu_socket', 'VARCHAR(255)')
+    ],
+    'Gpu': [
+        ('gpu_id', 'INT'),
+        ('gpu_vendor_name', 'VARCHAR(255)'),
+        ('gpu_brand', 'VARCHAR(255)'),
+        ('cpu_series', 'VARCHAR(255)'),
+        ('gpu_processor_manufacturer', 'VARCHAR(255)'),
+        ('gpu_memory', 'FLOAT'),
+        ('gpu_memory_type', 'VARCHAR(255)')
+    ],
+    'Ram': [
+        ('ram_id', 'INT'),
+        ('ram_vendor_name', 'VARCHAR(255)'),
+        ('ram_brand', 'VARCHAR(255)'),
+        ('ram_name', 'VARCHAR(255)'),
+        ('ram_type', 'VARCHAR(255)'),
+        ('ram_size', 'FLOAT'),
+        ('ram_clock', 'FLOAT')
+    ],
+    'Computer_sales': [
+        ('sale_id', 'INT'),
+        ('geo_id', 'INT'),
+        ('time_id', 'INT'),
+        ('ram_id', 'INT'),
+        ('cpu_id', 'INT'),
+        ('gpu_id', 'INT'),
+        ('ram_sales', 'FLOAT'),
+        ('ram_sales_usd', 'FLOAT'),
+        ('cpu_sales', 'FLOAT'),
+        ('cpu_sales_usd', 'FLOAT'),
+        ('gpu_sales', 'FLOAT'),
+        ('gpu_sales_usd', 'FLOAT'),
+        ('total_sales', 'FLOAT'),
+        ('total_sales_usd', 'FLOAT')
+    ]
+}
+
+# Foreign keys of the fact table: (column, referenced dimension table)
+FOREIGN_KEYS = {
+    'Computer_sales': [
+        ('geo_id', 'Geography'),
+        ('time_id', 'Time'),
+        ('ram_id', 'Ram'),
+        ('cpu_id', 'Cpu'),
+        ('gpu_id', 'Gpu')
+    ]
+}
+
+# CSV file of every table in the 'Tables CSV' folder, in load order (dimensions first, fact table last)
+TABLE_FILES = {
+    'Geography': GEOGRAPHY['file'],
+    'Time': DIMENSIONS['Time']['file'],
+    'Cpu': DIMENSIONS['Cpu']['file'],
+    'Gpu': DIMENSIONS['Gpu']['file'],
+    'Ram': DIMENSIONS['Ram']['file'],
+    FACT_TABLE: FACT_FILE
+}
+
+def create_table_query(table_name, foreign_keys=True):
+    # Build the CREATE TABLE statement of a table from its column definitions
+    columns = TABLE_COLUMNS[table_name]
+    lines = [f"{columns[0][0]} {columns[0][1]} PRIMARY KEY"]
+    lines += [f"{name} {sql_type}" for name, sql_type in columns[1:]]
+    if foreign_keys:
+        lines += [f"FOREIGN KEY ({column}) REFERENCES {table}({TABLE_COLUMNS[table][0][0]})"
+                  for column, table in FOREIGN_KEYS.get(table_name, [])]
+    return f"CREATE TABLE {table_name} (\n    " + ",\n    ".join(lines) + "\n)"
+
+def column_converters(table_name, columns):
+    # Return, for each column, a function converting its CSV text to the Python type of its SQL type.
+    # Empty strings become None (NULL).
+    sql_types = dict(TABLE_COLUMNS[table_name])
+    python_types = {'INT': int, 'FLOAT': float}
+    return [python_types.get(sql_types[column], str) for column in columns]
+
+def convert_row(converters, row):
+    # Convert a CSV row with the functions returned by column_converters
+    return [convert(value) if value != '' else None for convert, value in zip(converters, row)]
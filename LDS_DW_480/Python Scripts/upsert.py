@@ -0,0 +1,190 @@
+import argparse  # Import argparse to read the command line options
+import csv  # Import the csv module to write the tables of the check
+import hashlib  # Import hashlib for the content hashes of the rows
+import os  # Import os for path handling
+import re  # Import re to read the upsert summaries printed by loadData.py
+import shutil  # Import shutil to copy the tables of the check
+import sqlite3  # Import sqlite3 to read the database of the check
+import tempfile  # Import tempfile for the scratch folder of the check
+
+from star_schema import FACT_TABLE, TABLE_COLUMNS, TABLE_FILES, TABLES_DIR
+
+# Incremental refresh of the tables by upsert. A hash of the content of every loaded row is kept in the
+# database, in a table of (table, primary key, hash). Before a batch is sent, the hash of each row is
+# compared with the stored one: unchanged rows are dropped on the client, so only new and changed rows
+# cross the network. Those are bulk-inserted into a temporary staging table and applied to the target
+# table with one set-based statement (MERGE on SQL Server, INSERT ... ON CONFLICT on SQLite, see
+# db_backends.py), which inserts the new keys and updates the existing ones; their hashes are merged into
+# the hash table in the same transaction. Running the load again with the same files sends nothing.
+# Rows missing from the files are not deleted.
+#
+# The stored hashes are only valid while the upserter is the only writer of a table: every other load
+# (loadData.py without --upsert, --bulk-reload, computer_sales.py, parallel_load.py, partition_load.py) calls
+# forget_hashes() for the tables it writes, and an upserter finding a number of hashes different from the
+# number of rows of its table drops them, so the next upsert sends every row again instead of trusting them.
+
+ROW_HASH_TABLE = 'Row_hashes'
+
+def create_hash_table(backend, cursor):
+    if not backend.table_exists(cursor, ROW_HASH_TABLE):
+        cursor.execute(f"""CREATE TABLE {ROW_HASH_TABLE} (
+    table_name VARCHAR(255),
+    row_id BIGINT,
+    row_hash CHAR(32),
+    PRIMARY KEY (table_name, row_id)
+)""")
+
+def read_hashes(cursor, table_name):
+    # Primary key -> content hash of the rows of a table loaded by a previous upsert. The table name is a
+    # literal: on SQL Server the cursor may still carry the input sizes of the last staging insert.
+    cursor.execute(f"SELECT row_id, row_hash FROM {ROW_HASH_TABLE} WHERE table_name = '{table_name}'")
+    return dict(cursor.fetchall())
+
+def forget_hashes(backend, cursor, table_name):
+    # Drop the stored hashes of a table written without the upserter; the caller commits (with the write)
+    if backend.table_exists(cursor, ROW_HASH_TABLE):
+        cursor.execute(f"DELETE FROM {ROW_HASH_TABLE} WHERE table_name = '{table_name}'")
+
+def count_rows(cursor, table_name):
+    cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
+    return cursor.fetchone()[0]
+
+def row_hash(row):
+    # 128-bit hash of the typed values of a row (repr tells None from 'None' and 1 from 1.0)
+    return hashlib.blake2b(repr(tuple(row)).encode('utf-8'), digest_size=16).hexdigest()
+
+class Upserter:
+    # Upserts the batches of one table through its staging table; the caller commits
+    def __init__(self, backend, cursor, table_name, columns, hash_table=ROW_HASH_TABLE):
+        key = TABLE_COLUMNS[table_name][0][0]
+        if key not in columns:
+            raise ValueError(f"The file of '{table_name}' has no column '{key}'")
+        self.backend = backend
+        self.cursor = cursor
+        self.table_name = table_name
+        self.columns = columns
+        self.hash_table = hash_table
+        self.key_index = columns.index(key)
+        self.hashes = read_hashes(cursor, table_name)
+        self.discarded = 0  # Stored hashes dropped because they did not match the table
+        if self.hashes and len(self.hashes) != count_rows(cursor, table_name):
+            # The table was written by other means since the last upsert: its hashes cannot be trusted
+            self.discarded = len(self.hashes)
+            forget_hashes(backend, cursor, table_name)
+            self.hashes = {}
+        self.staging = backend.create_staging(cursor, table_name, columns)
+        self.insert_query = backend.prepare_staging_insert(cursor, table_name, self.staging, columns)
+        self.inserted = 0  # Rows without a stored hash (new, or loaded before without --upsert)
+        self.updated = 0  # Rows whose content changed
+        self.unchanged = 0  # Rows not sent
+
+    def upsert(self, rows):
+        # Stage the new and changed rows of a batch and apply them; returns the number of rows sent
+        hashes, key_index = self.hashes, self.key_index
+        changed = []
+        for row in rows:
+            content = row_hash(row)
+            key = row[key_index]
+            previous = hashes.get(key)
+            if previous == content:
+                continue
+            if previous is None:
+                self.inserted += 1
+            else:
+                self.updated += 1
+            hashes[key] = content
+            changed.append((*row, content))
+        self.unchanged += len(rows) - len(changed)
+        if changed:
+            self.backend.insert_rows(self.cursor, self.insert_query, changed)
+            self.backend.merge_staging(self.cursor, self.table_name, self.staging, self.columns, self.hash_table)
+        return len(changed)
+
+    def close(self):
+        self.backend.drop_staging(self.cursor, self.staging)
+
+    def summary(self):
+        summary = (f"Upsert of '{self.table_name}': {self.inserted} new, {self.updated} changed, "
+                   f"{self.unchanged} unchanged (not sent).")
+        if self.discarded:
+            summary += f" {self.discarded} stored hashes did not match the table and were discarded."
+        return summary
+
+def regression_check(tables_dir=TABLES_DIR, fact_rows=200):
+    # Reload followed by upsert, with loadData.py on a scratch SQLite database: an upsert after a load by other
+    # means must not trust the hashes of the earlier upserts. Returns True when every step gives what it should.
+    from benchmark import run_stage  # Runs a script of this folder in its own process
+    scratch = tempfile.mkdtemp(prefix='upsert-check-')
+    try:
+        for table_name, file_name in TABLE_FILES.items():
+            with open(os.path.join(tables_dir, file_name), 'r') as source, \
+                    open(os.path.join(scratch, file_name), 'w') as copy:
+                for index, line in enumerate(source):
+                    if table_name == FACT_TABLE and index > fact_rows:
+                        break
+                    copy.write(line)
+        cpu_file = os.path.join(scratch, TABLE_FILES['Cpu'])
+        shutil.copy(cpu_file, cpu_file + '.original')
+        with open(cpu_file, 'r') as source:
+            rows = list(csv.reader(source))
+        rows[3][5] = str(int(rows[3][5]) + 1)  # Cpu 2 changed
+        rows.append(['999'] + rows[1][1:])  # Cpu 999 added
+        with open(cpu_file + '.changed', 'w', newline='') as changed:
+            csv.writer(changed).writerows(rows)
+
+        database = os.path.join(scratch, 'check.sqlite')
+        def load(cpu_version, *options):
+            shutil.copy(f'{cpu_file}.{cpu_version}', cpu_file)
+            _, _, output = run_stage(['loadData.py', '--backend', 'sqlite', '--database', database,
+                                      '--tables-dir', scratch, *options])
+            found = re.search(r"Upsert of 'Cpu': (\d+) new, (\d+) changed", output)
+            return (int(found.group(1)), int(found.group(2))) if found else None
+
+        def cpu_matches():
+            # The Cpu table holds exactly the rows of the CSV file loaded last
+            with open(cpu_file, 'r') as source:
+                expected = sorted(list(csv.reader(source))[1:], key=lambda row: int(row[0]))
+            with sqlite3.connect(database) as cnxn:
+                table = [[str(value) for value in row] for row in cnxn.execute('SELECT * FROM Cpu ORDER BY cpu_id')]
+            return table == expected
+
+        def empty_tables():
+            # Tables emptied by hand (e.g. before a plain load into an existing database); Row_hashes is kept
+            with sqlite3.connect(database) as cnxn:
+                for table_name in reversed(list(TABLE_FILES)):
+                    cnxn.execute(f'DELETE FROM {table_name}')
+
+        ok = True
+        def expect(label, counts, expected):
+            # Counts of the Cpu upsert (None for a load without --upsert) and content of the table
+            nonlocal ok
+            matches = cpu_matches()
+            print(f"{label}: " + (f"Cpu {counts[0]} new, {counts[1]} changed" if counts else 'loaded')
+                  + ('' if counts == expected else f' (expected {expected[0]} new, {expected[1]} changed)')
+                  + ('' if matches else ', table Cpu differs from the file'))
+            ok &= counts == expected and matches
+
+        original, changed = len(rows) - 2, len(rows) - 1  # Data rows of the two versions of CPU.csv
+        expect('first upsert', load('original', '--upsert'), (original, 0))
+        expect('upsert of the changed rows', load('changed', '--upsert'), (1, 1))
+        expect('same upsert again', load('changed', '--upsert'), (0, 0))
+        expect('bulk reload of the original rows', load('original', '--bulk-reload'), None)
+        # The hashes were dropped by the reload: every row is sent again
+        expect('upsert after the bulk reload', load('changed', '--upsert'), (changed, 0))
+        empty_tables()
+        expect('plain load of the original rows', load('original'), None)
+        expect('upsert after the plain load', load('changed', '--upsert'), (changed, 0))
+        # A table written behind the upserter's back (here one row deleted) makes it discard the hashes
+        with sqlite3.connect(database) as cnxn:
+            cnxn.execute('DELETE FROM Cpu WHERE cpu_id = 999')
+        expect('upsert after a row was deleted by hand', load('changed', '--upsert'), (changed, 0))
+        print('Upsert check passed.' if ok else 'Upsert check FAILED.')
+        return ok
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the upsert of loadData.py against loads by other means.')
+    parser.add_argument('--tables-dir', default=TABLES_DIR, help='folder with the CSV tables copied for the check')
+    args = parser.parse_args()
+    raise SystemExit(0 if regression_check(args.tables_dir) else 1)